@@ -1,11 +1,42 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+import time
+_IMPORT_STARTED = time.perf_counter()  # start of the "imports" phase in the start-up profile
+
+from flask import (Flask, render_template, request, redirect, url_for, session, flash, jsonify, g, send_from_directory,
+                   Response, abort, stream_template, render_template_string, has_app_context, has_request_context)
+from functools import wraps
+from collections import OrderedDict, deque
+import bisect
+import hashlib
+import json
+import logging
+import re
+import tempfile
+import csv
+import io
+import gzip
+import shutil
+import zlib
+import zipfile
+from xml.sax.saxutils import escape as xml_escape
+import argparse
+import socket
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from concurrent.futures import ThreadPoolExecutor
 import sqlite3
 import os
 import sys
+import queue
+import random
+import threading
+from contextlib import contextmanager
+import click
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from werkzeug.utils import safe_join, secure_filename
+from markupsafe import Markup, escape
 from datetime import datetime
 
+_IMPORTS_DONE = time.perf_counter()
+
 def resource_path(relative_path):
     """ Get absolute path to resource, works for dev and for PyInstaller """
     try:
@@ -16,11 +47,17 @@ def resource_path(relative_path):
 
     return os.path.join(base_path, relative_path)
 
-def init_db(db_path):
-    """ Initialize database tables if they don't exist """
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-
+def run_script(c, script):
+    """ Run a multi-statement script inside the caller's transaction (executescript commits first) """
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            c.execute(statement)
+            statement = ''
+
+def _migration_1_base_schema(c):
+    """ Base tables and the default admin account """
     # Create users table
     c.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -71,13 +108,730 @@ def init_db(db_path):
     # Check if admin user exists, if not create it
     c.execute('SELECT id FROM users WHERE username = ?', ('admin',))
     if not c.fetchone():
-        from werkzeug.security import generate_password_hash
         hashed_password = generate_password_hash("123456")
         c.execute('INSERT INTO users (email, username, password) VALUES (?, ?, ?)',
                   ("admin@example.com", "admin", hashed_password))
 
-    conn.commit()
-    conn.close()
+# Recompute every borrower's balance row from the raw tables
+BALANCES_SELECT_SQL = '''
+    SELECT b.id AS borrower_id,
+           b.total_amount AS total_loaned,
+           COALESCE(p.total_paid, 0) AS total_paid,
+           b.total_amount - COALESCE(p.total_paid, 0) AS remaining,
+           p.last_payment_date,
+           COALESCE(p.payment_count, 0) AS payment_count,
+           COALESCE(d.device_count, 0) AS device_count,
+           d.last_device_date
+    FROM borrowers b
+    LEFT JOIN (SELECT borrower_id, SUM(amount_paid) AS total_paid, MAX(payment_date) AS last_payment_date,
+                      COUNT(*) AS payment_count
+               FROM payments GROUP BY borrower_id) p ON p.borrower_id = b.id
+    LEFT JOIN (SELECT borrower_id, COUNT(*) AS device_count, MAX(device_date) AS last_device_date
+               FROM devices GROUP BY borrower_id) d ON d.borrower_id = b.id
+'''
+
+BALANCE_COLUMNS = ('total_loaned', 'total_paid', 'remaining', 'last_payment_date',
+                   'payment_count', 'device_count', 'last_device_date')
+
+# Shop-wide totals computed straight from the raw tables
+SUMMARY_SELECT_SQL = '''
+    SELECT COALESCE(SUM(b.total_amount), 0) AS total_loans,
+           COALESCE(SUM(p.total_paid), 0) AS total_paid,
+           COALESCE(SUM(b.total_amount - COALESCE(p.total_paid, 0)), 0) AS total_remaining,
+           COUNT(b.id) AS borrower_count,
+           COALESCE(SUM(b.total_amount - COALESCE(p.total_paid, 0) <= 0), 0) AS settled_count
+    FROM borrowers b
+    LEFT JOIN (SELECT borrower_id, SUM(amount_paid) AS total_paid
+               FROM payments GROUP BY borrower_id) p ON p.borrower_id = b.id
+'''
+
+SUMMARY_COLUMNS = ('total_loans', 'total_paid', 'total_remaining', 'borrower_count', 'settled_count')
+
+def _migration_2_balances(c):
+    """ Per-borrower balances kept current by triggers on borrowers, payments and devices """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS balances (
+            borrower_id INTEGER PRIMARY KEY,
+            total_loaned REAL NOT NULL DEFAULT 0,
+            total_paid REAL NOT NULL DEFAULT 0,
+            remaining REAL NOT NULL DEFAULT 0,
+            last_payment_date TEXT,
+            payment_count INTEGER NOT NULL DEFAULT 0,
+            device_count INTEGER NOT NULL DEFAULT 0,
+            last_device_date TEXT
+        )
+    ''')
+
+    run_script(c, '''
+        CREATE TRIGGER IF NOT EXISTS balances_borrower_insert AFTER INSERT ON borrowers
+        BEGIN
+            INSERT INTO balances (borrower_id, total_loaned, remaining)
+            VALUES (NEW.id, NEW.total_amount, NEW.total_amount);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS balances_borrower_update AFTER UPDATE OF total_amount ON borrowers
+        BEGIN
+            UPDATE balances SET total_loaned = NEW.total_amount,
+                                remaining = NEW.total_amount - total_paid
+            WHERE borrower_id = NEW.id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS balances_borrower_delete AFTER DELETE ON borrowers
+        BEGIN
+            DELETE FROM balances WHERE borrower_id = OLD.id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS balances_payment_insert AFTER INSERT ON payments
+        BEGIN
+            UPDATE balances SET total_paid = total_paid + NEW.amount_paid,
+                                remaining = total_loaned - total_paid - NEW.amount_paid,
+                                payment_count = payment_count + 1,
+                                last_payment_date = CASE
+                                    WHEN last_payment_date IS NULL OR NEW.payment_date > last_payment_date
+                                    THEN NEW.payment_date ELSE last_payment_date END
+            WHERE borrower_id = NEW.borrower_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS balances_payment_update
+        AFTER UPDATE OF borrower_id, amount_paid, payment_date ON payments
+        BEGIN
+            UPDATE balances SET total_paid = total_paid - OLD.amount_paid,
+                                remaining = total_loaned - total_paid + OLD.amount_paid,
+                                payment_count = payment_count - 1
+            WHERE borrower_id = OLD.borrower_id;
+            UPDATE balances SET total_paid = total_paid + NEW.amount_paid,
+                                remaining = total_loaned - total_paid - NEW.amount_paid,
+                                payment_count = payment_count + 1
+            WHERE borrower_id = NEW.borrower_id;
+            UPDATE balances SET last_payment_date = (SELECT MAX(payment_date) FROM payments
+                                                     WHERE borrower_id = balances.borrower_id)
+            WHERE borrower_id IN (OLD.borrower_id, NEW.borrower_id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS balances_payment_delete AFTER DELETE ON payments
+        BEGIN
+            UPDATE balances SET total_paid = total_paid - OLD.amount_paid,
+                                remaining = total_loaned - total_paid + OLD.amount_paid,
+                                payment_count = payment_count - 1,
+                                last_payment_date = (SELECT MAX(payment_date) FROM payments
+                                                     WHERE borrower_id = OLD.borrower_id)
+            WHERE borrower_id = OLD.borrower_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS balances_device_insert AFTER INSERT ON devices
+        BEGIN
+            UPDATE balances SET device_count = device_count + 1,
+                                last_device_date = CASE
+                                    WHEN last_device_date IS NULL OR NEW.device_date > last_device_date
+                                    THEN NEW.device_date ELSE last_device_date END
+            WHERE borrower_id = NEW.borrower_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS balances_device_update AFTER UPDATE OF borrower_id, device_date ON devices
+        BEGIN
+            UPDATE balances SET device_count = (SELECT COUNT(*) FROM devices WHERE borrower_id = balances.borrower_id),
+                                last_device_date = (SELECT MAX(device_date) FROM devices
+                                                    WHERE borrower_id = balances.borrower_id)
+            WHERE borrower_id IN (OLD.borrower_id, NEW.borrower_id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS balances_device_delete AFTER DELETE ON devices
+        BEGIN
+            UPDATE balances SET device_count = device_count - 1,
+                                last_device_date = (SELECT MAX(device_date) FROM devices
+                                                    WHERE borrower_id = OLD.borrower_id)
+            WHERE borrower_id = OLD.borrower_id;
+        END;
+    ''')
+
+    c.execute('DELETE FROM balances')
+    c.execute('INSERT INTO balances (borrower_id, ' + ', '.join(BALANCE_COLUMNS) + ') ' + BALANCES_SELECT_SQL)
+
+def _migration_3_lookup_indexes(c):
+    """ Indexes for per-borrower lookups and case-insensitive name checks """
+    c.execute('CREATE INDEX IF NOT EXISTS idx_payments_borrower_date ON payments (borrower_id, payment_date)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_devices_borrower_date ON devices (borrower_id, device_date)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_borrowers_name ON borrowers (name)')
+
+    # The expression must match the LOWER(TRIM(name)) used by the duplicate-name checks.
+    # It can only be unique when the existing data has no duplicates already.
+    c.execute('SELECT 1 FROM borrowers GROUP BY LOWER(TRIM(name)) HAVING COUNT(*) > 1 LIMIT 1')
+    unique = '' if c.fetchone() else 'UNIQUE '
+    c.execute(f'CREATE {unique}INDEX IF NOT EXISTS idx_borrowers_name_normalized ON borrowers (LOWER(TRIM(name)))')
+
+def _migration_4_shop_summary(c):
+    """ Single-row shop totals, maintained from balances changes in the same transaction """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS shop_summary (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_loans REAL NOT NULL DEFAULT 0,
+            total_paid REAL NOT NULL DEFAULT 0,
+            total_remaining REAL NOT NULL DEFAULT 0,
+            borrower_count INTEGER NOT NULL DEFAULT 0,
+            settled_count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    # Every write reaches balances through its triggers, so summing the balance deltas here
+    # keeps the header totals current for add_loan, add_payment, deletes and edits alike
+    run_script(c, '''
+        CREATE TRIGGER IF NOT EXISTS shop_summary_balance_insert AFTER INSERT ON balances
+        BEGIN
+            UPDATE shop_summary SET total_loans = total_loans + NEW.total_loaned,
+                                    total_paid = total_paid + NEW.total_paid,
+                                    total_remaining = total_remaining + NEW.remaining,
+                                    borrower_count = borrower_count + 1,
+                                    settled_count = settled_count + (NEW.remaining <= 0)
+            WHERE id = 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS shop_summary_balance_update
+        AFTER UPDATE OF total_loaned, total_paid, remaining ON balances
+        BEGIN
+            UPDATE shop_summary SET total_loans = total_loans - OLD.total_loaned + NEW.total_loaned,
+                                    total_paid = total_paid - OLD.total_paid + NEW.total_paid,
+                                    total_remaining = total_remaining - OLD.remaining + NEW.remaining,
+                                    settled_count = settled_count - (OLD.remaining <= 0) + (NEW.remaining <= 0)
+            WHERE id = 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS shop_summary_balance_delete AFTER DELETE ON balances
+        BEGIN
+            UPDATE shop_summary SET total_loans = total_loans - OLD.total_loaned,
+                                    total_paid = total_paid - OLD.total_paid,
+                                    total_remaining = total_remaining - OLD.remaining,
+                                    borrower_count = borrower_count - 1,
+                                    settled_count = settled_count - (OLD.remaining <= 0)
+            WHERE id = 1;
+        END;
+    ''')
+
+    c.execute('DELETE FROM shop_summary')
+    c.execute('INSERT INTO shop_summary (id, ' + ', '.join(SUMMARY_COLUMNS) + ') SELECT 1, * FROM (' + SUMMARY_SELECT_SQL + ')')
+
+def _migration_5_date_indexes(c):
+    """ Date indexes so date-ordered exports and date-range filters need no sort """
+    c.execute('CREATE INDEX IF NOT EXISTS idx_payments_date ON payments (payment_date)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_devices_date ON devices (device_date)')
+
+# Lending and collections per calendar month (YYYY-MM), computed straight from the raw tables
+MONTHLY_SELECT_SQL = '''
+    SELECT month, SUM(lent) AS lent, SUM(loan_count) AS loan_count,
+           SUM(collected) AS collected, SUM(payment_count) AS payment_count
+    FROM (SELECT COALESCE(substr(device_date, 1, 7), '') AS month, COALESCE(device_amount, 0) AS lent,
+                 1 AS loan_count, 0 AS collected, 0 AS payment_count
+          FROM devices
+          UNION ALL
+          SELECT COALESCE(substr(payment_date, 1, 7), ''), 0, 0, amount_paid, 1
+          FROM payments)
+    GROUP BY month
+'''
+
+# The same over the hot tables and the attached archive; archived borrowers still count in past months
+MONTHLY_HISTORY_SELECT_SQL = '''
+    SELECT month, SUM(lent) AS lent, SUM(loan_count) AS loan_count,
+           SUM(collected) AS collected, SUM(payment_count) AS payment_count
+    FROM (SELECT COALESCE(substr(device_date, 1, 7), '') AS month, COALESCE(device_amount, 0) AS lent,
+                 1 AS loan_count, 0 AS collected, 0 AS payment_count
+          FROM (SELECT device_date, device_amount FROM main.devices
+                UNION ALL SELECT device_date, device_amount FROM archive.devices)
+          UNION ALL
+          SELECT COALESCE(substr(payment_date, 1, 7), ''), 0, 0, amount_paid, 1
+          FROM (SELECT payment_date, amount_paid FROM main.payments
+                UNION ALL SELECT payment_date, amount_paid FROM archive.payments))
+    GROUP BY month
+'''
+
+MONTHLY_COLUMNS = ('lent', 'loan_count', 'collected', 'payment_count')
+
+# Outstanding debt grouped by the date its age is counted from: the last payment, or the first
+# loan for borrowers who never paid ('' when there is neither)
+AGING_ANCHOR_SQL = "COALESCE(last_payment_date, first_device_date, '')"
+
+AGING_SELECT_SQL = f'''
+    SELECT {AGING_ANCHOR_SQL} AS anchor_date, COUNT(*) AS borrower_count, SUM(remaining) AS remaining
+    FROM balances WHERE remaining > 0
+    GROUP BY anchor_date
+'''
+
+AGING_COLUMNS = ('borrower_count', 'remaining')
+
+def _migration_6_report_rollups(c):
+    """ Monthly lending/collection totals and outstanding debt per aging date, kept current by triggers """
+    c.execute('ALTER TABLE balances ADD COLUMN first_device_date TEXT')
+    c.execute('''UPDATE balances SET first_device_date = (SELECT MIN(device_date) FROM devices
+                                                          WHERE borrower_id = balances.borrower_id)''')
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS monthly_totals (
+            month TEXT PRIMARY KEY,
+            lent REAL NOT NULL DEFAULT 0,
+            loan_count INTEGER NOT NULL DEFAULT 0,
+            collected REAL NOT NULL DEFAULT 0,
+            payment_count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS aging_rollup (
+            anchor_date TEXT PRIMARY KEY,
+            borrower_count INTEGER NOT NULL DEFAULT 0,
+            remaining REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    # Lists the borrowers behind one aging bucket, oldest debt first
+    c.execute(f'CREATE INDEX IF NOT EXISTS idx_balances_aging ON balances ({AGING_ANCHOR_SQL}) WHERE remaining > 0')
+
+    run_script(c, '''
+        CREATE TRIGGER IF NOT EXISTS balances_first_device_insert AFTER INSERT ON devices
+        BEGIN
+            UPDATE balances SET first_device_date = NEW.device_date
+            WHERE borrower_id = NEW.borrower_id
+              AND (first_device_date IS NULL OR NEW.device_date < first_device_date);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS balances_first_device_update AFTER UPDATE OF borrower_id, device_date ON devices
+        BEGIN
+            UPDATE balances SET first_device_date = (SELECT MIN(device_date) FROM devices
+                                                     WHERE borrower_id = balances.borrower_id)
+            WHERE borrower_id IN (OLD.borrower_id, NEW.borrower_id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS balances_first_device_delete AFTER DELETE ON devices
+        BEGIN
+            UPDATE balances SET first_device_date = (SELECT MIN(device_date) FROM devices
+                                                     WHERE borrower_id = OLD.borrower_id)
+            WHERE borrower_id = OLD.borrower_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS monthly_device_insert AFTER INSERT ON devices
+        BEGIN
+            INSERT INTO monthly_totals (month, lent, loan_count)
+            VALUES (COALESCE(substr(NEW.device_date, 1, 7), ''), COALESCE(NEW.device_amount, 0), 1)
+            ON CONFLICT (month) DO UPDATE SET lent = lent + excluded.lent, loan_count = loan_count + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS monthly_device_update AFTER UPDATE OF device_date, device_amount ON devices
+        BEGIN
+            UPDATE monthly_totals SET lent = lent - COALESCE(OLD.device_amount, 0), loan_count = loan_count - 1
+            WHERE month = COALESCE(substr(OLD.device_date, 1, 7), '');
+            INSERT INTO monthly_totals (month, lent, loan_count)
+            VALUES (COALESCE(substr(NEW.device_date, 1, 7), ''), COALESCE(NEW.device_amount, 0), 1)
+            ON CONFLICT (month) DO UPDATE SET lent = lent + excluded.lent, loan_count = loan_count + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS monthly_device_delete AFTER DELETE ON devices
+        BEGIN
+            UPDATE monthly_totals SET lent = lent - COALESCE(OLD.device_amount, 0), loan_count = loan_count - 1
+            WHERE month = COALESCE(substr(OLD.device_date, 1, 7), '');
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS monthly_payment_insert AFTER INSERT ON payments
+        BEGIN
+            INSERT INTO monthly_totals (month, collected, payment_count)
+            VALUES (COALESCE(substr(NEW.payment_date, 1, 7), ''), NEW.amount_paid, 1)
+            ON CONFLICT (month) DO UPDATE SET collected = collected + excluded.collected,
+                                              payment_count = payment_count + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS monthly_payment_update AFTER UPDATE OF payment_date, amount_paid ON payments
+        BEGIN
+            UPDATE monthly_totals SET collected = collected - OLD.amount_paid, payment_count = payment_count - 1
+            WHERE month = COALESCE(substr(OLD.payment_date, 1, 7), '');
+            INSERT INTO monthly_totals (month, collected, payment_count)
+            VALUES (COALESCE(substr(NEW.payment_date, 1, 7), ''), NEW.amount_paid, 1)
+            ON CONFLICT (month) DO UPDATE SET collected = collected + excluded.collected,
+                                              payment_count = payment_count + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS monthly_payment_delete AFTER DELETE ON payments
+        BEGIN
+            UPDATE monthly_totals SET collected = collected - OLD.amount_paid, payment_count = payment_count - 1
+            WHERE month = COALESCE(substr(OLD.payment_date, 1, 7), '');
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS aging_balance_insert AFTER INSERT ON balances WHEN NEW.remaining > 0
+        BEGIN
+            INSERT INTO aging_rollup (anchor_date, borrower_count, remaining)
+            VALUES (COALESCE(NEW.last_payment_date, NEW.first_device_date, ''), 1, NEW.remaining)
+            ON CONFLICT (anchor_date) DO UPDATE SET borrower_count = borrower_count + 1,
+                                                    remaining = remaining + excluded.remaining;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS aging_balance_update
+        AFTER UPDATE OF remaining, last_payment_date, first_device_date ON balances
+        BEGIN
+            UPDATE aging_rollup SET borrower_count = borrower_count - 1, remaining = remaining - OLD.remaining
+            WHERE OLD.remaining > 0 AND anchor_date = COALESCE(OLD.last_payment_date, OLD.first_device_date, '');
+            INSERT INTO aging_rollup (anchor_date, borrower_count, remaining)
+            SELECT COALESCE(NEW.last_payment_date, NEW.first_device_date, ''), 1, NEW.remaining
+            WHERE NEW.remaining > 0
+            ON CONFLICT (anchor_date) DO UPDATE SET borrower_count = borrower_count + 1,
+                                                    remaining = remaining + excluded.remaining;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS aging_balance_delete AFTER DELETE ON balances WHEN OLD.remaining > 0
+        BEGIN
+            UPDATE aging_rollup SET borrower_count = borrower_count - 1, remaining = remaining - OLD.remaining
+            WHERE anchor_date = COALESCE(OLD.last_payment_date, OLD.first_device_date, '');
+        END;
+    ''')
+
+    c.execute('DELETE FROM monthly_totals')
+    c.execute('INSERT INTO monthly_totals (month, ' + ', '.join(MONTHLY_COLUMNS) + ') ' + MONTHLY_SELECT_SQL)
+    c.execute('DELETE FROM aging_rollup')
+    c.execute('INSERT INTO aging_rollup (anchor_date, ' + ', '.join(AGING_COLUMNS) + ') ' + AGING_SELECT_SQL)
+
+# Arabic spelling variants folded together before text is indexed or searched: diacritics and
+# tatweel are dropped, hamza and alef forms collapse, and Arabic-Indic digits become ASCII
+ARABIC_FOLDING = (
+    [(chr(c), '') for c in range(0x064B, 0x0653)] + [('\u0670', ''), ('\u0640', '')]
+    + [('أ', 'ا'), ('إ', 'ا'), ('آ', 'ا'), ('ٱ', 'ا'), ('ى', 'ي'), ('ئ', 'ي'), ('ؤ', 'و'), ('ة', 'ه')]
+    + [(chr(0x0660 + d), str(d)) for d in range(10)] + [(chr(0x06F0 + d), str(d)) for d in range(10)]
+)
+_ARABIC_FOLD_TABLE = str.maketrans({source: target for source, target in ARABIC_FOLDING})
+
+def fold_text(text):
+    """ Python counterpart of fold_sql(), applied to search queries """
+    return (text or '').translate(_ARABIC_FOLD_TABLE).lower()
+
+def fold_sql(expression, chunk=16):
+    """ SQL expression folding expression like fold_text(), for use inside triggers """
+    # Deeply nested REPLACE() calls overflow SQLite's parser stack, so every chunk of
+    # replacements is applied in its own scalar subquery
+    folded = f"COALESCE({expression}, '')"
+    for start in range(0, len(ARABIC_FOLDING), chunk):
+        step = 'f'
+        for source, target in ARABIC_FOLDING[start:start + chunk]:
+            step = f"REPLACE({step}, '{source}', '{target}')"
+        folded = f'(SELECT {step} FROM (SELECT {folded} AS f))'
+    return f'LOWER({folded})'
+
+def fold_phone_sql(expression):
+    """ Phone numbers are indexed without spaces and dashes so any fragment of the digits matches """
+    return f"REPLACE(REPLACE({fold_sql(expression)}, ' ', ''), '-', '')"
+
+# One search document per borrower, device and payment. Rowids encode the source row as
+# id * 4 + kind so triggers can replace a document without scanning the index.
+SEARCH_KIND_BORROWER, SEARCH_KIND_DEVICE, SEARCH_KIND_PAYMENT = 0, 1, 2
+
+SEARCH_POPULATE_SQL = (
+    f'''INSERT INTO borrower_search (rowid, name, number_phone, notes, item, borrower_id)
+        SELECT id * 4, {fold_sql('name')}, {fold_phone_sql('number_phone')}, {fold_sql('notes')}, '', id
+        FROM borrowers''',
+    f'''INSERT INTO borrower_search (rowid, name, number_phone, notes, item, borrower_id)
+        SELECT id * 4 + 1, '', '', '', {fold_sql('device_description')}, borrower_id
+        FROM devices WHERE device_description != ''
+    ''',
+    f'''INSERT INTO borrower_search (rowid, name, number_phone, notes, item, borrower_id)
+        SELECT id * 4 + 2, '', '', '', {fold_sql('device_description')}, borrower_id
+        FROM payments WHERE device_description != ''
+    ''',
+)
+
+def _migration_7_search_index(c):
+    """ FTS5 index over borrower names, phones, notes and device descriptions, kept in sync by triggers """
+    # The trigram tokenizer matches any fragment of three or more characters, which suits Arabic
+    # names written with or without the article and phone numbers searched by their last digits.
+    # Older SQLite builds fall back to word tokens matched by prefix.
+    try:
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS borrower_search
+                     USING fts5(name, number_phone, notes, item, borrower_id UNINDEXED, tokenize = 'trigram')''')
+    except sqlite3.OperationalError:
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS borrower_search
+                     USING fts5(name, number_phone, notes, item, borrower_id UNINDEXED,
+                                tokenize = 'unicode61 remove_diacritics 2')''')
+
+    run_script(c, f'''
+        CREATE TRIGGER IF NOT EXISTS search_borrower_insert AFTER INSERT ON borrowers
+        BEGIN
+            INSERT INTO borrower_search (rowid, name, number_phone, notes, item, borrower_id)
+            VALUES (NEW.id * 4, {fold_sql('NEW.name')}, {fold_phone_sql('NEW.number_phone')},
+                    {fold_sql('NEW.notes')}, '', NEW.id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS search_borrower_update AFTER UPDATE OF name, number_phone, notes ON borrowers
+        BEGIN
+            UPDATE borrower_search SET name = {fold_sql('NEW.name')},
+                                       number_phone = {fold_phone_sql('NEW.number_phone')},
+                                       notes = {fold_sql('NEW.notes')}
+            WHERE rowid = NEW.id * 4;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS search_borrower_delete AFTER DELETE ON borrowers
+        BEGIN
+            DELETE FROM borrower_search WHERE rowid = OLD.id * 4;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS search_device_insert AFTER INSERT ON devices
+        WHEN NEW.device_description != ''
+        BEGIN
+            INSERT INTO borrower_search (rowid, name, number_phone, notes, item, borrower_id)
+            VALUES (NEW.id * 4 + 1, '', '', '', {fold_sql('NEW.device_description')}, NEW.borrower_id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS search_device_update AFTER UPDATE OF borrower_id, device_description ON devices
+        BEGIN
+            DELETE FROM borrower_search WHERE rowid = OLD.id * 4 + 1;
+            INSERT INTO borrower_search (rowid, name, number_phone, notes, item, borrower_id)
+            SELECT NEW.id * 4 + 1, '', '', '', {fold_sql('NEW.device_description')}, NEW.borrower_id
+            WHERE NEW.device_description != '';
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS search_device_delete AFTER DELETE ON devices
+        BEGIN
+            DELETE FROM borrower_search WHERE rowid = OLD.id * 4 + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS search_payment_insert AFTER INSERT ON payments
+        WHEN NEW.device_description != ''
+        BEGIN
+            INSERT INTO borrower_search (rowid, name, number_phone, notes, item, borrower_id)
+            VALUES (NEW.id * 4 + 2, '', '', '', {fold_sql('NEW.device_description')}, NEW.borrower_id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS search_payment_update AFTER UPDATE OF borrower_id, device_description ON payments
+        BEGIN
+            DELETE FROM borrower_search WHERE rowid = OLD.id * 4 + 2;
+            INSERT INTO borrower_search (rowid, name, number_phone, notes, item, borrower_id)
+            SELECT NEW.id * 4 + 2, '', '', '', {fold_sql('NEW.device_description')}, NEW.borrower_id
+            WHERE NEW.device_description != '';
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS search_payment_delete AFTER DELETE ON payments
+        BEGIN
+            DELETE FROM borrower_search WHERE rowid = OLD.id * 4 + 2;
+        END;
+    ''')
+
+    c.execute('DELETE FROM borrower_search')
+    for sql in SEARCH_POPULATE_SQL:
+        c.execute(sql)
+
+# While a transaction holds the 'moving_history' flag, rows moved between the hot tables and the
+# archive leave the monthly totals alone: archiving a borrower does not rewrite past months
+MOVING_HISTORY_SQL = "NOT EXISTS (SELECT 1 FROM sync_flags WHERE name = 'moving_history')"
+
+def _migration_8_archive_flags(c):
+    """ Flags set inside a transaction to tell triggers why rows are written, and monthly
+    triggers that skip rows moved to or from the archive """
+    c.execute('CREATE TABLE IF NOT EXISTS sync_flags (name TEXT PRIMARY KEY)')
+    for name in ('monthly_device_insert', 'monthly_device_delete', 'monthly_payment_insert', 'monthly_payment_delete'):
+        c.execute(f'DROP TRIGGER IF EXISTS {name}')
+
+    run_script(c, f'''
+        CREATE TRIGGER monthly_device_insert AFTER INSERT ON devices WHEN {MOVING_HISTORY_SQL}
+        BEGIN
+            INSERT INTO monthly_totals (month, lent, loan_count)
+            VALUES (COALESCE(substr(NEW.device_date, 1, 7), ''), COALESCE(NEW.device_amount, 0), 1)
+            ON CONFLICT (month) DO UPDATE SET lent = lent + excluded.lent, loan_count = loan_count + 1;
+        END;
+
+        CREATE TRIGGER monthly_device_delete AFTER DELETE ON devices WHEN {MOVING_HISTORY_SQL}
+        BEGIN
+            UPDATE monthly_totals SET lent = lent - COALESCE(OLD.device_amount, 0), loan_count = loan_count - 1
+            WHERE month = COALESCE(substr(OLD.device_date, 1, 7), '');
+        END;
+
+        CREATE TRIGGER monthly_payment_insert AFTER INSERT ON payments WHEN {MOVING_HISTORY_SQL}
+        BEGIN
+            INSERT INTO monthly_totals (month, collected, payment_count)
+            VALUES (COALESCE(substr(NEW.payment_date, 1, 7), ''), NEW.amount_paid, 1)
+            ON CONFLICT (month) DO UPDATE SET collected = collected + excluded.collected,
+                                              payment_count = payment_count + 1;
+        END;
+
+        CREATE TRIGGER monthly_payment_delete AFTER DELETE ON payments WHEN {MOVING_HISTORY_SQL}
+        BEGIN
+            UPDATE monthly_totals SET collected = collected - OLD.amount_paid, payment_count = payment_count - 1
+            WHERE month = COALESCE(substr(OLD.payment_date, 1, 7), '');
+        END;
+    ''')
+
+# A borrower's latest activity: the newer of the last payment and the last loan ('' when neither)
+ACTIVITY_SQL = "MAX(COALESCE(last_payment_date, ''), COALESCE(last_device_date, ''))"
+
+def _migration_9_dashboard_indexes(c):
+    """ Indexes the paginated dashboard sorts by, so a page is read in order without a sort """
+    c.execute('CREATE INDEX IF NOT EXISTS idx_balances_remaining ON balances (remaining)')
+    c.execute(f'CREATE INDEX IF NOT EXISTS idx_balances_activity ON balances ({ACTIVITY_SQL})')
+
+def _migration_10_jobs(c):
+    """ Persistent queue of background jobs, with progress, retries and cancellation """
+    # AUTOINCREMENT so pruning the newest rows never hands their ids (and export file names) to new jobs
+    run_script(c, '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            params TEXT NOT NULL DEFAULT '{}',
+            priority INTEGER NOT NULL DEFAULT 0,
+            state TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            progress REAL NOT NULL DEFAULT 0,
+            message TEXT,
+            result TEXT,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            run_after TEXT NOT NULL,
+            started_at TEXT,
+            finished_at TEXT
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_jobs_queued ON jobs (priority DESC, run_after, id) WHERE state = 'queued';
+        CREATE INDEX IF NOT EXISTS idx_jobs_finished ON jobs (finished_at) WHERE finished_at IS NOT NULL;
+    ''')
+
+def _migration_11_data_changes(c):
+    """ Log of changed borrowers, so a server sees writes made by other processes (flask CLI commands) """
+    # names is 1 when the borrower's name may have changed; a NULL borrower_id means everything did.
+    # AUTOINCREMENT so pruning never lets an id a reader has already seen come back.
+    run_script(c, '''
+        CREATE TABLE IF NOT EXISTS data_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            borrower_id INTEGER,
+            names INTEGER NOT NULL DEFAULT 0
+        );
+
+        CREATE TRIGGER IF NOT EXISTS data_changes_borrower_insert AFTER INSERT ON borrowers
+        BEGIN
+            INSERT INTO data_changes (borrower_id, names) VALUES (NEW.id, 1);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS data_changes_borrower_update AFTER UPDATE ON borrowers
+        BEGIN
+            INSERT INTO data_changes (borrower_id, names) VALUES (NEW.id, OLD.name IS NOT NEW.name);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS data_changes_borrower_delete AFTER DELETE ON borrowers
+        BEGIN
+            INSERT INTO data_changes (borrower_id, names) VALUES (OLD.id, 1);
+        END;
+    ''')
+    for table in ('payments', 'devices'):
+        run_script(c, f'''
+            CREATE TRIGGER IF NOT EXISTS data_changes_{table}_insert AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO data_changes (borrower_id) VALUES (NEW.borrower_id);
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS data_changes_{table}_update AFTER UPDATE ON {table}
+            BEGIN
+                INSERT INTO data_changes (borrower_id) SELECT NEW.borrower_id UNION SELECT OLD.borrower_id;
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS data_changes_{table}_delete AFTER DELETE ON {table}
+            BEGIN
+                INSERT INTO data_changes (borrower_id) VALUES (OLD.borrower_id);
+            END;
+        ''')
+
+# Numbered schema upgrades. The version applied last is stored in PRAGMA user_version,
+# so new tables and indexes ship by appending a step here - never edit an applied one.
+MIGRATIONS = [
+    (1, _migration_1_base_schema),
+    (2, _migration_2_balances),
+    (3, _migration_3_lookup_indexes),
+    (4, _migration_4_shop_summary),
+    (5, _migration_5_date_indexes),
+    (6, _migration_6_report_rollups),
+    (7, _migration_7_search_index),
+    (8, _migration_8_archive_flags),
+    (9, _migration_9_dashboard_indexes),
+    (10, _migration_10_jobs),
+    (11, _migration_11_data_changes),
+]
+
+def init_db(db_path):
+    """ Bring the database schema up to date by applying pending migrations """
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    c = conn.cursor()
+    try:
+        current_version = c.execute('PRAGMA user_version').fetchone()[0]
+        if current_version == 0:
+            # Only takes effect before the first table exists; lets archiving hand freed pages back
+            c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        for version, migrate in MIGRATIONS:
+            if version <= current_version:
+                continue
+            # Each step runs in its own transaction together with the version bump
+            c.execute('BEGIN IMMEDIATE')
+            try:
+                migrate(c)
+                c.execute(f'PRAGMA user_version = {int(version)}')
+                c.execute('COMMIT')
+            except Exception:
+                c.execute('ROLLBACK')
+                raise
+    finally:
+        conn.close()
+    init_archive(get_archive_path(db_path))
+
+# Columns copied between the hot tables and the archive database
+ARCHIVE_COLUMNS = {
+    'borrowers': ('id', 'name', 'number_phone', 'total_amount', 'notes'),
+    'devices': ('id', 'borrower_id', 'device_description', 'device_image', 'device_date', 'device_amount'),
+    'payments': ('id', 'borrower_id', 'amount_paid', 'payment_date', 'device_description', 'device_image'),
+}
+
+def init_archive(archive_path):
+    """ Create the archive database of settled borrowers: the same three tables, the date each
+    borrower was archived, and a search index of its own """
+    conn = sqlite3.connect(archive_path, isolation_level=None)
+    c = conn.cursor()
+    try:
+        if c.execute('PRAGMA user_version').fetchone()[0] >= 1:
+            return
+        c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        c.execute('PRAGMA journal_mode = WAL')
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            run_script(c, '''
+                CREATE TABLE IF NOT EXISTS borrowers (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    number_phone TEXT NOT NULL,
+                    total_amount REAL NOT NULL,
+                    notes TEXT,
+                    archived_at TEXT NOT NULL
+                );
+
+                CREATE TABLE IF NOT EXISTS payments (
+                    id INTEGER PRIMARY KEY,
+                    borrower_id INTEGER NOT NULL,
+                    amount_paid REAL NOT NULL,
+                    payment_date TEXT NOT NULL,
+                    device_description TEXT,
+                    device_image TEXT
+                );
+
+                CREATE TABLE IF NOT EXISTS devices (
+                    id INTEGER PRIMARY KEY,
+                    borrower_id INTEGER NOT NULL,
+                    device_description TEXT,
+                    device_image TEXT,
+                    device_date TEXT,
+                    device_amount REAL
+                );
+
+                CREATE INDEX IF NOT EXISTS idx_payments_borrower_date ON payments (borrower_id, payment_date);
+                CREATE INDEX IF NOT EXISTS idx_devices_borrower_date ON devices (borrower_id, device_date);
+            ''')
+            # Same layout and tokenizer choice as the main borrower_search index
+            try:
+                c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS borrower_search
+                             USING fts5(name, number_phone, notes, item, borrower_id UNINDEXED, tokenize = 'trigram')''')
+            except sqlite3.OperationalError:
+                c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS borrower_search
+                             USING fts5(name, number_phone, notes, item, borrower_id UNINDEXED,
+                                        tokenize = 'unicode61 remove_diacritics 2')''')
+            c.execute('PRAGMA user_version = 1')
+            c.execute('COMMIT')
+        except Exception:
+            c.execute('ROLLBACK')
+            raise
+    finally:
+        conn.close()
 
 def get_db_path():
     """ Get database path that works in both development and PyInstaller environments """
@@ -85,25 +839,95 @@ def get_db_path():
     if hasattr(sys, '_MEIPASS'):
         # Running from PyInstaller exe - use user-writable AppData directory
         appdata_dir = os.path.join(os.environ.get('APPDATA', ''), 'LoanManagementSystem')
-        if not os.path.exists(appdata_dir):
-            os.makedirs(appdata_dir)
-        db_path = os.path.join(appdata_dir, 'users.db')
+        return os.path.join(appdata_dir, 'users.db')
+    else:
+        # Development mode - use current directory
+        return os.path.join(os.path.abspath("."), 'users.db')
 
-        # If database doesn't exist, copy from bundled resources
+def get_archive_path(db_path):
+    """ The archive of settled borrowers lives next to the main database """
+    return os.path.splitext(db_path)[0] + '-archive.db'
+
+def prepare_database(db_path):
+    """ On the first run of the packaged app, copy the bundled database into place """
+    if hasattr(sys, '_MEIPASS') and not os.path.exists(db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
         bundled_db = resource_path('users.db')
-        if os.path.exists(bundled_db) and not os.path.exists(db_path):
-            import shutil
+        if os.path.exists(bundled_db):
             shutil.copy2(bundled_db, db_path)
 
-        # Initialize database tables if missing
-        init_db(db_path)
+class BootSequence:
+    """ Measured start-up. Importing the module only records paths; the database is copied and
+    migrated on first use, and housekeeping runs on a background thread once the server is up. """
 
-        return db_path
-    else:
-        # Development mode - use current directory
-        db_path = os.path.join(os.path.abspath("."), 'users.db')
-        init_db(db_path)
-        return db_path
+    def __init__(self):
+        self.phases = []    # (name, seconds, deferred)
+        self._lock = threading.Lock()
+        self._database_ready = False
+        self._deferred = None
+
+    def record(self, name, seconds, deferred=False):
+        self.phases.append((name, seconds, deferred))
+
+    @contextmanager
+    def phase(self, name, deferred=False):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started, deferred)
+
+    def ensure_database(self):
+        """ Copy and migrate the database once; every other caller waits until it is ready """
+        if self._database_ready:
+            return
+        with self._lock:
+            if self._database_ready:
+                return
+            with self.phase('database copy'):
+                prepare_database(app.config['DATABASE'])
+            with self.phase('database migrations'):
+                init_db(app.config['DATABASE'])
+            self._database_ready = True
+
+    def run_deferred(self):
+        """ Work that no request waits for: upload folder, integrity check, thumbnails, name index, job workers,
+        change watcher """
+        deferred = (
+            ('database', self.ensure_database),
+            ('upload folder', lambda: os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)),
+            ('integrity check', check_integrity),
+            ('upload scan', scan_uploads),
+            ('name index', name_index.warm),
+            ('job runner', job_runner.start),
+            ('change watcher', change_watcher.start),
+        )
+        for name, step in deferred:
+            try:
+                with self.phase(name, deferred=True):
+                    step()
+            except Exception as e:
+                app.logger.error('Start-up step %s failed: %s', name, e)
+
+    def start_deferred(self):
+        """ Run the deferred steps (which start the job workers) on a daemon thread, once,
+        and start the backup schedule """
+        if self._deferred is None:
+            self._deferred = threading.Thread(target=self.run_deferred, name='boot', daemon=True)
+            self._deferred.start()
+            backup_scheduler.start()
+        return self._deferred
+
+    def report(self):
+        lines = []
+        for name, seconds, deferred in self.phases:
+            lines.append(f"{name:24s} {seconds * 1000:9.1f} ms{'  (deferred)' if deferred else ''}")
+        critical = sum(seconds for _, seconds, deferred in self.phases if not deferred)
+        lines.append(f"{'critical path':24s} {critical * 1000:9.1f} ms")
+        return lines
+
+boot = BootSequence()
+boot.record('imports', _IMPORTS_DONE - _IMPORT_STARTED)
 
 app = Flask(__name__,
             template_folder=resource_path('templates'),
@@ -127,21 +951,1945 @@ def get_upload_folder():
         # Running from PyInstaller exe - use user-writable directory
         # Use AppData directory which is always writable for users
         appdata_dir = os.path.join(os.environ.get('APPDATA', ''), 'LoanManagementSystem')
-        upload_dir = os.path.join(appdata_dir, 'uploads')
-
-        if not os.path.exists(upload_dir):
-            os.makedirs(upload_dir)
-
-        return upload_dir
+        return os.path.join(appdata_dir, 'uploads')
     else:
         # Development mode - use current directory
-        upload_dir = 'static/uploads'
-        if not os.path.exists(upload_dir):
-            os.makedirs(upload_dir)
-        return upload_dir
+        return 'static/uploads'
 
+# Both paths are only resolved here; the boot sequence creates, copies and migrates them
 UPLOAD_FOLDER = get_upload_folder()
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['DATABASE'] = get_db_path()
+
+# Maximum number of open connections; 0 opens a fresh connection per request
+app.config['DB_POOL_SIZE'] = 8
+# Seconds to wait for a free pooled connection or a database lock
+app.config['DB_TIMEOUT'] = 10.0
+
+# PRAGMAs applied once when a pooled connection is opened
+CONNECTION_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -16000),      # negative means KiB, so ~16 MB of page cache
+    ('mmap_size', 134217728),    # 128 MB memory-mapped reads
+    ('temp_store', 'MEMORY'),
+    ('foreign_keys', 'ON'),
+)
+
+# SQL instrumentation: every pooled connection times its statements and counts the rows they return.
+# Statements run while a request is being handled are collected into that request's QueryStats.
+_sql_collector = threading.local()
+
+class QueryStats:
+    """ Statements run while handling one request """
+
+    def __init__(self):
+        self.statements = []    # [sql, seconds, rows], updated while the cursor is fetched
+
+    def record(self, sql):
+        entry = [sql, 0.0, 0]
+        self.statements.append(entry)
+        return entry
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    @property
+    def seconds(self):
+        return sum(entry[1] for entry in self.statements)
+
+    @property
+    def rows(self):
+        return sum(entry[2] for entry in self.statements)
+
+    def slowest(self, n=5):
+        return sorted(self.statements, key=lambda entry: entry[1], reverse=True)[:n]
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """ Cursor that charges execution and fetch time and fetched rows to the current request """
+    _entry = None
+
+    def _start(self, sql):
+        stats = getattr(_sql_collector, 'stats', None)
+        self._entry = stats.record(sql) if stats is not None else None
+
+    def _charge(self, started, rows=0):
+        if self._entry is not None:
+            self._entry[1] += time.perf_counter() - started
+            self._entry[2] += rows
+
+    def execute(self, sql, parameters=()):
+        self._start(sql)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._charge(started)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._start(sql)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._charge(started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._charge(started, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._charge(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._charge(started, len(rows))
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._charge(started)
+            raise
+        self._charge(started, 1)
+        return row
+
+class InstrumentedConnection(sqlite3.Connection):
+    """ Connection whose cursors, including the ones behind conn.execute(), are instrumented """
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+class ConnectionPool:
+    """ Bounded, thread-safe pool of SQLite connections """
+
+    def __init__(self, db_path, max_size=8, timeout=10.0, archive_path=None):
+        self.db_path = db_path
+        self.archive_path = archive_path
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size) if max_size > 0 else None
+
+    def connect(self):
+        """ Open a new connection with the row factory and PRAGMAs applied """
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False,
+                               factory=InstrumentedConnection)
+        conn.row_factory = sqlite3.Row
+        for name, value in CONNECTION_PRAGMAS:
+            conn.execute(f'PRAGMA {name} = {value}')
+        if self.archive_path:
+            conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+        return conn
+
+    def acquire(self):
+        """ Borrow a connection, reusing an idle one when possible """
+        if self._slots is None:
+            return self.connect()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError('timed out waiting for a database connection')
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                return self.connect()
+            except Exception:
+                self._slots.release()
+                raise
+
+    def release(self, conn):
+        """ Return a connection, discarding any work that was not committed """
+        if self._slots is None:
+            conn.close()
+            return
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+        except sqlite3.Error:
+            conn.close()
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        """ Close every idle connection """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """ Return the application's connection pool, creating it on first use """
+    pool = app.extensions.get('db_pool')
+    if pool is None:
+        boot.ensure_database()
+        with _pool_lock:
+            pool = app.extensions.get('db_pool')
+            if pool is None:
+                pool = ConnectionPool(app.config['DATABASE'],
+                                      max_size=app.config['DB_POOL_SIZE'],
+                                      timeout=app.config['DB_TIMEOUT'],
+                                      archive_path=get_archive_path(app.config['DATABASE']))
+                app.extensions['db_pool'] = pool
+    return pool
+
+def get_db():
+    """ Return the connection bound to the current app context """
+    if 'db' not in g:
+        g.db = get_pool().acquire()
+    return g.db
+
+@app.teardown_appcontext
+def close_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        get_pool().release(conn)
+
+# Attempts at taking the write lock before giving up (each already waits DB_TIMEOUT for a busy database)
+app.config['DB_WRITE_RETRIES'] = 5
+
+@contextmanager
+def write_transaction(conn=None):
+    """ Run a block as one BEGIN IMMEDIATE transaction, committed on success and rolled back on error.
+    The write lock is taken before the block reads anything, so read-check-write sequences such as
+    the overpayment check cannot interleave with another cashier's write. """
+    conn = conn if conn is not None else get_db()
+    if conn.in_transaction:
+        # Already inside a write transaction, the outer block commits
+        yield conn
+        return
+
+    delay = 0.02
+    for attempt in range(app.config['DB_WRITE_RETRIES']):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            break
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) and 'busy' not in str(e) or attempt == app.config['DB_WRITE_RETRIES'] - 1:
+                raise
+            time.sleep(delay * (1 + random.random()))
+            delay *= 2
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+def verify_balances(conn, tolerance=0.005):
+    """ Compare the balances table with a fresh computation and return every drifted value """
+    expected = {row['borrower_id']: row for row in conn.execute(BALANCES_SELECT_SQL)}
+    stored = {row['borrower_id']: row for row in conn.execute('SELECT * FROM balances')}
+
+    drift = []
+    for borrower_id in sorted(expected.keys() | stored.keys()):
+        want = expected.get(borrower_id)
+        have = stored.get(borrower_id)
+        if want is None or have is None:
+            drift.append({'borrower_id': borrower_id, 'column': 'row',
+                          'stored': have is not None, 'expected': want is not None})
+            continue
+        for column in BALANCE_COLUMNS:
+            a, b = have[column], want[column]
+            if isinstance(a, float) or isinstance(b, float):
+                same = a is not None and b is not None and abs(a - b) <= tolerance
+            else:
+                same = a == b
+            if not same:
+                drift.append({'borrower_id': borrower_id, 'column': column, 'stored': a, 'expected': b})
+    return drift
+
+def rebuild_balances(conn):
+    """ Recompute the balances table from scratch """
+    conn.execute('DELETE FROM balances')
+    conn.execute('INSERT INTO balances (borrower_id, ' + ', '.join(BALANCE_COLUMNS) + ') ' + BALANCES_SELECT_SQL)
+    conn.execute('''UPDATE balances SET first_device_date = (SELECT MIN(device_date) FROM devices
+                                                             WHERE borrower_id = balances.borrower_id)''')
+    conn.commit()
+
+# Hot queries and the index EXPLAIN QUERY PLAN must report for each of them
+QUERY_PLAN_CHECKS = (
+    ('SELECT id FROM borrowers WHERE LOWER(TRIM(name)) = LOWER(TRIM(?))', ('',),
+     'idx_borrowers_name_normalized'),
+    ('SELECT id FROM borrowers WHERE LOWER(TRIM(name)) = LOWER(TRIM(?)) AND id != ?', ('', 0),
+     'idx_borrowers_name_normalized'),
+    ('SELECT b.id, bal.remaining FROM borrowers b JOIN balances bal ON bal.borrower_id = b.id WHERE b.name = ?', ('',),
+     'idx_borrowers_name'),
+    ('SELECT * FROM payments WHERE borrower_id = ? ORDER BY payment_date ASC', (0,),
+     'idx_payments_borrower_date'),
+    ('SELECT * FROM devices WHERE borrower_id = ? ORDER BY device_date DESC', (0,),
+     'idx_devices_borrower_date'),
+    ('SELECT * FROM devices WHERE borrower_id = ? ORDER BY device_date DESC LIMIT 1', (0,),
+     'idx_devices_borrower_date'),
+    ('SELECT MAX(payment_date) FROM payments WHERE borrower_id = ?', (0,),
+     'idx_payments_borrower_date'),
+    ('SELECT * FROM payments ORDER BY payment_date, id', (),
+     'idx_payments_date'),
+    ('SELECT * FROM devices ORDER BY device_date, id', (),
+     'idx_devices_date'),
+    (f'SELECT borrower_id FROM balances WHERE remaining > 0 AND {AGING_ANCHOR_SQL} <= ? '
+     f'ORDER BY {AGING_ANCHOR_SQL} LIMIT 100', ('',),
+     'idx_balances_aging'),
+    ('SELECT b.id FROM borrowers b JOIN balances bal ON bal.borrower_id = b.id WHERE +bal.remaining > 0 '
+     'ORDER BY bal.remaining DESC, bal.borrower_id DESC LIMIT 50', (),
+     'idx_balances_remaining'),
+    (f'SELECT b.id FROM borrowers b JOIN balances bal ON bal.borrower_id = b.id WHERE +bal.remaining > 0 '
+     f'ORDER BY {ACTIVITY_SQL} DESC, bal.borrower_id DESC LIMIT 50', (),
+     'idx_balances_activity'),
+    ("SELECT id FROM jobs WHERE state = 'queued' AND run_after <= ? ORDER BY priority DESC, run_after, id LIMIT 1",
+     ('',), 'idx_jobs_queued'),
+)
+
+def check_query_plans(conn):
+    """ Return (sql, plan) for every hot query whose plan no longer uses its index """
+    failures = []
+    for sql, params, index in QUERY_PLAN_CHECKS:
+        plan = ' | '.join(row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params))
+        if index not in plan:
+            failures.append((sql, plan))
+    return failures
+
+def check_integrity():
+    """ Run PRAGMA quick_check on its own connection; problems are logged and returned, not raised """
+    conn = get_pool().connect()
+    try:
+        result = [row[0] for row in conn.execute('PRAGMA quick_check')]
+    finally:
+        conn.close()
+    if result != ['ok']:
+        app.logger.error('Database integrity check failed: %s', '; '.join(result[:10]))
+    return result
+
+@app.cli.group()
+def schema():
+    """ Inspect the database schema """
+
+@schema.command('version')
+def schema_version():
+    """ Show the applied migration version """
+    version = get_db().execute('PRAGMA user_version').fetchone()[0]
+    click.echo(f'schema version {version} (latest {MIGRATIONS[-1][0]})')
+
+@schema.command('plans')
+def schema_plans():
+    """ Check that the hot queries still use their indexes """
+    # A fresh connection: a pooled one may reuse a cached EXPLAIN planned before an index changed
+    conn = get_pool().connect()
+    try:
+        failures = check_query_plans(conn)
+    finally:
+        conn.close()
+    for sql, plan in failures:
+        click.echo(f'{sql}\n    -> {plan}')
+    click.echo(f'{len(QUERY_PLAN_CHECKS) - len(failures)}/{len(QUERY_PLAN_CHECKS)} query plans use their index')
+    if failures:
+        sys.exit(1)
+
+def verify_summary(conn, tolerance=0.005):
+    """ Compare the shop_summary row with totals recomputed from the raw tables """
+    expected = conn.execute(SUMMARY_SELECT_SQL).fetchone()
+    stored = conn.execute('SELECT * FROM shop_summary WHERE id = 1').fetchone()
+    if stored is None:
+        return [{'column': 'row', 'stored': None, 'expected': dict(expected)}]
+
+    drift = []
+    for column in SUMMARY_COLUMNS:
+        if abs(stored[column] - expected[column]) > tolerance:
+            drift.append({'column': column, 'stored': stored[column], 'expected': expected[column]})
+    return drift
+
+def rebuild_summary(conn):
+    """ Recompute the shop_summary row from scratch """
+    conn.execute('DELETE FROM shop_summary')
+    conn.execute('INSERT INTO shop_summary (id, ' + ', '.join(SUMMARY_COLUMNS) + ') SELECT 1, * FROM (' + SUMMARY_SELECT_SQL + ')')
+    conn.commit()
+
+@app.cli.group()
+def balances():
+    """ Check or rebuild the per-borrower balances table """
+
+@balances.command('verify')
+def balances_verify():
+    """ Report balances that drifted from the payments and devices tables """
+    drift = verify_balances(get_db())
+    for item in drift:
+        click.echo(f"borrower {item['borrower_id']}: {item['column']} stored={item['stored']!r} expected={item['expected']!r}")
+    click.echo(f'{len(drift)} drifted value(s)')
+    if drift:
+        sys.exit(1)
+
+@balances.command('rebuild')
+def balances_rebuild():
+    """ Recompute every balance from the raw tables """
+    conn = get_db()
+    drift = verify_balances(conn)
+    rebuild_balances(conn)
+    click.echo(f'Rebuilt balances; {len(drift)} drifted value(s) corrected')
+
+@app.cli.group()
+def summary():
+    """ Check or rebuild the shop-wide totals """
+
+@summary.command('verify')
+@click.option('--database', type=click.Path(exists=True, dir_okay=False),
+              help='Check this database file instead of the application database.')
+def summary_verify(database):
+    """ Report header totals that drifted from the raw tables """
+    if database:
+        conn = sqlite3.connect(database)
+        conn.row_factory = sqlite3.Row
+    else:
+        conn = get_db()
+    drift = verify_summary(conn)
+    for item in drift:
+        click.echo(f"{item['column']}: stored={item['stored']!r} expected={item['expected']!r}")
+    click.echo(f'{len(drift)} drifted value(s)')
+    if drift:
+        sys.exit(1)
+
+@summary.command('rebuild')
+def summary_rebuild():
+    """ Recompute the shop-wide totals from the raw tables """
+    conn = get_db()
+    drift = verify_summary(conn)
+    rebuild_summary(conn)
+    click.echo(f'Rebuilt shop summary; {len(drift)} drifted value(s) corrected')
+
+# Aging buckets as (label, oldest age in days or None for open-ended)
+AGING_BUCKETS = (
+    ('0-30', 30),
+    ('31-60', 60),
+    ('61-90', 90),
+    ('90+', None),
+)
+
+def aging_report(conn, today=None):
+    """ Outstanding debt per aging bucket, counted in days since the last payment
+    (or since the first loan for borrowers who never paid) """
+    today = today or datetime.now().strftime('%Y-%m-%d')
+    buckets = {label: {'bucket': label, 'borrowers': 0, 'remaining': 0.0} for label, _ in AGING_BUCKETS}
+    buckets['unknown'] = {'bucket': 'unknown', 'borrowers': 0, 'remaining': 0.0}
+    # aging_rollup has one row per anchor date, so this reads a few thousand rows at most
+    for row in conn.execute('''SELECT anchor_date, julianday(?) - julianday(anchor_date) AS age,
+                                      borrower_count, remaining
+                               FROM aging_rollup WHERE borrower_count > 0''', (today,)):
+        label = 'unknown'
+        if row['age'] is not None:
+            label = next(label for label, days in AGING_BUCKETS if days is None or row['age'] <= days)
+        buckets[label]['borrowers'] += row['borrower_count']
+        buckets[label]['remaining'] += row['remaining']
+    return list(buckets.values())
+
+def overdue_borrowers(conn, days=90, today=None, limit=100):
+    """ Borrowers who still owe money and have not paid for more than days, oldest debt first """
+    today = today or datetime.now().strftime('%Y-%m-%d')
+    return conn.execute(f'''
+        SELECT b.id, b.name, b.number_phone, bal.remaining, {AGING_ANCHOR_SQL} AS since,
+               CAST(julianday(?) - julianday({AGING_ANCHOR_SQL}) AS INTEGER) AS days
+        FROM balances bal JOIN borrowers b ON b.id = bal.borrower_id
+        WHERE remaining > 0 AND {AGING_ANCHOR_SQL} != '' AND {AGING_ANCHOR_SQL} < date(?, ?)
+        ORDER BY {AGING_ANCHOR_SQL}
+        LIMIT ?
+    ''', (today, today, f'-{int(days)} days', limit)).fetchall()
+
+def monthly_report(conn, months=24):
+    """ Lending and collections for the latest months, newest first """
+    return conn.execute('''SELECT month, lent, loan_count, collected, payment_count FROM monthly_totals
+                           WHERE month != '' AND (loan_count > 0 OR payment_count > 0)
+                           ORDER BY month DESC LIMIT ?''', (months,)).fetchall()
+
+def verify_reports(conn, tolerance=0.005):
+    """ Compare the report rollups with a fresh computation and return every drifted value """
+    drift = []
+    for table, key, columns, select_sql in (('monthly_totals', 'month', MONTHLY_COLUMNS, MONTHLY_HISTORY_SELECT_SQL),
+                                            ('aging_rollup', 'anchor_date', AGING_COLUMNS, AGING_SELECT_SQL)):
+        expected = {row[key]: row for row in conn.execute(select_sql)}
+        # Rows that dropped to zero stay behind in the rollups and count as absent
+        nonzero = ' OR '.join(f'{column} != 0' for column in columns)
+        stored = {row[key]: row for row in conn.execute(f'SELECT * FROM {table} WHERE {nonzero}')}
+        for value in sorted(expected.keys() | stored.keys()):
+            for column in columns:
+                a = stored[value][column] if value in stored else 0
+                b = expected[value][column] if value in expected else 0
+                if abs(a - b) > tolerance:
+                    drift.append({'table': table, 'key': value, 'column': column, 'stored': a, 'expected': b})
+    for row in conn.execute('''SELECT borrower_id, first_device_date,
+                                      (SELECT MIN(device_date) FROM devices WHERE borrower_id = balances.borrower_id) AS expected
+                               FROM balances WHERE first_device_date IS NOT expected'''):
+        drift.append({'table': 'balances', 'key': row['borrower_id'], 'column': 'first_device_date',
+                      'stored': row['first_device_date'], 'expected': row['expected']})
+    return drift
+
+def rebuild_reports(conn):
+    """ Recompute the report rollups from scratch """
+    conn.execute('''UPDATE balances SET first_device_date = (SELECT MIN(device_date) FROM devices
+                                                             WHERE borrower_id = balances.borrower_id)''')
+    conn.execute('DELETE FROM monthly_totals')
+    conn.execute('INSERT INTO monthly_totals (month, ' + ', '.join(MONTHLY_COLUMNS) + ') ' + MONTHLY_HISTORY_SELECT_SQL)
+    conn.execute('DELETE FROM aging_rollup')
+    conn.execute('INSERT INTO aging_rollup (anchor_date, ' + ', '.join(AGING_COLUMNS) + ') ' + AGING_SELECT_SQL)
+    conn.commit()
+
+@app.cli.group()
+def reports():
+    """ Check or rebuild the aging and monthly report rollups """
+
+@reports.command('verify')
+def reports_verify():
+    """ Report rollup values that drifted from the raw tables """
+    drift = verify_reports(get_db())
+    for item in drift:
+        click.echo(f"{item['table']} {item['key']!r}: {item['column']} stored={item['stored']!r} expected={item['expected']!r}")
+    click.echo(f'{len(drift)} drifted value(s)')
+    if drift:
+        sys.exit(1)
+
+@reports.command('rebuild')
+def reports_rebuild():
+    """ Recompute the report rollups from the raw tables """
+    conn = get_db()
+    drift = verify_reports(conn)
+    rebuild_reports(conn)
+    click.echo(f'Rebuilt report rollups; {len(drift)} drifted value(s) corrected')
+
+
+# Full-text search over the borrower_search index
+SEARCH_KINDS = {SEARCH_KIND_BORROWER: 'borrower', SEARCH_KIND_DEVICE: 'device', SEARCH_KIND_PAYMENT: 'payment'}
+# bm25 weights for name, number_phone, notes, item and the unindexed borrower_id
+SEARCH_WEIGHTS = (10.0, 6.0, 2.0, 1.0, 0.0)
+SEARCH_MIN_TERM = 3
+
+_search_trigram = None
+
+def _search_uses_trigram(conn):
+    """ Whether the index was built with the trigram tokenizer (checked once per process) """
+    global _search_trigram
+    if _search_trigram is None:
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'borrower_search'").fetchone()
+        _search_trigram = row is not None and 'trigram' in row[0]
+    return _search_trigram
+
+def search_match_expression(conn, query, operator=' '):
+    """ FTS5 MATCH expression for a user query, or None when no term is long enough to search """
+    trigram = _search_uses_trigram(conn)
+    terms = []
+    for term in fold_text(query).split():
+        term = term.strip('-') if term.replace('-', '').isdigit() else term
+        if trigram and len(term) < SEARCH_MIN_TERM:
+            continue
+        quoted = '"' + term.replace('"', '""') + '"'
+        terms.append(quoted if trigram else quoted + '*')
+    return operator.join(terms) or None
+
+def _search_snippet(text):
+    # snippet() marks matches with control characters so the text can be escaped before adding <mark>
+    return Markup(str(escape(text)).replace('\x02', '<mark>').replace('\x03', '</mark>'))
+
+def _search_index(conn, schema, query, limit):
+    """ Matches in the main or the archive search index, grouped per borrower in rank order """
+    sql = f'''SELECT borrower_id, rowid % 4 AS kind,
+                     bm25(borrower_search, {', '.join(map(str, SEARCH_WEIGHTS))}) AS rank,
+                     snippet(borrower_search, -1, char(2), char(3), '…', 24) AS snippet
+              FROM {schema}.borrower_search WHERE borrower_search MATCH ?
+              ORDER BY rank LIMIT ?'''
+    # All terms must occur in one document; when none does, documents matching any term still rank
+    rows = []
+    for operator in (' ', ' OR '):
+        expression = search_match_expression(conn, query, operator)
+        if expression is None:
+            return OrderedDict()
+        rows = conn.execute(sql, (expression, limit * 10)).fetchall()
+        if rows or ' ' not in expression:
+            break
+
+    found = OrderedDict()
+    for row in rows:
+        matches = found.setdefault(row['borrower_id'], {'rank': row['rank'], 'matches': []})['matches']
+        if len(matches) < 3:
+            matches.append({'kind': SEARCH_KINDS[row['kind']], 'snippet': _search_snippet(row['snippet'])})
+    return found
+
+def search_borrowers(conn, query, limit=20, include_archived=True):
+    """ Borrowers whose name, phone, notes or bought items match query, best match first, each
+    with up to three highlighted snippets of the matching text. Archived borrowers follow the
+    active ones, marked with archived=True. """
+    found = _search_index(conn, 'main', query, limit)
+    ids = list(found)[:limit]
+    results = []
+    if ids:
+        placeholders = ', '.join('?' * len(ids))
+        borrowers = {row['id']: row for row in conn.execute(f'''
+            SELECT b.id, b.name, b.number_phone, bal.remaining FROM borrowers b
+            LEFT JOIN balances bal ON bal.borrower_id = b.id
+            WHERE b.id IN ({placeholders})''', ids)}
+        results = [{'id': borrower_id, 'name': borrowers[borrower_id]['name'],
+                    'number_phone': borrowers[borrower_id]['number_phone'],
+                    'remaining': borrowers[borrower_id]['remaining'] or 0, 'archived': False,
+                    'rank': found[borrower_id]['rank'], 'matches': found[borrower_id]['matches']}
+                   for borrower_id in ids if borrower_id in borrowers]
+
+    if include_archived and len(results) < limit:
+        active = {result['id'] for result in results}
+        archived = _search_index(conn, 'archive', query, limit)
+        ids = [borrower_id for borrower_id in archived if borrower_id not in active][:limit - len(results)]
+        if ids:
+            placeholders = ', '.join('?' * len(ids))
+            borrowers = {row['id']: row for row in conn.execute(
+                f'SELECT id, name, number_phone FROM archive.borrowers WHERE id IN ({placeholders})', ids)}
+            # Only settled borrowers are archived, so nothing remains to be paid
+            results.extend({'id': borrower_id, 'name': borrowers[borrower_id]['name'],
+                            'number_phone': borrowers[borrower_id]['number_phone'], 'remaining': 0, 'archived': True,
+                            'rank': archived[borrower_id]['rank'], 'matches': archived[borrower_id]['matches']}
+                           for borrower_id in ids if borrower_id in borrowers)
+    return results
+
+def rebuild_search(conn):
+    """ Re-index every borrower, device and payment, then merge the index into one segment """
+    conn.execute('DELETE FROM borrower_search')
+    for sql in SEARCH_POPULATE_SQL:
+        conn.execute(sql)
+    conn.execute("INSERT INTO borrower_search (borrower_search) VALUES ('optimize')")
+    conn.commit()
+
+@app.cli.group()
+def search():
+    """ Maintain the full-text search index """
+
+@search.command('rebuild')
+def search_rebuild():
+    """ Rebuild the search index from the borrowers, devices and payments tables """
+    conn = get_db()
+    rebuild_search(conn)
+    count = conn.execute('SELECT COUNT(*) FROM borrower_search').fetchone()[0]
+    click.echo(f'Indexed {count} document(s)')
+
+
+# Cold archive: borrowers who owe nothing and have been inactive for a while move with their devices
+# and payments into the attached archive database, so the hot tables only hold current customers
+app.config['ARCHIVE_AFTER_DAYS'] = 180
+app.config['ARCHIVE_BATCH_SIZE'] = 200
+# Float sums of payments can leave dust behind on a settled balance
+ARCHIVE_SETTLED_BELOW = 0.005
+
+def _search_rowids_sql(schema, placeholders):
+    """ rowids of the search documents of some borrowers, found through the tables they index """
+    return f'''SELECT id * 4 FROM {schema}.borrowers WHERE id IN ({placeholders})
+               UNION ALL SELECT id * 4 + 1 FROM {schema}.devices WHERE borrower_id IN ({placeholders})
+               UNION ALL SELECT id * 4 + 2 FROM {schema}.payments WHERE borrower_id IN ({placeholders})'''
+
+def _move_borrowers(conn, ids, to_archive):
+    """ Move borrowers with their devices and payments between main and archive inside the caller's
+    write transaction. Balances, totals, aging and search in main follow through their triggers,
+    while the moving_history flag keeps the monthly totals as they were. """
+    source, target = ('main', 'archive') if to_archive else ('archive', 'main')
+    placeholders = ', '.join('?' * len(ids))
+    conn.execute("INSERT INTO sync_flags (name) VALUES ('moving_history')")
+
+    # The archive index is written by hand: copied before the delete triggers drop the rows from main,
+    # dropped on restore while the insert triggers index them in main again
+    if to_archive:
+        conn.execute(f'''INSERT OR REPLACE INTO archive.borrower_search
+                               (rowid, name, number_phone, notes, item, borrower_id)
+                        SELECT rowid, name, number_phone, notes, item, borrower_id FROM main.borrower_search
+                        WHERE rowid IN ({_search_rowids_sql('main', placeholders)})''', ids * 3)
+    else:
+        conn.execute(f'''DELETE FROM archive.borrower_search
+                        WHERE rowid IN ({_search_rowids_sql('archive', placeholders)})''', ids * 3)
+
+    # Archiving again after an interrupted move just overwrites the copy; restoring never
+    # replaces a row in main, so a borrower with the same name makes it fail instead
+    verb = 'INSERT OR REPLACE' if to_archive else 'INSERT'
+    for table in ('borrowers', 'devices', 'payments'):
+        columns = ', '.join(ARCHIVE_COLUMNS[table])
+        key = 'id' if table == 'borrowers' else 'borrower_id'
+        if to_archive and table == 'borrowers':
+            conn.execute(f'''{verb} INTO archive.borrowers ({columns}, archived_at)
+                            SELECT {columns}, datetime('now') FROM main.borrowers
+                            WHERE id IN ({placeholders})''', ids)
+        else:
+            conn.execute(f'''{verb} INTO {target}.{table} ({columns})
+                            SELECT {columns} FROM {source}.{table} WHERE {key} IN ({placeholders})''', ids)
+    for table in ('payments', 'devices', 'borrowers'):
+        key = 'id' if table == 'borrowers' else 'borrower_id'
+        conn.execute(f'DELETE FROM {source}.{table} WHERE {key} IN ({placeholders})', ids)
+    conn.execute("DELETE FROM sync_flags WHERE name = 'moving_history'")
+
+def archive_settled(conn, days=None, batch_size=None, today=None):
+    """ Archive borrowers who owe nothing and had no payment or loan for days, one short write
+    transaction per batch so cashiers are never held up for long; returns the archived ids """
+    days = app.config['ARCHIVE_AFTER_DAYS'] if days is None else days
+    batch_size = batch_size or app.config['ARCHIVE_BATCH_SIZE']
+    today = today or datetime.now().strftime('%Y-%m-%d')
+    archived = []
+    while True:
+        with write_transaction(conn):
+            ids = [row[0] for row in conn.execute(f'''
+                SELECT borrower_id FROM balances
+                WHERE remaining < ? AND {ACTIVITY_SQL} < date(?, ?)
+                LIMIT ?''', (ARCHIVE_SETTLED_BELOW, today, f'-{int(days)} days', batch_size))]
+            if ids:
+                _move_borrowers(conn, ids, to_archive=True)
+        if not ids:
+            return archived
+        for borrower_id in ids:
+            data_changed(borrower_id)
+            name_index.remove(borrower_id)
+        archived.extend(ids)
+
+def restore_borrower(conn, borrower_id):
+    """ Move an archived borrower back into the hot tables; False when the id is not archived.
+    Raises sqlite3.IntegrityError when an active borrower already has the same name. """
+    with write_transaction(conn):
+        row = conn.execute('SELECT name FROM archive.borrowers WHERE id = ?', (borrower_id,)).fetchone()
+        if row is None:
+            return False
+        # Checked here rather than left to the name index, which databases created before it may lack
+        if conn.execute('SELECT 1 FROM main.borrowers WHERE LOWER(TRIM(name)) = LOWER(TRIM(?)) AND id != ?',
+                        (row['name'], borrower_id)).fetchone():
+            raise sqlite3.IntegrityError(f'an active borrower is already named {row["name"]!r}')
+        if conn.execute('SELECT 1 FROM main.borrowers WHERE id = ?', (borrower_id,)).fetchone():
+            # Left in both by an interrupted move; the active copy wins
+            conn.execute(f'DELETE FROM archive.borrower_search WHERE rowid IN ({_search_rowids_sql("archive", "?")})',
+                         (borrower_id,) * 3)
+            for table, key in (('payments', 'borrower_id'), ('devices', 'borrower_id'), ('borrowers', 'id')):
+                conn.execute(f'DELETE FROM archive.{table} WHERE {key} = ?', (borrower_id,))
+        else:
+            _move_borrowers(conn, [borrower_id], to_archive=False)
+    data_changed(borrower_id)
+    name_index.remove(borrower_id)
+    name_index.add(borrower_id, row['name'])
+    return True
+
+def archived_borrower(conn, borrower_id):
+    """ An archived borrower with totals computed from the archived payments, or None """
+    return conn.execute('''SELECT b.*, COALESCE(SUM(p.amount_paid), 0) AS total_paid,
+                                   b.total_amount - COALESCE(SUM(p.amount_paid), 0) AS remaining
+                            FROM archive.borrowers b LEFT JOIN archive.payments p ON p.borrower_id = b.id
+                            WHERE b.id = ? GROUP BY b.id''', (borrower_id,)).fetchone()
+
+def reclaim_space(conn, schema='main', step_pages=1000):
+    """ Return free pages to the file system, step_pages per write transaction; only databases
+    in incremental auto-vacuum mode can do this. Returns the number of pages freed. """
+    if conn.execute(f'PRAGMA {schema}.auto_vacuum').fetchone()[0] != 2:
+        return 0
+    freed = 0
+    free = conn.execute(f'PRAGMA {schema}.freelist_count').fetchone()[0]
+    while free:
+        with write_transaction(conn):
+            conn.execute(f'PRAGMA {schema}.incremental_vacuum({min(free, step_pages)})').fetchall()
+        left = conn.execute(f'PRAGMA {schema}.freelist_count').fetchone()[0]
+        if left >= free:
+            break
+        freed += free - left
+        free = left
+    return freed
+
+@app.cli.group()
+def archive():
+    """ Move settled borrowers to the archive database and back """
+
+@archive.command('run')
+@click.option('--days', type=int, default=None, help='Days without payments or loans before a settled borrower is archived.')
+@click.option('--batch-size', type=int, default=None, help='Borrowers moved per transaction.')
+@click.option('--full-vacuum', is_flag=True,
+              help='Switch a database created before archiving existed to incremental auto-vacuum. '
+                   'Runs one full VACUUM, which blocks every writer while it runs.')
+def archive_run(days, batch_size, full_vacuum):
+    """ Archive settled, inactive borrowers and reclaim the space they used """
+    conn = get_db()
+    archived = archive_settled(conn, days, batch_size)
+    if full_vacuum and conn.execute('PRAGMA main.auto_vacuum').fetchone()[0] != 2:
+        conn.execute('PRAGMA main.auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM main')
+    freed = reclaim_space(conn)
+    click.echo(f'Archived {len(archived)} borrower(s); freed {freed} page(s)')
+
+@archive.command('restore')
+@click.argument('borrower_id', type=int)
+def archive_restore(borrower_id):
+    """ Move an archived borrower back to the active tables """
+    try:
+        restored = restore_borrower(get_db(), borrower_id)
+    except sqlite3.IntegrityError:
+        click.echo(f'An active borrower already has the name of borrower {borrower_id}')
+        sys.exit(1)
+    if not restored:
+        click.echo(f'Borrower {borrower_id} is not archived')
+        sys.exit(1)
+    click.echo(f'Restored borrower {borrower_id}')
+
+@archive.command('stats')
+def archive_stats():
+    """ Row counts in the active tables and in the archive """
+    conn = get_db()
+    for table in ('borrowers', 'devices', 'payments'):
+        hot = conn.execute(f'SELECT COUNT(*) FROM main.{table}').fetchone()[0]
+        cold = conn.execute(f'SELECT COUNT(*) FROM archive.{table}').fetchone()[0]
+        click.echo(f'{table:10s} active {hot:9d}  archived {cold:9d}')
+
+# Online backups: snapshots of the main and archive databases copied with SQLite's backup API in
+# small page steps, checked with integrity_check, gzip-compressed and rotated by hour, day and week
+app.config['BACKUP_FOLDER'] = None       # None keeps them in backups/ next to the database
+app.config['BACKUP_INTERVAL'] = 3600     # seconds between scheduled snapshots, 0 turns the schedule off
+app.config['BACKUP_STEP_PAGES'] = 256
+app.config['BACKUP_STEP_SLEEP'] = 0.005
+# Newest snapshot kept for each of the latest N hours, days and ISO weeks
+app.config['BACKUP_RETENTION'] = {'hourly': 24, 'daily': 7, 'weekly': 8}
+
+BACKUP_SCHEMAS = ('main', 'archive')
+_BACKUP_NAME = re.compile(r'^(\d{8}-\d{6})-(main|archive)\.db\.gz$')
+_backup_lock = threading.Lock()
+
+def get_backup_folder():
+    return app.config['BACKUP_FOLDER'] or os.path.join(os.path.dirname(os.path.abspath(app.config['DATABASE'])),
+                                                       'backups')
+
+def list_backups():
+    """ [(stamp, {schema: path})] for every snapshot in the backup folder, newest first """
+    folder = get_backup_folder()
+    snapshots = {}
+    if os.path.isdir(folder):
+        for name in os.listdir(folder):
+            match = _BACKUP_NAME.match(name)
+            if match:
+                snapshots.setdefault(match.group(1), {})[match.group(2)] = os.path.join(folder, name)
+    return sorted(snapshots.items(), reverse=True)
+
+def _integrity_errors(path):
+    conn = sqlite3.connect(path)
+    try:
+        result = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+    finally:
+        conn.close()
+    return [] if result == ['ok'] else result
+
+def create_backup(now=None):
+    """ Write a verified, compressed snapshot of both databases and rotate old ones; returns its stamp.
+    Raises RuntimeError, keeping nothing of the snapshot, when a copy fails its integrity check. """
+    folder = get_backup_folder()
+    os.makedirs(folder, exist_ok=True)
+    stamp = (now or datetime.now()).strftime('%Y%m%d-%H%M%S')
+    db_path = app.config['DATABASE']
+    with _backup_lock:
+        source = sqlite3.connect(db_path, timeout=app.config['DB_TIMEOUT'])
+        written = []
+        try:
+            source.execute('ATTACH DATABASE ? AS archive', (get_archive_path(db_path),))
+            # One read transaction over both files makes the copy a consistent snapshot. In WAL mode
+            # writers never wait for it, and their commits do not make the backup start over.
+            source.execute('BEGIN')
+            for schema in BACKUP_SCHEMAS:
+                source.execute(f'SELECT COUNT(*) FROM {schema}.sqlite_master').fetchone()
+            for schema in BACKUP_SCHEMAS:
+                fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.backup-', suffix='.db')
+                os.close(fd)
+                try:
+                    target = sqlite3.connect(temp_path)
+                    try:
+                        source.backup(target, pages=app.config['BACKUP_STEP_PAGES'], name=schema,
+                                      sleep=app.config['BACKUP_STEP_SLEEP'])
+                    finally:
+                        target.close()
+                    errors = _integrity_errors(temp_path)
+                    if errors:
+                        raise RuntimeError(f'{schema} snapshot failed its integrity check: ' + '; '.join(errors[:5]))
+                    final_path = os.path.join(folder, f'{stamp}-{schema}.db.gz')
+                    with open(temp_path, 'rb') as f, gzip.open(final_path + '.tmp', 'wb', compresslevel=6) as out:
+                        shutil.copyfileobj(f, out, 1024 * 1024)
+                    os.replace(final_path + '.tmp', final_path)
+                    written.append(final_path)
+                finally:
+                    os.remove(temp_path)
+        except Exception:
+            for path in written:
+                os.remove(path)
+            raise
+        finally:
+            source.close()
+        rotate_backups()
+    return stamp
+
+def rotate_backups():
+    """ Delete the snapshots that no hourly, daily or weekly slot of BACKUP_RETENTION keeps """
+    snapshots = list_backups()
+    keep = set()
+    for period, bucket_format in (('hourly', '%Y%m%d%H'), ('daily', '%Y%m%d'), ('weekly', '%G%V')):
+        buckets = set()
+        for stamp, _ in snapshots:
+            bucket = datetime.strptime(stamp, '%Y%m%d-%H%M%S').strftime(bucket_format)
+            if bucket in buckets:
+                continue
+            if len(buckets) >= app.config['BACKUP_RETENTION'].get(period, 0):
+                break
+            buckets.add(bucket)
+            keep.add(stamp)
+    removed = 0
+    for stamp, files in snapshots:
+        if stamp not in keep:
+            for path in files.values():
+                os.remove(path)
+            removed += 1
+    return removed
+
+@contextmanager
+def _unpacked_backup(stamp):
+    """ Decompress a snapshot into temporary files and yield {schema: path} """
+    files = dict(list_backups()).get(stamp)
+    if files is None:
+        raise ValueError(f'no backup {stamp}')
+    unpacked = {}
+    try:
+        for schema, path in files.items():
+            fd, temp_path = tempfile.mkstemp(dir=get_backup_folder(), prefix='.restore-', suffix='.db')
+            unpacked[schema] = temp_path
+            with os.fdopen(fd, 'wb') as out, gzip.open(path, 'rb') as f:
+                shutil.copyfileobj(f, out, 1024 * 1024)
+        yield unpacked
+    finally:
+        for temp_path in unpacked.values():
+            os.remove(temp_path)
+
+def verify_backup(stamp):
+    """ {schema: integrity_check problems} for one snapshot; empty lists mean it is sound """
+    with _unpacked_backup(stamp) as unpacked:
+        return {schema: _integrity_errors(path) for schema, path in unpacked.items()}
+
+def restore_backup(stamp):
+    """ Replace both live databases with a snapshot after checking it. The current state is saved
+    as a new snapshot first; its stamp is returned. """
+    with _unpacked_backup(stamp) as unpacked:
+        for schema, path in unpacked.items():
+            errors = _integrity_errors(path)
+            if errors:
+                raise RuntimeError(f'{schema} snapshot {stamp} is damaged: ' + '; '.join(errors[:5]))
+        safety = create_backup()
+        db_path = app.config['DATABASE']
+        live_paths = {'main': db_path, 'archive': get_archive_path(db_path)}
+        latest_change = _latest_change_id(get_db())
+        for schema, path in unpacked.items():
+            snapshot = sqlite3.connect(path)
+            live = sqlite3.connect(live_paths[schema], timeout=app.config['DB_TIMEOUT'])
+            try:
+                # One step, so readers see either the old or the restored database
+                snapshot.backup(live)
+            finally:
+                live.close()
+                snapshot.close()
+    # A snapshot taken by an older release gets the current schema
+    init_db(db_path)
+    # Continue the change log past ids other processes have already read, so they notice the restore
+    conn = get_db()
+    with write_transaction(conn):
+        if conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'data_changes'",
+                        (latest_change,)).rowcount == 0:
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('data_changes', ?)", (latest_change,))
+    page_cache.clear()
+    data_changed()
+    name_index.reset()
+    return safety
+
+def _latest_change_id(conn):
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'data_changes'").fetchone()
+    return row[0] if row is not None else 0
+
+class BackupScheduler:
+    """ Daemon thread taking a snapshot whenever the newest one is BACKUP_INTERVAL seconds old """
+
+    # Leave the first minutes after start-up to the requests
+    FIRST_DELAY = 60
+
+    def __init__(self):
+        self._thread = None
+
+    def seconds_until_due(self):
+        snapshots = list_backups()
+        if not snapshots:
+            return 0
+        age = (datetime.now() - datetime.strptime(snapshots[0][0], '%Y%m%d-%H%M%S')).total_seconds()
+        return max(0, app.config['BACKUP_INTERVAL'] - age)
+
+    def run(self):
+        time.sleep(self.FIRST_DELAY)
+        while True:
+            try:
+                wait = self.seconds_until_due()
+                if wait <= 0:
+                    create_backup()
+                    wait = app.config['BACKUP_INTERVAL']
+            except Exception as e:
+                app.logger.error('Scheduled backup failed: %s', e)
+                wait = app.config['BACKUP_INTERVAL']
+            time.sleep(max(wait, 1))
+
+    def start(self):
+        if self._thread is None and app.config['BACKUP_INTERVAL'] > 0:
+            self._thread = threading.Thread(target=self.run, name='backups', daemon=True)
+            self._thread.start()
+        return self._thread
+
+backup_scheduler = BackupScheduler()
+
+@app.cli.group()
+def backup():
+    """ Create, check and restore database snapshots """
+
+@backup.command('create')
+def backup_create():
+    """ Take a snapshot now """
+    started = time.perf_counter()
+    stamp = create_backup()
+    click.echo(f'Created backup {stamp} in {time.perf_counter() - started:.1f}s')
+
+@backup.command('list')
+def backup_list():
+    """ List snapshots, newest first """
+    for stamp, files in list_backups():
+        size = sum(os.path.getsize(path) for path in files.values())
+        click.echo(f"{stamp}  {size / 1e6:9.1f} MB  {', '.join(sorted(files))}")
+
+@backup.command('verify')
+@click.argument('stamp', required=False)
+def backup_verify(stamp):
+    """ Run integrity_check on a snapshot (the newest by default) """
+    snapshots = list_backups()
+    if not snapshots:
+        click.echo('No backups')
+        sys.exit(1)
+    stamp = stamp or snapshots[0][0]
+    problems = verify_backup(stamp)
+    for schema, errors in sorted(problems.items()):
+        click.echo(f"{stamp} {schema}: {'ok' if not errors else '; '.join(errors[:5])}")
+    if any(problems.values()):
+        sys.exit(1)
+
+@backup.command('restore')
+@click.argument('stamp')
+@click.confirmation_option(prompt='Replace the current data with this backup? Stop the server first.')
+def backup_restore(stamp):
+    """ Replace the databases with a snapshot; the current data is kept as a new snapshot """
+    safety = restore_backup(stamp)
+    click.echo(f'Restored backup {stamp}; the previous data was saved as backup {safety}')
+
+# Upper bound for rendered pages kept in memory, in bytes
+app.config['PAGE_CACHE_MAX_BYTES'] = 32 * 1024 * 1024
+
+class DataVersions:
+    """ Monotonic data versions: one for the whole shop and one per borrower """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.shop = 0
+        self._borrowers = {}
+        self._all = 0        # every borrower version is at least this
+
+    def bump(self, borrower_id=None):
+        """ Record a write; the shop version always moves, the borrower's only when given """
+        with self._lock:
+            self.shop += 1
+            if borrower_id is not None:
+                self._borrowers[int(borrower_id)] = self.shop
+
+    def bump_all(self):
+        """ Record a write that may have touched any borrower """
+        with self._lock:
+            self.shop += 1
+            self._all = self.shop
+            self._borrowers = {}
+
+    def borrower(self, borrower_id):
+        return max(self._borrowers.get(int(borrower_id), 0), self._all)
+
+class PageCache:
+    """ LRU cache of rendered pages, bounded by the total size of the cached bodies """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        """ Return the cached body for key if it was rendered at this data version """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                if entry is not None:
+                    self._discard(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, body):
+        size = len(body.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._discard(key)
+            self._entries[key] = (version, body, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _discard(self, key):
+        self._size -= self._entries.pop(key)[2]
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self._size, 'max_bytes': self.max_bytes}
+
+data_versions = DataVersions()
+page_cache = PageCache(app.config['PAGE_CACHE_MAX_BYTES'])
+
+# Live updates: committed changes are pushed to open dashboards over /events (server-sent events)
+app.config['EVENTS_MAX_CLIENTS'] = None  # None allows half of SERVER_THREADS, each stream holds a thread
+app.config['EVENTS_KEEPALIVE'] = 15      # seconds between comment lines on an idle stream
+app.config['EVENTS_MAX_SECONDS'] = 300   # a stream then ends and the browser reconnects with Last-Event-ID
+EVENTS_HISTORY = 1000
+EVENTS_QUEUE_SIZE = 256
+
+LIVE_BORROWER_SQL = '''
+    SELECT b.id, b.name, b.number_phone, bal.total_loaned, bal.total_paid, bal.payment_count, bal.remaining,
+           bal.last_payment_date, bal.last_device_date,
+           (SELECT device_description FROM devices WHERE borrower_id = b.id
+            ORDER BY device_date DESC, id DESC LIMIT 1) AS device_description
+    FROM borrowers b JOIN balances bal ON bal.borrower_id = b.id
+    WHERE b.id = ?
+'''
+
+class ChangeFeed:
+    """ In-process publish/subscribe of committed changes. Every subscriber reads from its own bounded
+    queue; the last events are kept so a reconnecting client can catch up from the id it last saw. """
+
+    def __init__(self, history, queue_size):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._history = deque(maxlen=history)
+        self._latest = OrderedDict()    # key -> last payload published under it
+        self.history = history
+        self.queue_size = queue_size
+        # Ids start at the clock so those of an earlier run never look current after a restart
+        self.last_id = int(time.time() * 1000)
+
+    @property
+    def active(self):
+        return bool(self._subscribers)
+
+    def publish(self, event, data, key=None):
+        """ Queue an event for every subscriber; one that has fallen too far behind gets a reload instead.
+        An event with a key is dropped when the last one published under that key carried the same data. """
+        payload = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+        with self._lock:
+            if key is not None:
+                if self._latest.get(key) == payload:
+                    return
+                self._latest[key] = payload
+                self._latest.move_to_end(key)
+                if len(self._latest) > self.history:
+                    self._latest.popitem(last=False)
+            self.last_id += 1
+            item = (self.last_id, event, payload)
+            self._history.append(item)
+            for subscriber in self._subscribers:
+                try:
+                    subscriber.put_nowait(item)
+                except queue.Full:
+                    self._reload(subscriber)
+
+    def subscribe(self, last_id=None, limit=None):
+        """ Return a queue of (id, event, data) for a new client, or None when limit clients are connected.
+        Events after last_id are queued first, or a reload when they are no longer all kept. """
+        with self._lock:
+            if limit is not None and len(self._subscribers) >= limit:
+                return None
+            subscriber = queue.Queue(self.queue_size)
+            if last_id is not None and last_id != self.last_id:
+                missed = [item for item in self._history if item[0] > last_id]
+                complete = last_id < self.last_id and self._history and self._history[0][0] <= last_id + 1
+                if complete and len(missed) < self.queue_size:
+                    for item in missed:
+                        subscriber.put_nowait(item)
+                else:
+                    self._reload(subscriber)
+            self._subscribers.add(subscriber)
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def _reload(self, subscriber):
+        while True:
+            try:
+                subscriber.get_nowait()
+            except queue.Empty:
+                break
+        subscriber.put_nowait((self.last_id, 'reload', '{}'))
+
+    def stats(self):
+        with self._lock:
+            return {'subscribers': len(self._subscribers), 'last_id': self.last_id}
+
+change_feed = ChangeFeed(EVENTS_HISTORY, EVENTS_QUEUE_SIZE)
+
+def shop_totals(conn):
+    row = conn.execute('SELECT ' + ', '.join(SUMMARY_COLUMNS) + ' FROM shop_summary WHERE id = 1').fetchone()
+    return dict(row) if row is not None else {}
+
+def borrower_delta(conn, borrower_id):
+    """ The dashboard row of one borrower after a change (None once it is deleted or archived) with the shop totals """
+    row = conn.execute(LIVE_BORROWER_SQL, (int(borrower_id),)).fetchone()
+    return {'id': int(borrower_id), 'borrower': dict(row) if row is not None else None, 'totals': shop_totals(conn)}
+
+def data_changed(borrower_id=None):
+    """ Call after a committed write so cached pages showing that data are re-rendered
+    and open dashboards are told what changed """
+    if borrower_id is None:
+        # Any borrower's page may show what changed, not only the shop-wide ones
+        data_versions.bump_all()
+    else:
+        data_versions.bump(borrower_id)
+    if has_request_context():
+        g.setdefault('changed_borrowers', []).append(borrower_id)
+    if borrower_id is None and has_app_context():
+        # Triggers log changes to single borrowers; other processes learn of this one from its own row
+        change_watcher.record_reset(get_db())
+    if not change_feed.active:
+        return
+    if borrower_id is None or not has_app_context():
+        change_feed.publish('reload', {})
+        return
+    delta = borrower_delta(get_db(), borrower_id)
+    if has_request_context():
+        g.setdefault('borrower_deltas', {})[delta['id']] = delta
+    change_feed.publish('borrower', delta, key=delta['id'])
+
+def cached_page(scope):
+    """ Serve a view's rendered page from the page cache while its data version is unchanged.
+    scope is 'shop' for pages showing every borrower, 'borrower' for pages of one borrower. """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            # Pages carrying flash messages are one-off, never cache them
+            if 'email' not in session or '_flashes' in session:
+                return view(**kwargs)
+
+            if scope == 'borrower':
+                version = data_versions.borrower(kwargs['borrower_id'])
+            else:
+                version = data_versions.shop
+            key = (request.full_path, session['email'])
+
+            body = page_cache.get(key, version)
+            if body is not None:
+                return body
+            result = view(**kwargs)
+            if isinstance(result, str):
+                page_cache.put(key, version, result)
+            return result
+        return wrapper
+    return decorator
+
+# SQLite's built-in LOWER() folds ASCII letters only
+_ASCII_LOWER = {code: code + 32 for code in range(ord('A'), ord('Z') + 1)}
+
+def normalize_name(name):
+    """ Exact Python counterpart of LOWER(TRIM(name)) used for duplicate-name checks: TRIM strips
+    spaces only and LOWER leaves non-ASCII letters alone, so both sides agree on what a duplicate is """
+    return name.strip(' ').translate(_ASCII_LOWER)
+
+class BorrowerNameIndex:
+    """ Sorted in-memory index of normalized borrower names, loaded lazily from the database """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._keys = []      # sorted (normalized name, borrower id)
+        self._names = {}     # borrower id -> display name
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        rows = get_db().execute('SELECT id, name FROM borrowers').fetchall()
+        with self._lock:
+            if not self._loaded:
+                self._names = {row['id']: row['name'] for row in rows}
+                self._keys = sorted((normalize_name(row['name']), row['id']) for row in rows)
+                self._loaded = True
+
+    def warm(self):
+        """ Load the index ahead of the first lookup, outside any request """
+        with app.app_context():
+            self._ensure_loaded()
+
+    def add(self, borrower_id, name):
+        with self._lock:
+            if not self._loaded:
+                return
+            self._names[borrower_id] = name
+            bisect.insort(self._keys, (normalize_name(name), borrower_id))
+
+    def remove(self, borrower_id):
+        with self._lock:
+            if not self._loaded or borrower_id not in self._names:
+                return
+            key = (normalize_name(self._names.pop(borrower_id)), borrower_id)
+            i = bisect.bisect_left(self._keys, key)
+            if i < len(self._keys) and self._keys[i] == key:
+                del self._keys[i]
+
+    def rename(self, borrower_id, name):
+        self.remove(borrower_id)
+        self.add(borrower_id, name)
+
+    def reset(self):
+        """ Drop everything so the next lookup reloads from the database """
+        with self._lock:
+            self._loaded = False
+            self._keys = []
+            self._names = {}
+
+    def find(self, name, exclude_id=None):
+        """ Return the id of a borrower with this name (case-insensitive), or None """
+        self._ensure_loaded()
+        key = normalize_name(name)
+        with self._lock:
+            i = bisect.bisect_left(self._keys, (key,))
+            while i < len(self._keys) and self._keys[i][0] == key:
+                if self._keys[i][1] != exclude_id:
+                    return self._keys[i][1]
+                i += 1
+        return None
+
+    def prefix(self, prefix, limit=10):
+        """ Return up to limit (id, name) pairs whose normalized name starts with prefix """
+        self._ensure_loaded()
+        key = normalize_name(prefix)
+        matches = []
+        with self._lock:
+            i = bisect.bisect_left(self._keys, (key,))
+            while i < len(self._keys) and len(matches) < limit and self._keys[i][0].startswith(key):
+                borrower_id = self._keys[i][1]
+                matches.append((borrower_id, self._names[borrower_id]))
+                i += 1
+        return matches
+
+name_index = BorrowerNameIndex()
+
+# Writes made by other processes (flask import-csv, archive run, backup restore, jobs run) reach the
+# server's page cache, name index and live feed through the data_changes table the triggers fill
+app.config['DATA_SYNC_SECONDS'] = 1.0     # how often the server reads new rows, 0 turns it off
+app.config['DATA_CHANGES_KEEP'] = 10000   # rows kept when the table is pruned
+DATA_SYNC_BATCH = 1000                    # more new rows than this are applied as one reset
+DATA_CHANGES_PRUNE_SECONDS = 300
+
+class ChangeWatcher:
+    """ Daemon thread applying rows other processes added to data_changes since it last looked """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self.last_id = None
+        self._own = set()    # ids of shop-wide rows written by this process, already applied here
+
+    def record_reset(self, conn):
+        """ Log a change that may touch every borrower, which no trigger sees """
+        with write_transaction(conn):
+            row_id = conn.execute('INSERT INTO data_changes (borrower_id) VALUES (NULL)').lastrowid
+        with self._lock:
+            if self.last_id is not None:
+                self._own.add(row_id)
+
+    def reset(self):
+        """ Forget everything derived from the database """
+        page_cache.clear()
+        data_versions.bump_all()
+        name_index.reset()
+        if change_feed.active:
+            change_feed.publish('reload', {})
+
+    def poll(self, conn):
+        """ Apply the rows added since the last poll; the first poll only notes where the log ends.
+        Returns the number of rows read. """
+        with self._lock:
+            newest = conn.execute('SELECT COALESCE(MAX(id), 0) FROM data_changes').fetchone()[0]
+            if self.last_id is None or newest == self.last_id:
+                self.last_id = newest
+                return 0
+            if newest < self.last_id or newest - self.last_id > DATA_SYNC_BATCH:
+                # Replaced by an older copy of the file, or too much to apply row by row
+                self.last_id = newest
+                self._own.clear()
+                reset = True
+                rows = []
+            else:
+                rows = conn.execute('SELECT id, borrower_id, names FROM data_changes WHERE id > ? AND id <= ?',
+                                    (self.last_id, newest)).fetchall()
+                self.last_id = newest
+                reset = any(row['borrower_id'] is None and row['id'] not in self._own for row in rows)
+                self._own = {row_id for row_id in self._own if row_id > newest}
+        if reset:
+            self.reset()
+            return len(rows)
+
+        changed = {row['borrower_id'] for row in rows if row['borrower_id'] is not None}
+        renamed = sorted({row['borrower_id'] for row in rows if row['borrower_id'] is not None and row['names']})
+        for borrower_id in changed:
+            data_versions.bump(borrower_id)
+        if renamed:
+            names = dict(conn.execute(f"SELECT id, name FROM borrowers WHERE id IN ({', '.join('?' * len(renamed))})",
+                                      renamed).fetchall())
+            for borrower_id in renamed:
+                name_index.remove(borrower_id)
+                if borrower_id in names:
+                    name_index.add(borrower_id, names[borrower_id])
+        if change_feed.active:
+            # Changes this process made itself were published already and are dropped as repeats
+            for borrower_id in sorted(changed):
+                delta = borrower_delta(conn, borrower_id)
+                change_feed.publish('borrower', delta, key=delta['id'])
+        return len(rows)
+
+    def prune(self, conn):
+        with write_transaction(conn):
+            conn.execute('DELETE FROM data_changes WHERE id <= (SELECT MAX(id) FROM data_changes) - ?',
+                         (app.config['DATA_CHANGES_KEEP'],))
+
+    def run(self):
+        conn = get_pool().connect()
+        pruned = 0
+        while True:
+            try:
+                self.poll(conn)
+                if time.monotonic() - pruned > DATA_CHANGES_PRUNE_SECONDS:
+                    self.prune(conn)
+                    pruned = time.monotonic()
+            except Exception as e:
+                app.logger.error('Reading data changes failed: %s', e)
+            time.sleep(app.config['DATA_SYNC_SECONDS'])
+
+    def start(self):
+        if self._thread is None and app.config['DATA_SYNC_SECONDS'] > 0:
+            self._thread = threading.Thread(target=self.run, name='data-changes', daemon=True)
+            self._thread.start()
+        return self._thread
+
+change_watcher = ChangeWatcher()
+
+# Downscaled copies generated for every uploaded image: variant -> bounding box in pixels
+IMAGE_VARIANTS = {'thumb': (240, 240), 'preview': (1280, 1280)}
+app.config['IMAGE_WORKERS'] = 2
+
+_HASHED_NAME = re.compile(r'^[0-9a-f]{64}(\.[a-z0-9]+)?$')
+# Originals and their thumbnails, named after the SHA-256 of the uploaded content
+_IMMUTABLE_UPLOAD = re.compile(r'^(thumbs/)?[0-9a-f]{64}(_[a-z]+)?(\.[a-z0-9]+)?$')
+_image_executor = None
+_image_executor_lock = threading.Lock()
+
+def variant_filename(filename, variant):
+    """ Name of a downscaled copy, relative to the upload folder """
+    return f'thumbs/{os.path.splitext(filename)[0]}_{variant}.jpg'
+
+def store_upload(file_storage):
+    """ Save an upload under the SHA-256 of its content and return the stored filename.
+    Identical files share one copy on disk; thumbnails are generated in the background. """
+    upload_dir = app.config['UPLOAD_FOLDER']
+    os.makedirs(upload_dir, exist_ok=True)
+    extension = os.path.splitext(secure_filename(file_storage.filename))[1].lower()
+    digest = hashlib.sha256()
+
+    fd, temp_path = tempfile.mkstemp(dir=upload_dir, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in iter(lambda: file_storage.stream.read(65536), b''):
+                digest.update(chunk)
+                out.write(chunk)
+        filename = digest.hexdigest() + extension
+        final_path = os.path.join(upload_dir, filename)
+        if os.path.exists(final_path):
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, final_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    schedule_thumbnails(filename)
+    return filename
+
+_pillow = None
+
+def load_pillow():
+    """ Import Pillow on first use, so start-up does not pay for it; (None, None) when it is missing """
+    global _pillow
+    if _pillow is None:
+        try:
+            from PIL import Image, ImageOps
+            _pillow = (Image, ImageOps)
+        except ImportError:  # Pillow is optional, without it pages fall back to the original images
+            _pillow = (None, None)
+    return _pillow
+
+def generate_thumbnails(filename):
+    """ Write every missing downscaled variant of an uploaded image """
+    Image, ImageOps = load_pillow()
+    if Image is None:
+        return
+    source = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    targets = {variant: os.path.join(app.config['UPLOAD_FOLDER'], variant_filename(filename, variant))
+               for variant in IMAGE_VARIANTS}
+    missing = {variant: path for variant, path in targets.items() if not os.path.exists(path)}
+    if not missing or not os.path.exists(source):
+        return
+
+    os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'thumbs'), exist_ok=True)
+    try:
+        with Image.open(source) as original:
+            image = ImageOps.exif_transpose(original).convert('RGB')
+    except OSError as e:
+        app.logger.warning('Cannot create thumbnails for %s: %s', filename, e)
+        return
+    for variant, path in missing.items():
+        copy = image.copy()
+        copy.thumbnail(IMAGE_VARIANTS[variant])
+        temp_path = path + '.tmp'
+        copy.save(temp_path, 'JPEG', quality=80, optimize=True)
+        os.replace(temp_path, path)
+
+def _get_image_executor():
+    global _image_executor
+    with _image_executor_lock:
+        if _image_executor is None:
+            _image_executor = ThreadPoolExecutor(max_workers=app.config['IMAGE_WORKERS'],
+                                                 thread_name_prefix='thumbnails')
+        return _image_executor
+
+def schedule_thumbnails(filename):
+    """ Generate thumbnails off the request thread """
+    _get_image_executor().submit(generate_thumbnails, filename)
+
+def scan_uploads():
+    """ Queue thumbnails for stored images that lack a variant; returns how many were queued """
+    upload_dir = app.config['UPLOAD_FOLDER']
+    if not os.path.isdir(upload_dir):
+        return 0
+    queued = 0
+    for name in os.listdir(upload_dir):
+        if _HASHED_NAME.match(name) and any(
+                not os.path.exists(os.path.join(upload_dir, variant_filename(name, variant)))
+                for variant in IMAGE_VARIANTS):
+            schedule_thumbnails(name)
+            queued += 1
+    return queued
+
+def migrate_uploads(conn):
+    """ Rename stored images to their content hash, rewrite the rows and create thumbnails.
+    Returns (renamed, deduplicated, missing) file counts. """
+    upload_dir = app.config['UPLOAD_FOLDER']
+    names = {row[0] for row in conn.execute(
+        'SELECT device_image FROM devices WHERE device_image IS NOT NULL AND device_image != \'\' '
+        'UNION SELECT device_image FROM payments WHERE device_image IS NOT NULL AND device_image != \'\'')}
+
+    renamed = deduplicated = missing = 0
+    for name in sorted(names):
+        if _HASHED_NAME.match(name):
+            generate_thumbnails(name)
+            continue
+        path = os.path.join(upload_dir, name)
+        if not os.path.exists(path):
+            missing += 1
+            continue
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        filename = digest.hexdigest() + os.path.splitext(name)[1].lower()
+        target = os.path.join(upload_dir, filename)
+        if os.path.exists(target):
+            deduplicated += 1
+        else:
+            renamed += 1
+        conn.execute('UPDATE devices SET device_image = ? WHERE device_image = ?', (filename, name))
+        conn.execute('UPDATE payments SET device_image = ? WHERE device_image = ?', (filename, name))
+        conn.commit()
+        # Only touch the file once the rows point at the new name
+        if os.path.exists(target):
+            os.remove(path)
+        else:
+            os.replace(path, target)
+        generate_thumbnails(filename)
+    return renamed, deduplicated, missing
+
+@app.cli.group()
+def images():
+    """ Maintain uploaded device images """
+
+@images.command('migrate')
+def images_migrate():
+    """ Move existing uploads to content-addressed names and build their thumbnails """
+    renamed, deduplicated, missing = migrate_uploads(get_db())
+    click.echo(f'{renamed} file(s) renamed, {deduplicated} duplicate(s) removed, {missing} missing file(s)')
+    if load_pillow()[0] is None:
+        click.echo('Pillow is not installed, thumbnails were not generated')
+
+# Exportable datasets: columns, query and the date column used by date_from/date_to
+EXPORTS = {
+    'borrowers': {
+        'columns': ('id', 'name', 'number_phone', 'notes', 'total_loaned', 'total_paid', 'remaining',
+                    'last_payment_date', 'payment_count', 'device_count', 'last_device_date'),
+        'sql': '''SELECT b.id, b.name, b.number_phone, b.notes, bal.total_loaned, bal.total_paid, bal.remaining,
+                         bal.last_payment_date, bal.payment_count, bal.device_count, bal.last_device_date
+                  FROM borrowers b JOIN balances bal ON bal.borrower_id = b.id''',
+        'date_column': 'bal.last_payment_date',
+        'borrower_column': 'b.id',
+        'order_by': 'b.id',
+    },
+    'payments': {
+        'columns': ('id', 'borrower_id', 'borrower_name', 'amount_paid', 'payment_date',
+                    'device_description', 'device_image'),
+        'sql': '''SELECT p.id, p.borrower_id, b.name, p.amount_paid, p.payment_date,
+                         p.device_description, p.device_image
+                  FROM payments p LEFT JOIN borrowers b ON b.id = p.borrower_id''',
+        'date_column': 'p.payment_date',
+        'borrower_column': 'p.borrower_id',
+        'order_by': 'p.payment_date, p.id',
+    },
+    'devices': {
+        'columns': ('id', 'borrower_id', 'borrower_name', 'device_description', 'device_date',
+                    'device_amount', 'device_image'),
+        'sql': '''SELECT d.id, d.borrower_id, b.name, d.device_description, d.device_date,
+                         d.device_amount, d.device_image
+                  FROM devices d LEFT JOIN borrowers b ON b.id = d.borrower_id''',
+        'date_column': 'd.device_date',
+        'borrower_column': 'd.borrower_id',
+        'order_by': 'd.device_date, d.id',
+    },
+}
+
+EXPORT_BATCH_SIZE = 1000
+
+def export_query(dataset, date_from=None, date_to=None, borrower_id=None):
+    """ Build the SQL and parameters for one export """
+    spec = EXPORTS[dataset]
+    where = []
+    params = []
+    if date_from:
+        where.append(f"{spec['date_column']} >= ?")
+        params.append(date_from)
+    if date_to:
+        where.append(f"{spec['date_column']} <= ?")
+        params.append(date_to)
+    if borrower_id is not None:
+        where.append(f"{spec['borrower_column']} = ?")
+        params.append(borrower_id)
+    sql = spec['sql']
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    return sql + ' ORDER BY ' + spec['order_by'], params
+
+def iter_export_rows(sql, params):
+    """ Yield batches of rows from a dedicated pooled connection, so memory stays flat """
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        cursor = conn.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            yield rows
+    finally:
+        pool.release(conn)
+
+def generate_csv(columns, batches):
+    """ Encode batches of rows as UTF-8 CSV chunks (with a BOM so Excel shows Arabic correctly) """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    tail = buffer.getvalue()
+    if tail:
+        yield tail.encode('utf-8')
+
+def gzip_chunks(chunks):
+    """ Compress a stream of byte chunks into gzip format on the fly """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+class _ChunkSink:
+    """ Write-only, non-seekable file object collecting what zipfile writes """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+_XML_INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def _xlsx_cell(value):
+    if value is None:
+        return '<c/>'
+    if isinstance(value, (int, float)):
+        return f'<c t="n"><v>{value}</v></c>'
+    text = xml_escape(_XML_INVALID.sub('', str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+_XLSX_STATIC_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>'),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="{sheet}" sheetId="1" r:id="rId1"/></sheets></workbook>'),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '</Relationships>'),
+}
+
+def generate_xlsx(sheet_name, columns, batches):
+    """ Stream a single-sheet XLSX workbook; the sheet XML is zipped as rows arrive """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as workbook:
+        for name, content in _XLSX_STATIC_PARTS.items():
+            workbook.writestr(name, content.replace('{sheet}', xml_escape(sheet_name)))
+        yield sink.drain()
+
+        with workbook.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            sheet.write(('<row>' + ''.join(_xlsx_cell(c) for c in columns) + '</row>').encode('utf-8'))
+            for rows in batches:
+                sheet.write(''.join('<row>' + ''.join(_xlsx_cell(v) for v in row) + '</row>'
+                                    for row in rows).encode('utf-8'))
+                data = sink.drain()
+                if data:
+                    yield data
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.drain()
+
+# Bulk import: rows are validated like the matching form and inserted in batches of this size
+IMPORT_BATCH_SIZE = 5000
+
+# Required and optional CSV columns per import kind
+IMPORT_COLUMNS = {
+    'borrowers': (('name', 'number_phone', 'total_amount'), ('notes', 'loan_date', 'device_description')),
+    'loans': (('amount',), ('borrower_name', 'borrower_id', 'loan_date', 'device_description')),
+    'payments': (('amount_paid', 'payment_date'), ('borrower_name', 'borrower_id', 'device_description')),
+}
+
+def _import_amount(value):
+    try:
+        return float((value or '').replace(',', '').strip())
+    except ValueError:
+        raise ValueError('يرجى إدخال مبلغ صحيح')
+
+def _import_borrower(row, ids_by_name, known_ids):
+    """ Resolve the borrower of a loans/payments row by borrower_id or exact name """
+    borrower_id = (row.get('borrower_id') or '').strip()
+    if borrower_id.isdigit() and int(borrower_id) in known_ids:
+        return int(borrower_id)
+    name = (row.get('borrower_name') or '').strip()
+    if name in ids_by_name:
+        return ids_by_name[name]
+    raise ValueError('الاسم غير موجود في النظام')
+
+def import_csv(conn, kind, lines):
+    """ Import borrowers, loans or payments from CSV lines in batched transactions.
+    Invalid rows are reported by line number and skipped; the rest of the file is still imported. """
+    reader = csv.DictReader(lines)
+    report = {'kind': kind, 'imported': 0, 'errors': []}
+    required, optional = IMPORT_COLUMNS[kind]
+    missing = [column for column in required if column not in (reader.fieldnames or ())]
+    if kind != 'borrowers' and not {'borrower_name', 'borrower_id'} & set(reader.fieldnames or ()):
+        missing.append('borrower_name')
+    if missing:
+        report['errors'].append({'line': 1, 'error': 'missing column(s): ' + ', '.join(missing)})
+        return report
+
+    today = datetime.now().strftime('%Y-%m-%d')
+    ids_by_name = {row['name']: row['id'] for row in conn.execute('SELECT id, name FROM borrowers')}
+    known_ids = set(ids_by_name.values())
+    if kind == 'borrowers':
+        taken = {normalize_name(name) for name in ids_by_name}
+    pending = []
+    touched = set()
+
+    def check_payments():
+        """ Split the pending payments into (accepted, rejected) against the balances as they are now;
+        called inside the batch's write transaction so no other payment can land in between """
+        ids = sorted({values[0] for _, values in pending})
+        remaining = dict(conn.execute(f'''SELECT borrower_id, remaining FROM balances
+                                           WHERE borrower_id IN ({', '.join('?' * len(ids))})''', ids).fetchall())
+        accepted, rejected = [], []
+        for line, values in pending:
+            left = remaining.get(values[0], 0)
+            if left <= 0:
+                rejected.append({'line': line, 'error': 'هذا الشخص مسدد - لا يوجد مبلغ متبقي'})
+            elif values[1] > left:
+                rejected.append({'line': line, 'error': 'اكثر'})
+            else:
+                remaining[values[0]] = left - values[1]
+                accepted.append((line, values))
+        return accepted, rejected
+
+    def flush():
+        if not pending:
+            return
+        accepted, rejected = pending, []
+        try:
+            with write_transaction(conn):
+                if kind == 'borrowers':
+                    conn.executemany('INSERT INTO borrowers (name, number_phone, total_amount, notes) VALUES (?, ?, ?, ?)',
+                                     [values[:4] for _, values in pending])
+                    # Like add_loan, a loan without a date is dated today
+                    conn.executemany('''INSERT INTO devices (borrower_id, device_description, device_date, device_amount)
+                                        SELECT id, ?, ?, ? FROM borrowers WHERE name = ?''',
+                                     [(values[5], values[4] or today, values[2], values[0])
+                                      for _, values in pending if values[4] or values[5]])
+                elif kind == 'loans':
+                    conn.executemany('UPDATE borrowers SET total_amount = total_amount + ? WHERE id = ?',
+                                     [(values[1], values[0]) for _, values in pending])
+                    conn.executemany('''INSERT INTO devices (borrower_id, device_amount, device_date, device_description)
+                                        VALUES (?, ?, ?, ?)''', [values for _, values in pending])
+                else:
+                    accepted, rejected = check_payments()
+                    conn.executemany('''INSERT INTO payments (borrower_id, amount_paid, payment_date, device_description)
+                                        VALUES (?, ?, ?, ?)''', [values for _, values in accepted])
+            report['imported'] += len(accepted)
+            report['errors'].extend(rejected)
+            if kind != 'borrowers':
+                touched.update(values[0] for _, values in accepted)
+        except sqlite3.Error as e:
+            report['errors'].append({'line': f'{pending[0][0]}-{pending[-1][0]}', 'error': str(e)})
+        pending.clear()
+
+    for row in reader:
+        line = reader.line_num
+        try:
+            if kind == 'borrowers':
+                name = (row.get('name') or '').strip()
+                number_phone = (row.get('number_phone') or '').strip()
+                if not name or not number_phone or not (row.get('total_amount') or '').strip():
+                    raise ValueError('يرجى ملء جميع الحقول المطلوبة')
+                total_amount = _import_amount(row['total_amount'])
+                if normalize_name(name) in taken:
+                    raise ValueError('هذا الاسم متكرر')
+                taken.add(normalize_name(name))
+                values = (name, number_phone, total_amount, (row.get('notes') or '').strip(),
+                          (row.get('loan_date') or '').strip(), (row.get('device_description') or '').strip())
+            elif kind == 'loans':
+                borrower_id = _import_borrower(row, ids_by_name, known_ids)
+                amount = _import_amount(row.get('amount'))
+                if amount <= 0:
+                    raise ValueError('⚠️ المبلغ يجب أن يكون أكبر من صفر')
+                values = (borrower_id, amount, (row.get('loan_date') or '').strip() or today,
+                          (row.get('device_description') or '').strip())
+            else:
+                borrower_id = _import_borrower(row, ids_by_name, known_ids)
+                amount_paid = _import_amount(row.get('amount_paid'))
+                payment_date = (row.get('payment_date') or '').strip()
+                if not payment_date:
+                    raise ValueError('يرجى ملء جميع الحقول المطلوبة')
+                # The overpayment check runs when the batch is written, against current balances
+                values = (borrower_id, amount_paid, payment_date, (row.get('device_description') or '').strip())
+        except ValueError as e:
+            report['errors'].append({'line': line, 'error': str(e)})
+            continue
+
+        pending.append((line, values))
+        if len(pending) >= IMPORT_BATCH_SIZE:
+            flush()
+    flush()
+    # Overpayments are only found when their batch is written, after later lines were parsed
+    report['errors'].sort(key=lambda error: int(str(error['line']).split('-')[0]))
+
+    if kind == 'borrowers':
+        name_index.reset()
+        data_changed()
+    for borrower_id in touched:
+        data_changed(borrower_id)
+    return report
+
+@app.cli.command('import-csv')
+@click.argument('kind', type=click.Choice(sorted(IMPORT_COLUMNS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_csv_command(kind, path):
+    """ Import borrowers, loans or payments from a CSV file """
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        report = import_csv(get_db(), kind, f)
+    for error in report['errors'][:50]:
+        click.echo(f"line {error['line']}: {error['error']}")
+    click.echo(f"{report['imported']} row(s) imported, {len(report['errors'])} row(s) rejected")
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -158,20 +2906,17 @@ def login():
 
         if not username_error and not password_error:
             try:
-                db_path = get_db_path()
-                print(f"Database path: {db_path}")  # Debug logging
-                conn = sqlite3.connect(db_path)
+                conn = get_db()
                 c = conn.cursor()
                 c.execute('SELECT email, password FROM users WHERE username = ?', (username,))
                 user = c.fetchone()
-                conn.close()
                 if user and check_password_hash(user[1], password):
                     session['email'] = user[0]  # Store email in session for other operations
                     return redirect(url_for('dashboard'))
                 else:
                     password_error = 'اسم المستخدم أو كلمة المرور غير صحيحة'
             except Exception as e:
-                print(f"Database error: {e}")  # Debug logging
+                app.logger.error('Login failed on %s: %s', app.config['DATABASE'], e)
                 password_error = f'خطأ في قاعدة البيانات: {str(e)}'
 
     return render_template('login.html', username_error=username_error, password_error=password_error)
@@ -192,7 +2937,7 @@ def forgot_password():
         if not email:
             error = 'يرجى إدخال البريد الإلكتروني.'
         else:
-            conn = sqlite3.connect(get_db_path())
+            conn = get_db()
             c = conn.cursor()
             c.execute('SELECT id, username FROM users WHERE email = ?', (email,))
             user = c.fetchone()
@@ -225,50 +2970,224 @@ def forgot_password():
                     error = 'حدث خطأ أثناء تحديث البيانات.'
             else:
                 error = 'البريد الإلكتروني غير موجود في النظام.'
-            conn.close()
 
     return render_template('forgot_password.html', error=error, message=message)
 
+# Dashboard listing: sort keys with their indexed ORDER BY expression and tie-breaker
+DASHBOARD_SORTS = {
+    'activity': ("MAX(COALESCE(bal.last_payment_date, ''), COALESCE(bal.last_device_date, ''))", 'bal.borrower_id'),
+    'remaining': ('bal.remaining', 'bal.borrower_id'),
+    'name': ('b.name', 'b.id'),
+}
+# Status filters; {remaining} is the bare column when sorting by remaining and +bal.remaining otherwise,
+# which keeps SQLite walking the sort index instead of sorting every filtered row
+DASHBOARD_FILTERS = {
+    'all': '',
+    'unsettled': '{remaining} > 0',
+    'settled': '{remaining} <= 0',
+    'overdue': f"{{remaining}} > 0 AND {AGING_ANCHOR_SQL} != '' AND {AGING_ANCHOR_SQL} < date(?, ?)",
+}
+app.config['DASHBOARD_PAGE_SIZE'] = 50
+app.config['DASHBOARD_OVERDUE_DAYS'] = 90
+DASHBOARD_MAX_PAGE_SIZE = 500
+# Rows fetched (and devices looked up) at a time while a dashboard streams, and the size in
+# characters of the pieces sent; Jinja yields every text fragment separately otherwise
+DASHBOARD_STREAM_BATCH = 200
+DASHBOARD_STREAM_CHUNK = 16384
+
+LATEST_DEVICES_SQL = '''
+    SELECT id, borrower_id, device_description, device_image, device_date, device_amount
+    FROM devices d
+    WHERE borrower_id IN ({placeholders})
+      AND id = (SELECT id FROM devices WHERE borrower_id = d.borrower_id ORDER BY device_date DESC, id DESC LIMIT 1)
+'''
+
+def _query_int(name, default, low, high):
+    try:
+        return min(max(int(request.args.get(name, default)), low), high)
+    except ValueError:
+        return default
+
+def dashboard_rows(conn, sql, params, devices, payments, batch_size):
+    """ Yield borrower rows a batch at a time. Before a batch is handed out, devices and payments are
+    refilled with the latest device and the payment total of just those borrowers, so however many
+    rows are rendered only one batch is ever held in memory. """
+    cursor = conn.execute(sql, params)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        ids = [row['id'] for row in rows]
+        devices.clear()
+        devices.update(dict.fromkeys(ids))
+        for device in conn.execute(LATEST_DEVICES_SQL.format(placeholders=', '.join('?' * len(ids))), ids):
+            devices[device['borrower_id']] = device
+        payments.clear()
+        payments.update((row['id'], row['total_paid']) for row in rows if row['payment_count'])
+        yield from rows
+
+def coalesce_chunks(chunks, size):
+    """ Join the small strings a streamed template yields into pieces of about size characters """
+    buffer, length = [], 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
 @app.route('/dashboard')
+@cached_page('shop')
 def dashboard():
     if 'email' not in session:
         return redirect(url_for('login'))
 
-    conn = sqlite3.connect(get_db_path())
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+    sort = request.args.get('sort', 'activity')
+    sort = sort if sort in DASHBOARD_SORTS else 'activity'
+    order = 'asc' if request.args.get('order') == 'asc' else 'desc'
+    status = request.args.get('status', 'all')
+    status = status if status in DASHBOARD_FILTERS else 'all'
+    # stream=1 renders every matching row as it is read instead of one page
+    stream = request.args.get('stream') == '1'
+    per_page = _query_int('per_page', app.config['DASHBOARD_PAGE_SIZE'], 1, DASHBOARD_MAX_PAGE_SIZE)
 
-    # Fetch borrowers with loan_date
-    c.execute('SELECT * FROM borrowers')
-    borrowers = c.fetchall()
+    conn = get_db()
+    c = conn.cursor()
 
-    # Fetch device info for each borrower
+    # Header totals and the unfiltered counts are kept current by the shop_summary triggers
+    c.execute('SELECT total_loans, total_paid, total_remaining, borrower_count, settled_count FROM shop_summary WHERE id = 1')
+    totals = c.fetchone()
+    total_loans = totals['total_loans']
+    total_paid = totals['total_paid']
+    total_remaining = totals['total_remaining']
+
+    where = DASHBOARD_FILTERS[status].format(remaining='bal.remaining' if sort == 'remaining' else '+bal.remaining')
+    params = []
+    if status == 'overdue':
+        params = [datetime.now().strftime('%Y-%m-%d'), f"-{int(app.config['DASHBOARD_OVERDUE_DAYS'])} days"]
+        c.execute(f'SELECT COUNT(*) FROM balances bal WHERE {where}', params)
+        total = c.fetchone()[0]
+    else:
+        total = {'all': totals['borrower_count'], 'settled': totals['settled_count'],
+                 'unsettled': totals['borrower_count'] - totals['settled_count']}[status]
+
+    pages = max(1, -(-total // per_page))
+    page = 1 if stream else _query_int('page', 1, 1, pages)
+    expression, tie_breaker = DASHBOARD_SORTS[sort]
+    sql = f'''SELECT b.*, bal.total_paid, bal.payment_count, bal.remaining, bal.last_payment_date,
+                     bal.last_device_date
+              FROM borrowers b
+              JOIN balances bal ON bal.borrower_id = b.id
+              {'WHERE ' + where if where else ''}
+              ORDER BY {expression} {order}, {tie_breaker} {order}'''
+    if not stream:
+        sql += ' LIMIT ? OFFSET ?'
+        params = params + [per_page, (page - 1) * per_page]
+
+    def page_url(number):
+        return url_for('dashboard', sort=sort, order=order, status=status, per_page=per_page, page=number)
+
+    pagination = {
+        'page': page, 'pages': pages, 'per_page': per_page, 'total': total,
+        'sort': sort, 'order': order, 'status': status, 'stream': stream,
+        'prev_url': page_url(page - 1) if page > 1 and not stream else None,
+        'next_url': page_url(page + 1) if page < pages and not stream else None,
+        'page_url': page_url,
+    }
+
+    # Latest device and payment total of the borrowers being rendered, refilled batch by batch
     devices = {}
-    for borrower in borrowers:
-        c.execute('SELECT * FROM devices WHERE borrower_id = ? ORDER BY device_date DESC LIMIT 1', (borrower['id'],))
-        device = c.fetchone()
-        devices[borrower['id']] = device
-
-    # Calculate total loans, total paid, and remaining
-    c.execute('SELECT SUM(total_amount) as total_loans FROM borrowers')
-    total_loans_row = c.fetchone()
-    total_loans = total_loans_row['total_loans'] if total_loans_row['total_loans'] else 0
-
-    c.execute('SELECT SUM(amount_paid) as total_paid FROM payments')
-    total_paid_row = c.fetchone()
-    total_paid = total_paid_row['total_paid'] if total_paid_row['total_paid'] else 0
-
-    total_remaining = total_loans - total_paid
-
-    # Payments grouped by borrower
-    c.execute('SELECT borrower_id, SUM(amount_paid) as total_paid FROM payments GROUP BY borrower_id')
-    payments_data = c.fetchall()
-    payments = {row['borrower_id']: row['total_paid'] for row in payments_data}
-
-    conn.close()
+    payments = {}
+    context = dict(devices=devices, payments=payments, pagination=pagination,
+                   total_loans=total_loans, total_paid=total_paid, total_remaining=total_remaining)
+    if stream:
+        borrowers = dashboard_rows(conn, sql, params, devices, payments, DASHBOARD_STREAM_BATCH)
+        return Response(coalesce_chunks(stream_template('modern_dashboard.html', borrowers=borrowers, **context),
+                                        DASHBOARD_STREAM_CHUNK), mimetype='text/html')
+    borrowers = list(dashboard_rows(conn, sql, params, devices, payments, per_page))
+    return render_template('modern_dashboard.html', borrowers=borrowers, **context)
+
+def _sse_message(item):
+    event_id, event, data = item
+    return f'id: {event_id}\nevent: {event}\ndata: {data}\n\n'
+
+@app.route('/events')
+def events():
+    """ Server-sent events for open dashboards: a 'borrower' event with the new row and shop totals
+    after each change, 'reload' when too much changed to patch rows one by one """
+    if 'email' not in session:
+        abort(401)
 
-    return render_template('modern_dashboard.html', borrowers=borrowers, devices=devices, payments=payments,
-                           total_loans=total_loans, total_paid=total_paid, total_remaining=total_remaining)
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        last_id = None
+    limit = app.config['EVENTS_MAX_CLIENTS'] or max(1, app.config['SERVER_THREADS'] // 2)
+    subscriber = change_feed.subscribe(last_id, limit)
+    if subscriber is None:
+        # The browser retries on its own; the thread stays free for ordinary requests
+        response = Response('', status=503)
+        response.headers['Retry-After'] = '30'
+        return response
+
+    keepalive = app.config['EVENTS_KEEPALIVE']
+    deadline = time.monotonic() + app.config['EVENTS_MAX_SECONDS']
+
+    def stream():
+        try:
+            yield f'retry: 3000\nid: {last_id if last_id is not None else change_feed.last_id}\n\n'
+            while time.monotonic() < deadline:
+                try:
+                    item = subscriber.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield _sse_message(item)
+        finally:
+            change_feed.unsubscribe(subscriber)
+
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def wants_json():
+    """ True for requests made by the dashboard script, which patches the page itself """
+    return (request.headers.get('X-Requested-With') == 'fetch'
+            or request.accept_mimetypes.best == 'application/json')
+
+@app.after_request
+def mutation_json(response):
+    """ Answer a form post made from the dashboard script with the changed rows instead of a redirect """
+    if request.method != 'POST' or response.status_code not in (301, 302, 303) or not wants_json():
+        return response
+    if request.endpoint in ('login', 'forgot_password', 'update_user') or 'email' not in session:
+        return response
+
+    flashes = session.pop('_flashes', [])
+    errors = [message for category, message in flashes if category == 'error']
+    deltas = g.get('borrower_deltas', {})
+    changes = []
+    conn = get_db()
+    for borrower_id in dict.fromkeys(g.get('changed_borrowers', [])):
+        if borrower_id is not None:
+            borrower_id = int(borrower_id)
+            changes.append(deltas.get(borrower_id) or borrower_delta(conn, borrower_id))
+    body = {
+        'ok': not errors,
+        'errors': errors,
+        'messages': [message for category, message in flashes if category != 'error'],
+        'changes': changes,
+        'reload': None in g.get('changed_borrowers', []),
+        'totals': changes[-1]['totals'] if changes else shop_totals(conn),
+        'location': response.location,
+    }
+    response = jsonify(body)
+    response.status_code = 400 if errors else 200
+    return response
 
 @app.route('/check_name')
 def check_name():
@@ -277,32 +3196,46 @@ def check_name():
     if not name:
         return jsonify({'exists': False})
 
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    if borrower_id:
-        c.execute('SELECT id FROM borrowers WHERE LOWER(TRIM(name)) = LOWER(TRIM(?)) AND id != ?', (name, borrower_id))
-    else:
-        c.execute('SELECT id FROM borrowers WHERE LOWER(TRIM(name)) = LOWER(TRIM(?))', (name,))
-    exists = c.fetchone() is not None
-    conn.close()
+    exclude_id = int(borrower_id) if borrower_id.isdigit() else None
+    exists = name_index.find(name, exclude_id=exclude_id) is not None
     return jsonify({'exists': exists})
 
+@app.route('/borrowers/typeahead')
+def borrower_typeahead():
+    if 'email' not in session:
+        return jsonify({'error': 'unauthorized'}), 401
+
+    query = request.args.get('q', '').strip()
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), 50)
+    except ValueError:
+        limit = 10
+    if not query:
+        return jsonify([])
+
+    matches = name_index.prefix(query, limit)
+    remaining = {}
+    if matches:
+        placeholders = ', '.join('?' * len(matches))
+        rows = get_db().execute(f'SELECT borrower_id, remaining FROM balances WHERE borrower_id IN ({placeholders})',
+                                [borrower_id for borrower_id, _ in matches]).fetchall()
+        remaining = {row['borrower_id']: row['remaining'] for row in rows}
+
+    return jsonify([{'id': borrower_id, 'name': name, 'remaining': remaining.get(borrower_id, 0)}
+                    for borrower_id, name in matches])
+
+def borrower_names():
+    return get_db().execute('SELECT name FROM borrowers ORDER BY name').fetchall()
+
 @app.route('/add_loan', methods=['GET', 'POST'])
 def add_loan():
     if 'email' not in session:
         return redirect(url_for('login'))
 
     if request.method == 'GET':
-        # Fetch existing borrowers for the datalist
-        conn = sqlite3.connect(get_db_path())
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute('SELECT name FROM borrowers ORDER BY name')
-        borrowers = c.fetchall()
-        conn.close()
-
+        # Existing names for the datalist; /borrowers/typeahead serves the same names a prefix at a time
         today = datetime.now().strftime('%Y-%m-%d')
-        return render_template('add_loan.html', borrowers=borrowers, today=today)
+        return render_template('add_loan.html', borrowers=borrower_names(), today=today)
     
     # POST method handling
     name = request.form.get('name', '').strip()
@@ -318,57 +3251,47 @@ def add_loan():
     if not name or not number_phone or not total_amount:
         name_error = 'يرجى ملء جميع الحقول المطلوبة'
 
-    # Check if name already exists (case-insensitive)
+    # Check the name (case-insensitive) and insert in one write transaction so two tills cannot add the same name
     if not name_error:
-        conn = sqlite3.connect(get_db_path())
-        c = conn.cursor()
-        c.execute('SELECT id FROM borrowers WHERE LOWER(TRIM(name)) = LOWER(TRIM(?))', (name,))
-        existing_borrower = c.fetchone()
-        conn.close()
+        # Uploads are stored by content hash, so saving one before the check is harmless and keeps
+        # the file write outside the write lock
+        image_filename = None
+        if device_image and device_image.filename != '':
+            image_filename = store_upload(device_image)
 
-        if existing_borrower:
-            name_error = 'هذا الاسم متكرر'
+        with write_transaction() as conn:
+            c = conn.cursor()
+            c.execute('SELECT id FROM borrowers WHERE LOWER(TRIM(name)) = LOWER(TRIM(?))', (name,))
+            existing_borrower = c.fetchone()
 
-    if name_error:
-        # Fetch existing borrowers for the datalist
-        conn = sqlite3.connect(get_db_path())
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute('SELECT name FROM borrowers ORDER BY name')
-        borrowers = c.fetchall()
-        conn.close()
+            if existing_borrower:
+                name_error = 'هذا الاسم متكرر'
+            else:
+                # Insert borrower
+                c.execute('INSERT INTO borrowers (name, number_phone, total_amount, notes) VALUES (?, ?, ?, ?)',
+                          (name, number_phone, float(total_amount_clean), notes))
+                borrower_id = c.lastrowid
+
+                # Insert initial device info with individual loan amount
+                if device_description or image_filename or loan_date:
+                    if not loan_date:
+                        loan_date = datetime.now().strftime('%Y-%m-%d')
+                    amount = 0
+                    try:
+                        amount = float(total_amount_clean)
+                    except (ValueError, TypeError):
+                        amount = 0
+                    c.execute('INSERT INTO devices (borrower_id, device_description, device_image, device_date, device_amount) VALUES (?, ?, ?, ?, ?)',
+                              (borrower_id, device_description, image_filename, loan_date, amount))
 
+    if name_error:
+        if wants_json():
+            return jsonify({'ok': False, 'errors': [name_error]}), 400
         today = datetime.now().strftime('%Y-%m-%d')
-        return render_template('add_loan.html', borrowers=borrowers, today=today, name=name, number_phone=number_phone, total_amount=total_amount, notes=notes, device_description=device_description, loan_date=loan_date, name_error=name_error)
+        return render_template('add_loan.html', borrowers=borrower_names(), today=today, name=name, number_phone=number_phone, total_amount=total_amount, notes=notes, device_description=device_description, loan_date=loan_date, name_error=name_error)
 
-    image_filename = None
-    if device_image and device_image.filename != '':
-        filename = secure_filename(device_image.filename)
-        image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        device_image.save(image_path)
-        image_filename = filename
-
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    # Insert borrower
-    c.execute('INSERT INTO borrowers (name, number_phone, total_amount, notes) VALUES (?, ?, ?, ?)',
-              (name, number_phone, float(total_amount_clean), notes))
-    borrower_id = c.lastrowid
-
-    # Insert initial device info with individual loan amount
-    if device_description or image_filename or loan_date:
-        if not loan_date:
-            loan_date = datetime.now().strftime('%Y-%m-%d')
-        amount = 0
-        try:
-            amount = float(total_amount_clean)
-        except (ValueError, TypeError):
-            amount = 0
-        c.execute('INSERT INTO devices (borrower_id, device_description, device_image, device_date, device_amount) VALUES (?, ?, ?, ?, ?)',
-                  (borrower_id, device_description, image_filename, loan_date, amount))
-
-    conn.commit()
-    conn.close()
+    data_changed(borrower_id)
+    name_index.add(borrower_id, name)
 
     return redirect(url_for('dashboard'))
 
@@ -378,25 +3301,14 @@ def add_payment():
         return redirect(url_for('login'))
 
     if request.method == 'GET':
-        # Fetch borrowers for the dropdown
-        conn = sqlite3.connect(get_db_path())
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute('SELECT * FROM borrowers')
+        # Borrowers for the dropdown with their remaining amounts, read from balances in one query
+        c = get_db().cursor()
+        c.execute('SELECT b.*, bal.remaining FROM borrowers b JOIN balances bal ON bal.borrower_id = b.id')
         borrowers = c.fetchall()
-
-        # Calculate remaining amounts for each borrower
-        remaining_amounts = {}
-        for borrower in borrowers:
-            c.execute('SELECT SUM(amount_paid) as total_paid FROM payments WHERE borrower_id = ?', (borrower['id'],))
-            total_paid_row = c.fetchone()
-            total_paid = total_paid_row['total_paid'] if total_paid_row and total_paid_row['total_paid'] is not None else 0
-            remaining_amounts[borrower['name']] = borrower['total_amount'] - total_paid
-
-        conn.close()
-
+        remaining_amounts = {borrower['name']: borrower['remaining'] for borrower in borrowers}
         today = datetime.now().strftime('%Y-%m-%d')
-        return render_template('add_payment.html', borrowers=borrowers, remaining_amounts=remaining_amounts, today=today)
+        return render_template('add_payment.html', borrowers=borrowers, remaining_amounts=remaining_amounts,
+                               today=today)
 
     # POST method handling
     borrower_name = request.form.get('borrower_name', '').strip()
@@ -408,50 +3320,38 @@ def add_payment():
         flash('يرجى ملء جميع الحقول المطلوبة', 'error')
         return redirect(url_for('add_payment'))
 
-    # Look up borrower_id by name
-    conn = sqlite3.connect(get_db_path())
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('SELECT id FROM borrowers WHERE name = ?', (borrower_name,))
-    borrower = c.fetchone()
-    if not borrower:
-        flash('الاسم غير موجود في النظام', 'error')
-        conn.close()
-        return redirect(url_for('add_payment'))
-
-    borrower_id = borrower['id']
-
-    # Calculate remaining amount for this borrower
-    c.execute('SELECT SUM(amount_paid) as total_paid FROM payments WHERE borrower_id = ?', (borrower_id,))
-    total_paid_row = c.fetchone()
-    total_paid = total_paid_row['total_paid'] if total_paid_row and total_paid_row['total_paid'] is not None else 0
-
-    c.execute('SELECT total_amount FROM borrowers WHERE id = ?', (borrower_id,))
-    borrower_row = c.fetchone()
-    total_amount = borrower_row['total_amount'] if borrower_row else 0
-
-    remaining_amount = total_amount - total_paid
-
-    # Check if borrower is already fully paid
-    if remaining_amount <= 0:
-        flash('هذا الشخص مسدد - لا يوجد مبلغ متبقي', 'error')
-        conn.close()
-        return redirect(url_for('add_payment'))
-
-    # Validate that payment amount doesn't exceed remaining amount
-    if float(amount_paid_clean) > remaining_amount:
-        flash('اكثر', 'error')
-        conn.close()
-        return redirect(url_for('add_payment'))
-
-    # If payment_date not provided, set to current date
-    if not payment_date:
-        payment_date = datetime.now().strftime('%Y-%m-%d')
-
-    c.execute('INSERT INTO payments (borrower_id, amount_paid, payment_date) VALUES (?, ?, ?)',
-              (int(borrower_id), float(amount_paid_clean), payment_date))
-    conn.commit()
-    conn.close()
+    # The remaining-amount check and the insert share one write transaction, so two cashiers
+    # paying the same borrower at once cannot both pass the overpayment check
+    with write_transaction() as conn:
+        c = conn.cursor()
+        # Look up borrower_id by name
+        c.execute('''SELECT b.id, bal.remaining FROM borrowers b JOIN balances bal ON bal.borrower_id = b.id
+                     WHERE b.name = ?''', (borrower_name,))
+        borrower = c.fetchone()
+        if not borrower:
+            flash('الاسم غير موجود في النظام', 'error')
+            return redirect(url_for('add_payment'))
+
+        borrower_id = borrower['id']
+        remaining_amount = borrower['remaining']
+
+        # Check if borrower is already fully paid
+        if remaining_amount <= 0:
+            flash('هذا الشخص مسدد - لا يوجد مبلغ متبقي', 'error')
+            return redirect(url_for('add_payment'))
+
+        # Validate that payment amount doesn't exceed remaining amount
+        if float(amount_paid_clean) > remaining_amount:
+            flash('اكثر', 'error')
+            return redirect(url_for('add_payment'))
+
+        # If payment_date not provided, set to current date
+        if not payment_date:
+            payment_date = datetime.now().strftime('%Y-%m-%d')
+
+        c.execute('INSERT INTO payments (borrower_id, amount_paid, payment_date) VALUES (?, ?, ?)',
+                  (int(borrower_id), float(amount_paid_clean), payment_date))
+    data_changed(borrower_id)
 
     return redirect(url_for('dashboard'))
 
@@ -478,28 +3378,24 @@ def update_loan():
             flash('⚠️ المبلغ يجب أن يكون أكبر من صفر', 'error')
             return redirect(url_for('dashboard'))
             
-        conn = sqlite3.connect(get_db_path())
-        c = conn.cursor()
-
-        # Update the loan amount
-        c.execute('UPDATE borrowers SET total_amount = total_amount + ? WHERE id = ?', (additional_amount, int(borrower_id)))
-        
-        # Insert device details for this new loan
         image_filename = None
         if device_image and device_image.filename != '':
-            filename = secure_filename(device_image.filename)
-            image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            device_image.save(image_path)
-            image_filename = filename
+            image_filename = store_upload(device_image)
         
         if not loan_date:
             loan_date = datetime.now().strftime('%Y-%m-%d')
-            
-        c.execute('INSERT INTO devices (borrower_id, device_description, device_image, device_date, device_amount) VALUES (?, ?, ?, ?, ?)',
-                  (int(borrower_id), device_description, image_filename, loan_date, additional_amount))
-        
-        conn.commit()
-        conn.close()
+
+        with write_transaction() as conn:
+            c = conn.cursor()
+
+            # Update the loan amount
+            c.execute('UPDATE borrowers SET total_amount = total_amount + ? WHERE id = ?', (additional_amount, int(borrower_id)))
+
+            # Insert device details for this new loan
+            c.execute('INSERT INTO devices (borrower_id, device_description, device_image, device_date, device_amount) VALUES (?, ?, ?, ?, ?)',
+                      (int(borrower_id), device_description, image_filename, loan_date, additional_amount))
+
+        data_changed(borrower_id)
     except ValueError:
         flash('يرجى إدخال مبلغ صحيح', 'error')
         return redirect(url_for('dashboard'))
@@ -517,14 +3413,15 @@ def delete_borrower():
         flash('لم يتم تحديد الشخص', 'error')
         return redirect(url_for('dashboard'))
 
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    # Delete payments related to borrower
-    c.execute('DELETE FROM payments WHERE borrower_id = ?', (int(borrower_id),))
-    # Delete borrower
-    c.execute('DELETE FROM borrowers WHERE id = ?', (int(borrower_id),))
-    conn.commit()
-    conn.close()
+    with write_transaction() as conn:
+        c = conn.cursor()
+        # Delete payments and devices related to borrower
+        c.execute('DELETE FROM payments WHERE borrower_id = ?', (int(borrower_id),))
+        c.execute('DELETE FROM devices WHERE borrower_id = ?', (int(borrower_id),))
+        # Delete borrower
+        c.execute('DELETE FROM borrowers WHERE id = ?', (int(borrower_id),))
+    data_changed(borrower_id)
+    name_index.remove(int(borrower_id))
     
     return redirect(url_for('dashboard'))
 
@@ -538,11 +3435,13 @@ def delete_payment():
     if not payment_id:
         return redirect(url_for('dashboard'))
 
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute('DELETE FROM payments WHERE id = ?', (int(payment_id),))
-    conn.commit()
-    conn.close()
+    with write_transaction() as conn:
+        c = conn.cursor()
+        c.execute('SELECT borrower_id FROM payments WHERE id = ?', (int(payment_id),))
+        payment = c.fetchone()
+        c.execute('DELETE FROM payments WHERE id = ?', (int(payment_id),))
+    if payment:
+        data_changed(payment['borrower_id'])
 
     return redirect(url_for('dashboard'))
 
@@ -552,8 +3451,7 @@ def edit_borrower(borrower_id):
     if 'email' not in session:
         return redirect(url_for('login'))
 
-    conn = sqlite3.connect(get_db_path())
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
 
     if request.method == 'POST':
@@ -567,30 +3465,33 @@ def edit_borrower(borrower_id):
         if not name or not number_phone or not total_amount:
             name_error = 'يرجى ملء جميع الحقول المطلوبة'
 
-        # Check if name already exists (case-insensitive), but allow same borrower
+        # Check if name already exists (case-insensitive), but allow same borrower;
+        # the check and the update share one write transaction
         if not name_error:
-            c.execute('SELECT id FROM borrowers WHERE LOWER(TRIM(name)) = LOWER(TRIM(?)) AND id != ?', (name, borrower_id))
-            existing_borrower = c.fetchone()
-            if existing_borrower:
-                name_error = 'هذا الاسم متكرر'
+            with write_transaction():
+                c.execute('SELECT id FROM borrowers WHERE LOWER(TRIM(name)) = LOWER(TRIM(?)) AND id != ?', (name, borrower_id))
+                existing_borrower = c.fetchone()
+                if existing_borrower:
+                    name_error = 'هذا الاسم متكرر'
+                else:
+                    c.execute('UPDATE borrowers SET name = ?, number_phone = ?, total_amount = ?, notes = ? WHERE id = ?',
+                              (name, number_phone, float(total_amount_clean), notes, borrower_id))
 
         if name_error:
+            if wants_json():
+                return jsonify({'ok': False, 'errors': [name_error]}), 400
             # Re-fetch borrower data
             c.execute('SELECT * FROM borrowers WHERE id = ?', (borrower_id,))
             borrower = c.fetchone()
-            conn.close()
             today = datetime.now().strftime('%Y-%m-%d')
             return render_template('edit_borrower.html', borrower=borrower, today=today, name_error=name_error)
 
-        c.execute('UPDATE borrowers SET name = ?, number_phone = ?, total_amount = ?, notes = ? WHERE id = ?',
-                  (name, number_phone, float(total_amount_clean), notes, borrower_id))
-        conn.commit()
-        conn.close()
+        data_changed(borrower_id)
+        name_index.rename(borrower_id, name)
         return redirect(url_for('edit_borrower', borrower_id=borrower_id))
 
     c.execute('SELECT * FROM borrowers WHERE id = ?', (borrower_id,))
     borrower = c.fetchone()
-    conn.close()
 
     if borrower is None:
         return redirect(url_for('dashboard'))
@@ -604,8 +3505,7 @@ def edit_payment(payment_id):
     if 'email' not in session:
         return redirect(url_for('login'))
 
-    conn = sqlite3.connect(get_db_path())
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
 
     if request.method == 'POST':
@@ -620,26 +3520,25 @@ def edit_payment(payment_id):
 
         image_filename = None
         if device_image and device_image.filename != '':
-            filename = secure_filename(device_image.filename)
-            image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            device_image.save(image_path)
-            image_filename = filename
-
-            # Update with new image and other fields
-            c.execute('UPDATE payments SET amount_paid = ?, payment_date = ?, device_image = ?, device_description = ? WHERE id = ?',
-                      (float(amount_paid_clean), payment_date, image_filename, device_description, payment_id))
-        else:
-            # Update without changing image
-            c.execute('UPDATE payments SET amount_paid = ?, payment_date = ?, device_description = ? WHERE id = ?',
-                      (float(amount_paid_clean), payment_date, device_description, payment_id))
+            image_filename = store_upload(device_image)
 
-        conn.commit()
-        conn.close()
+        with write_transaction():
+            if image_filename:
+                # Update with new image and other fields
+                c.execute('UPDATE payments SET amount_paid = ?, payment_date = ?, device_image = ?, device_description = ? WHERE id = ?',
+                          (float(amount_paid_clean), payment_date, image_filename, device_description, payment_id))
+            else:
+                # Update without changing image
+                c.execute('UPDATE payments SET amount_paid = ?, payment_date = ?, device_description = ? WHERE id = ?',
+                          (float(amount_paid_clean), payment_date, device_description, payment_id))
+            c.execute('SELECT borrower_id FROM payments WHERE id = ?', (payment_id,))
+            payment = c.fetchone()
+        if payment:
+            data_changed(payment['borrower_id'])
         return redirect(url_for('dashboard'))
 
     c.execute('SELECT * FROM payments WHERE id = ?', (payment_id,))
     payment = c.fetchone()
-    conn.close()
 
     if payment is None:
         return redirect(url_for('dashboard'))
@@ -648,44 +3547,66 @@ def edit_payment(payment_id):
 
 # Route to show loan details with payment history
 @app.route('/loan_status/<int:borrower_id>')
+@cached_page('borrower')
 def loan_status(borrower_id):
     if 'email' not in session:
         return redirect(url_for('login'))
 
-    conn = sqlite3.connect(get_db_path())
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
 
-    c.execute('SELECT * FROM borrowers WHERE id = ?', (borrower_id,))
+    c.execute('''SELECT b.*, bal.total_paid, bal.remaining FROM borrowers b
+                 JOIN balances bal ON bal.borrower_id = b.id WHERE b.id = ?''', (borrower_id,))
     borrower = c.fetchone()
 
     c.execute('SELECT * FROM payments WHERE borrower_id = ? ORDER BY payment_date ASC', (borrower_id,))
     payments = c.fetchall()
 
-    c.execute('SELECT SUM(amount_paid) as total_paid FROM payments WHERE borrower_id = ?', (borrower_id,))
-    total_paid_row = c.fetchone()
-    total_paid = total_paid_row['total_paid'] if total_paid_row['total_paid'] is not None else 0
-
     # Fetch device info for borrower
     c.execute('SELECT * FROM devices WHERE borrower_id = ? ORDER BY device_date DESC LIMIT 1', (borrower_id,))
     device = c.fetchone()
 
-    conn.close()
-
+    archived = False
     if borrower is None:
-        return redirect(url_for('dashboard'))
+        # Settled borrowers moved to the archive keep their history, read-only until restored
+        borrower = archived_borrower(conn, borrower_id)
+        if borrower is None:
+            return redirect(url_for('dashboard'))
+        archived = True
+        c.execute('SELECT * FROM archive.payments WHERE borrower_id = ? ORDER BY payment_date ASC', (borrower_id,))
+        payments = c.fetchall()
+        c.execute('SELECT * FROM archive.devices WHERE borrower_id = ? ORDER BY device_date DESC LIMIT 1',
+                  (borrower_id,))
+        device = c.fetchone()
 
-    remaining = borrower['total_amount'] - total_paid
+    total_paid = borrower['total_paid']
+    remaining = borrower['remaining']
 
-    return render_template('loan_status.html', borrower=borrower, payments=payments, total_paid=total_paid, remaining=remaining, device=device)
+    return render_template('loan_status.html', borrower=borrower, payments=payments, total_paid=total_paid, remaining=remaining, device=device,
+                           archived=archived)
+
+@app.route('/restore_borrower/<int:borrower_id>', methods=['POST'])
+def restore_archived_borrower(borrower_id):
+    if 'email' not in session:
+        return redirect(url_for('login'))
+
+    try:
+        restored = restore_borrower(get_db(), borrower_id)
+    except sqlite3.IntegrityError:
+        flash('❌ يوجد عميل نشط بنفس الاسم، غيّر اسمه ثم أعد المحاولة', 'error')
+        return redirect(url_for('loan_status', borrower_id=borrower_id))
+
+    if not restored:
+        flash('العميل غير موجود في الأرشيف', 'error')
+    return redirect(url_for('loan_status', borrower_id=borrower_id))
 
 @app.route('/device_details/<int:borrower_id>')
+@cached_page('borrower')
 def device_details(borrower_id):
     if 'email' not in session:
         return redirect(url_for('login'))
 
-    conn = sqlite3.connect(get_db_path())
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
 
     c.execute('SELECT * FROM borrowers WHERE id = ?', (borrower_id,))
@@ -694,53 +3615,1113 @@ def device_details(borrower_id):
     c.execute('SELECT * FROM devices WHERE borrower_id = ? ORDER BY device_date DESC', (borrower_id,))
     devices = c.fetchall()
 
-    conn.close()
-
+    archived = False
     if borrower is None:
-        flash('العميل غير موجود', 'error')
-        return redirect(url_for('dashboard'))
+        c.execute('SELECT * FROM archive.borrowers WHERE id = ?', (borrower_id,))
+        borrower = c.fetchone()
+        if borrower is None:
+            flash('العميل غير موجود', 'error')
+            return redirect(url_for('dashboard'))
+        archived = True
+        c.execute('SELECT * FROM archive.devices WHERE borrower_id = ? ORDER BY device_date DESC', (borrower_id,))
+        devices = c.fetchall()
 
-    return render_template('all_devices.html', borrower=borrower, devices=devices)
+    return render_template('all_devices.html', borrower=borrower, devices=devices, archived=archived)
 
 @app.route('/delete_device/<int:device_id>', methods=['POST'])
 def delete_device(device_id):
     if 'email' not in session:
         return redirect(url_for('login'))
 
-    conn = sqlite3.connect(get_db_path())
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+    with write_transaction() as conn:
+        c = conn.cursor()
 
-    # Get borrower_id before deleting the device
-    c.execute('SELECT borrower_id, device_amount FROM devices WHERE id = ?', (device_id,))
-    device = c.fetchone()
+        # Get borrower_id before deleting the device
+        c.execute('SELECT borrower_id, device_amount FROM devices WHERE id = ?', (device_id,))
+        device = c.fetchone()
 
-    if device:
-        borrower_id = device['borrower_id']
-        device_amount = device['device_amount'] or 0
+        if device:
+            borrower_id = device['borrower_id']
+            device_amount = device['device_amount'] or 0
 
-        # Delete the device
-        c.execute('DELETE FROM devices WHERE id = ?', (device_id,))
+            # Delete the device
+            c.execute('DELETE FROM devices WHERE id = ?', (device_id,))
 
-        # Update borrower's total amount by subtracting the deleted device amount
-        c.execute('UPDATE borrowers SET total_amount = total_amount - ? WHERE id = ?', (device_amount, borrower_id))
+            # Update borrower's total amount by subtracting the deleted device amount
+            c.execute('UPDATE borrowers SET total_amount = total_amount - ? WHERE id = ?', (device_amount, borrower_id))
 
-        conn.commit()
+    if device:
+        data_changed(borrower_id)
     else:
         flash('❌ القرض غير موجود', 'error')
 
-    conn.close()
-    
     return redirect(url_for('device_details', borrower_id=borrower_id))
 
+# Full-text search over names, phones, notes and device descriptions
+# The templates folder ships without a search page, so it is rendered from this inline template
+SEARCH_PAGE = '''<!DOCTYPE html>
+<html lang="ar" dir="rtl">
+<head>
+<meta charset="utf-8">
+<title>البحث</title>
+<style>
+body { font-family: sans-serif; margin: 2em; }
+table { border-collapse: collapse; width: 100%; }
+th, td { border-bottom: 1px solid #ddd; padding: .4em; text-align: right; vertical-align: top; }
+mark { background: #ffe58a; }
+.archived { color: #777; }
+</style>
+</head>
+<body>
+<p><a href="{{ url_for('dashboard') }}">لوحة التحكم</a></p>
+<h1>البحث</h1>
+<form method="get" action="{{ url_for('search_page') }}">
+<input type="search" name="q" value="{{ query }}" autofocus>
+<button type="submit">بحث</button>
+</form>
+{% if query and not results %}
+<p>لا توجد نتائج{% if query|length < min_term %} - اكتب {{ min_term }} أحرف على الأقل{% endif %}</p>
+{% elif results %}
+<table>
+<tr><th>الاسم</th><th>الهاتف</th><th>المتبقي</th><th>المطابقات</th></tr>
+{% for result in results %}
+<tr{% if result.archived %} class="archived"{% endif %}>
+<td><a href="{{ url_for('loan_status', borrower_id=result.id) }}">{{ result.name }}</a>{% if result.archived %} (مؤرشف){% endif %}</td>
+<td>{{ result.number_phone }}</td>
+<td>{{ result.remaining|format_number }}</td>
+<td>{% for match in result.matches %}<div>{{ match.snippet }}</div>{% endfor %}</td>
+</tr>
+{% endfor %}
+</table>
+{% endif %}
+</body>
+</html>'''
+
+@app.route('/search')
+def search_page():
+    if 'email' not in session:
+        return redirect(url_for('login'))
+
+    query = request.args.get('q', '').strip()
+    results = search_borrowers(get_db(), query) if query else []
+    return render_template_string(SEARCH_PAGE, query=query, results=results, min_term=SEARCH_MIN_TERM)
+
+# Debt aging and monthly lending/collections, read from the trigger-maintained rollups.
+# The templates folder ships without a reports page, so it is rendered from this inline template
+REPORTS_PAGE = '''<!DOCTYPE html>
+<html lang="ar" dir="rtl">
+<head>
+<meta charset="utf-8">
+<title>التقارير</title>
+<style>
+body { font-family: sans-serif; margin: 2em; }
+table { border-collapse: collapse; margin-bottom: 2em; }
+th, td { border-bottom: 1px solid #ddd; padding: .4em .8em; text-align: right; }
+</style>
+</head>
+<body>
+<p><a href="{{ url_for('dashboard') }}">لوحة التحكم</a></p>
+<h1>التقارير</h1>
+<h2>أعمار الديون (بالأيام منذ آخر دفعة)</h2>
+<table>
+<tr><th>الفترة</th><th>عدد العملاء</th><th>المتبقي</th></tr>
+{% for bucket in aging %}
+<tr><td>{{ 'غير معروف' if bucket.bucket == 'unknown' else bucket.bucket }}</td><td>{{ bucket.borrowers }}</td><td>{{ bucket.remaining|format_number }}</td></tr>
+{% endfor %}
+</table>
+<h2>متأخرون عن الدفع أكثر من {{ days }} يوم</h2>
+<form method="get" action="{{ url_for('reports_page') }}">
+<input type="number" name="days" min="1" value="{{ days }}">
+<button type="submit">عرض</button>
+</form>
+<table>
+<tr><th>الاسم</th><th>الهاتف</th><th>المتبقي</th><th>منذ</th><th>الأيام</th></tr>
+{% for borrower in overdue %}
+<tr><td><a href="{{ url_for('loan_status', borrower_id=borrower.id) }}">{{ borrower.name }}</a></td>
+<td>{{ borrower.number_phone }}</td><td>{{ borrower.remaining|format_number }}</td>
+<td>{{ borrower.since }}</td><td>{{ borrower.days }}</td></tr>
+{% else %}
+<tr><td colspan="5">لا يوجد</td></tr>
+{% endfor %}
+</table>
+<h2>الإقراض والتحصيل الشهري</h2>
+<table>
+<tr><th>الشهر</th><th>المُقرض</th><th>عدد القروض</th><th>المُحصّل</th><th>عدد الدفعات</th></tr>
+{% for month in monthly %}
+<tr><td>{{ month.month }}</td><td>{{ month.lent|format_number }}</td><td>{{ month.loan_count }}</td>
+<td>{{ month.collected|format_number }}</td><td>{{ month.payment_count }}</td></tr>
+{% endfor %}
+</table>
+</body>
+</html>'''
+
+@app.route('/reports')
+def reports_page():
+    if 'email' not in session:
+        return redirect(url_for('login'))
+
+    try:
+        days = int(request.args.get('days', 90))
+    except ValueError:
+        days = 90
+    conn = get_db()
+    today = datetime.now().strftime('%Y-%m-%d')
+    return render_template_string(REPORTS_PAGE, today=today, days=days,
+                           aging=aging_report(conn, today),
+                           overdue=overdue_borrowers(conn, days, today),
+                           monthly=monthly_report(conn))
+
+# Bulk import of a CSV file of borrowers, loans or payments
+@app.route('/import', methods=['POST'])
+def import_data():
+    if 'email' not in session:
+        return redirect(url_for('login'))
+
+    kind = request.form.get('kind', '').strip()
+    upload = request.files.get('file')
+    if kind not in IMPORT_COLUMNS or not upload or upload.filename == '':
+        return jsonify({'error': 'يرجى ملء جميع الحقول المطلوبة'}), 400
+
+    report = import_csv(get_db(), kind, io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline=''))
+    report['error_count'] = len(report['errors'])
+    report['errors'] = report['errors'][:500]
+    return jsonify(report)
+
+# Stream an export of borrowers, payments or devices as CSV or XLSX
+@app.route('/export/<dataset>.<fmt>')
+def export_data(dataset, fmt):
+    if 'email' not in session:
+        return redirect(url_for('login'))
+    if dataset not in EXPORTS or fmt not in ('csv', 'xlsx'):
+        abort(404)
+
+    borrower_id = request.args.get('borrower_id', '').strip()
+    sql, params = export_query(dataset,
+                               date_from=request.args.get('date_from', '').strip() or None,
+                               date_to=request.args.get('date_to', '').strip() or None,
+                               borrower_id=int(borrower_id) if borrower_id.isdigit() else None)
+    columns = EXPORTS[dataset]['columns']
+    batches = iter_export_rows(sql, params)
+    stamp = datetime.now().strftime('%Y%m%d')
+
+    if fmt == 'xlsx':
+        body = generate_xlsx(dataset, columns, batches)
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        filename = f'{dataset}-{stamp}.xlsx'
+    else:
+        body = generate_csv(columns, batches)
+        mimetype = 'text/csv'
+        filename = f'{dataset}-{stamp}.csv'
+        if request.args.get('gzip') == '1':
+            body = gzip_chunks(body)
+            mimetype = 'application/gzip'
+            filename += '.gz'
+
+    response = Response(body, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+# Uploaded images and their thumbnails, which live outside static/ in the packaged build
+@app.route('/uploads/<path:filename>')
+def uploaded_file(filename):
+    if 'email' not in session:
+        return redirect(url_for('login'))
+    response = send_from_directory(os.path.abspath(app.config['UPLOAD_FOLDER']), filename)
+    # Stored names are content hashes, so a name never changes content; older uploads revalidate
+    if _IMMUTABLE_UPLOAD.match(filename):
+        response.headers['Cache-Control'] = f'private, max-age={ASSET_MAX_AGE}, immutable'
+    return response
+
+@app.route('/cache_stats')
+def cache_stats():
+    if 'email' not in session:
+        return redirect(url_for('login'))
+    return jsonify(page_cache.stats())
+
+# Request and SQL metrics, served in Prometheus text format on /metrics
+# Statements slower than SLOW_QUERY_MS are appended to SLOW_QUERY_LOG when it names a file
+app.config['SLOW_QUERY_LOG'] = None
+app.config['SLOW_QUERY_MS'] = 100
+
+class Histogram:
+    """ Thread-safe Prometheus histogram with fixed buckets, optionally split by one label """
+
+    def __init__(self, name, help_text, buckets, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label = label
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted(self._series.items(), key=lambda item: item[0] or '')
+            series = [(label_value, list(counts), total, count) for label_value, (counts, total, count) in series]
+        for label_value, counts, total, count in series:
+            labels = f'{self.label}="{_metric_label(label_value)}",' if self.label else ''
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{{{labels}le="{bound:g}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels}le="+Inf"}} {count}')
+            suffix = '{' + labels.rstrip(',') + '}' if labels else ''
+            lines.append(f'{self.name}_sum{suffix} {total:.6f}')
+            lines.append(f'{self.name}_count{suffix} {count}')
+        return lines
+
+def _metric_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+REQUEST_SECONDS = Histogram('loan_request_duration_seconds', 'Time spent handling a request.',
+                            (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10), label='endpoint')
+REQUEST_SQL_SECONDS = Histogram('loan_request_sql_seconds', 'Time spent in SQLite while handling a request.',
+                                (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5), label='endpoint')
+REQUEST_QUERIES = Histogram('loan_request_queries', 'SQL statements run while handling a request.',
+                            (0, 1, 2, 5, 10, 20, 50, 100, 250), label='endpoint')
+REQUEST_ROWS = Histogram('loan_request_rows', 'Rows fetched from SQLite while handling a request.',
+                         (0, 1, 10, 100, 1000, 10000, 100000), label='endpoint')
+STATEMENT_SECONDS = Histogram('loan_sql_statement_duration_seconds', 'Execution and fetch time of one SQL statement.',
+                              (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+METRICS = (REQUEST_SECONDS, REQUEST_SQL_SECONDS, REQUEST_QUERIES, REQUEST_ROWS, STATEMENT_SECONDS)
+
+_response_counts = {}
+_response_counts_lock = threading.Lock()
+
+slow_query_log = logging.getLogger('loan.slow_queries')
+slow_query_log.propagate = False
+
+def _slow_query_handler(path):
+    """ Point the slow-query logger at path, replacing any previous file """
+    for handler in list(slow_query_log.handlers):
+        if getattr(handler, 'baseFilename', None) == os.path.abspath(path):
+            return
+        slow_query_log.removeHandler(handler)
+        handler.close()
+    handler = logging.FileHandler(path, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    slow_query_log.addHandler(handler)
+    slow_query_log.setLevel(logging.INFO)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    _sql_collector.stats = g.query_stats = QueryStats()
+
+@app.after_request
+def add_server_timing(response):
+    stats = g.get('query_stats')
+    if stats is not None:
+        elapsed = time.perf_counter() - g.request_started
+        response.headers['Server-Timing'] = (f'sql;dur={stats.seconds * 1000:.1f};desc="{stats.count} queries", '
+                                             f'app;dur={elapsed * 1000:.1f}')
+    g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def record_request_metrics(exception):
+    stats = g.pop('query_stats', None)
+    _sql_collector.stats = None
+    if stats is None:
+        return
+    elapsed = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or 'unmatched'
+    REQUEST_SECONDS.observe(elapsed, endpoint)
+    REQUEST_SQL_SECONDS.observe(stats.seconds, endpoint)
+    REQUEST_QUERIES.observe(stats.count, endpoint)
+    REQUEST_ROWS.observe(stats.rows, endpoint)
+    key = (endpoint, str(g.pop('response_status', 500)))
+    with _response_counts_lock:
+        _response_counts[key] = _response_counts.get(key, 0) + 1
+
+    threshold = app.config['SLOW_QUERY_MS'] / 1000
+    log_path = app.config['SLOW_QUERY_LOG']
+    for sql, seconds, rows in stats.statements:
+        STATEMENT_SECONDS.observe(seconds)
+        if log_path and seconds >= threshold:
+            _slow_query_handler(log_path)
+            slow_query_log.info('%.1fms rows=%d endpoint=%s %s', seconds * 1000, rows, endpoint,
+                                ' '.join(sql.split()))
+
+@app.route('/metrics')
+def metrics():
+    # Scrapers on the same machine need no session; anyone else has to be logged in
+    if 'email' not in session and request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(403)
+    lines = []
+    for histogram in METRICS:
+        lines.extend(histogram.render())
+    lines.append('# HELP loan_requests_total Requests handled, by endpoint and status code.')
+    lines.append('# TYPE loan_requests_total counter')
+    with _response_counts_lock:
+        counts = sorted(_response_counts.items())
+    for (endpoint, status), count in counts:
+        lines.append(f'loan_requests_total{{endpoint="{_metric_label(endpoint)}",status="{status}"}} {count}')
+    cache = page_cache.stats()
+    for name in ('hits', 'misses', 'evictions'):
+        lines.append(f'# TYPE loan_page_cache_{name}_total counter')
+        lines.append(f'loan_page_cache_{name}_total {cache[name]}')
+    lines.append('# TYPE loan_page_cache_bytes gauge')
+    lines.append(f"loan_page_cache_bytes {cache['bytes']}")
+    lines.append('# TYPE loan_event_subscribers gauge')
+    lines.append(f"loan_event_subscribers {change_feed.stats()['subscribers']}")
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+# HTTP caching and compression: static URLs carry a content fingerprint and are cached for a year,
+# pages and JSON revalidate against a weak ETag, and text bodies are gzip or brotli encoded
+ASSET_MAX_AGE = 365 * 24 * 3600
+# Bodies smaller than this are sent as they are; compressing them saves less than the headers cost
+app.config['COMPRESS_MIN_SIZE'] = 1024
+app.config['COMPRESS_LEVEL'] = 6
+app.config['COMPRESS_BROTLI_QUALITY'] = 5
+COMPRESS_MIMETYPES = frozenset(('text/html', 'application/json', 'text/plain', 'text/css', 'text/javascript',
+                                'application/javascript', 'image/svg+xml'))
+REVALIDATE_MIMETYPES = frozenset(('text/html', 'application/json'))
+
+_static_versions = {}
+
+def static_version(filename):
+    """ Short content hash of a file in the static folder, rehashed only when its size or mtime changes;
+    None when the file does not exist """
+    path = safe_join(app.static_folder, filename) if filename and app.static_folder else None
+    try:
+        stat = os.stat(path) if path else None
+    except OSError:
+        stat = None
+    if stat is None:
+        return None
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = _static_versions.get(filename)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    version = digest.hexdigest()[:12]
+    _static_versions[filename] = (stamp, version)
+    return version
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    # url_for('static', filename=...) becomes /static/...?v=<hash>, so a changed file gets a new URL
+    if endpoint == 'static' and 'v' not in values:
+        version = static_version(values.get('filename'))
+        if version:
+            values['v'] = version
+
+_brotli = None
+
+def load_brotli():
+    """ Import brotli on first use; False when it is not installed and responses fall back to gzip """
+    global _brotli
+    if _brotli is None:
+        try:
+            import brotli
+            _brotli = brotli
+        except ImportError:
+            _brotli = False
+    return _brotli
+
+def compress_body(data, encoding):
+    if encoding == 'br':
+        return load_brotli().compress(data, quality=app.config['COMPRESS_BROTLI_QUALITY'])
+    compressor = zlib.compressobj(app.config['COMPRESS_LEVEL'], zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+# Registered after add_server_timing, so it runs first and its cost is part of the app timing
+@app.after_request
+def cache_and_compress(response):
+    if request.endpoint == 'static':
+        filename = (request.view_args or {}).get('filename')
+        if response.status_code in (200, 304) and request.args.get('v') and \
+                request.args.get('v') == static_version(filename):
+            response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable'
+        return response
+    # Files, streamed exports and error pages are left alone
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    if (request.method in ('GET', 'HEAD') and response.mimetype in REVALIDATE_MIMETYPES
+            and 'Cache-Control' not in response.headers):
+        # The page is still built (or taken from the page cache), but an unchanged one is not sent again.
+        # The ETag is weak so it stays valid for the compressed and the plain body alike.
+        response.add_etag(weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+
+    if response.mimetype in COMPRESS_MIMETYPES:
+        data = response.get_data()
+        if len(data) >= app.config['COMPRESS_MIN_SIZE']:
+            response.vary.add('Accept-Encoding')
+            encoding = request.accept_encodings.best_match(['br', 'gzip'] if load_brotli() else ['gzip'])
+            if encoding:
+                response.set_data(compress_body(data, encoding))
+                response.headers['Content-Encoding'] = encoding
+    return response
+
+# JSON API (v1): keyset-paginated borrowers, payments and devices
+API_DEFAULT_LIMIT = 50
+API_MAX_LIMIT = 500
+
+API_FIELDS = {
+    'borrowers': ('id', 'name', 'number_phone', 'total_amount', 'notes', 'total_paid', 'remaining',
+                  'last_payment_date', 'payment_count', 'device_count', 'last_device_date'),
+    'payments': ('id', 'borrower_id', 'amount_paid', 'payment_date', 'device_description', 'device_image'),
+    'devices': ('id', 'borrower_id', 'device_description', 'device_image', 'device_date', 'device_amount'),
+}
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+@app.errorhandler(ApiError)
+def handle_api_error(e):
+    return jsonify({'error': e.message}), e.status
+
+def _api_limit():
+    try:
+        limit = int(request.args.get('limit', API_DEFAULT_LIMIT))
+    except ValueError:
+        raise ApiError('limit must be an integer')
+    return min(max(limit, 1), API_MAX_LIMIT)
+
+def _api_fields(resource):
+    """ Fields requested with ?fields=a,b (all fields when absent) """
+    requested = request.args.get('fields', '').strip()
+    if not requested:
+        return API_FIELDS[resource]
+    fields = tuple(field.strip() for field in requested.split(',') if field.strip())
+    unknown = [field for field in fields if field not in API_FIELDS[resource]]
+    if unknown:
+        raise ApiError('unknown field(s): ' + ', '.join(unknown))
+    return fields
+
+def _api_float(name):
+    value = request.args.get(name, '').strip()
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise ApiError(f'{name} must be a number')
+
+def _api_page(rows, resource, limit, cursor_of):
+    """ Build a conditional JSON page; one extra row was fetched to know whether more follow """
+    fields = _api_fields(resource)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    payload = {
+        'data': [{field: row[field] for field in fields} for row in rows],
+        'next': cursor_of(rows[-1]) if has_more else None,
+    }
+    response = jsonify(payload)
+    # Weak, since cache_and_compress may send the same page gzip or brotli encoded
+    response.add_etag(weak=True)
+    return response.make_conditional(request)
+
+def _api_borrower_exists(borrower_id):
+    if get_db().execute('SELECT 1 FROM borrowers WHERE id = ?', (borrower_id,)).fetchone() is None:
+        raise ApiError('borrower not found', 404)
+
+@app.before_request
+def require_api_login():
+    if request.path.startswith('/api/') and 'email' not in session:
+        return jsonify({'error': 'unauthorized'}), 401
+
+@app.route('/api/v1/borrowers')
+def api_borrowers():
+    limit = _api_limit()
+    _api_fields('borrowers')
+    where = []
+    params = []
+
+    after = request.args.get('after', '').strip()
+    if after:
+        if not after.isdigit():
+            raise ApiError('after must be a borrower id')
+        where.append('b.id > ?')
+        params.append(int(after))
+    min_remaining = _api_float('min_remaining')
+    if min_remaining is not None:
+        where.append('bal.remaining >= ?')
+        params.append(min_remaining)
+    max_remaining = _api_float('max_remaining')
+    if max_remaining is not None:
+        where.append('bal.remaining <= ?')
+        params.append(max_remaining)
+    settled = request.args.get('settled', '').strip().lower()
+    if settled in ('1', 'true', 'yes'):
+        where.append('bal.remaining <= 0')
+    elif settled in ('0', 'false', 'no'):
+        where.append('bal.remaining > 0')
+    elif settled:
+        raise ApiError('settled must be true or false')
+
+    sql = '''SELECT b.*, bal.total_paid, bal.remaining, bal.last_payment_date, bal.payment_count,
+                    bal.device_count, bal.last_device_date
+             FROM borrowers b JOIN balances bal ON bal.borrower_id = b.id'''
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    rows = get_db().execute(sql + ' ORDER BY b.id LIMIT ?', params + [limit + 1]).fetchall()
+    return _api_page(rows, 'borrowers', limit, lambda row: str(row['id']))
+
+@app.route('/api/v1/borrowers/<int:borrower_id>/payments')
+def api_borrower_payments(borrower_id):
+    limit = _api_limit()
+    _api_fields('payments')
+    _api_borrower_exists(borrower_id)
+
+    # Cursor is "<payment_date>,<id>" of the last row on the previous page
+    after = request.args.get('after', '').strip()
+    if after:
+        payment_date, _, payment_id = after.rpartition(',')
+        if not payment_id.isdigit():
+            raise ApiError('after must be "<payment_date>,<id>"')
+        rows = get_db().execute('''SELECT * FROM payments WHERE borrower_id = ? AND (payment_date, id) > (?, ?)
+                                   ORDER BY payment_date, id LIMIT ?''',
+                                (borrower_id, payment_date, int(payment_id), limit + 1)).fetchall()
+    else:
+        rows = get_db().execute('SELECT * FROM payments WHERE borrower_id = ? ORDER BY payment_date, id LIMIT ?',
+                                (borrower_id, limit + 1)).fetchall()
+    return _api_page(rows, 'payments', limit, lambda row: f"{row['payment_date']},{row['id']}")
+
+@app.route('/api/v1/borrowers/<int:borrower_id>/devices')
+def api_borrower_devices(borrower_id):
+    limit = _api_limit()
+    _api_fields('devices')
+    _api_borrower_exists(borrower_id)
+
+    after = request.args.get('after', '').strip()
+    if after and not after.isdigit():
+        raise ApiError('after must be a device id')
+    rows = get_db().execute('SELECT * FROM devices WHERE borrower_id = ? AND id > ? ORDER BY id LIMIT ?',
+                            (borrower_id, int(after or 0), limit + 1)).fetchall()
+    return _api_page(rows, 'devices', limit, lambda row: str(row['id']))
+
+@app.route('/api/v1/reports/aging')
+def api_report_aging():
+    try:
+        days = int(request.args.get('days', 90))
+    except ValueError:
+        raise ApiError('days must be an integer')
+    conn = get_db()
+    today = datetime.now().strftime('%Y-%m-%d')
+    return jsonify({'as_of': today, 'buckets': aging_report(conn, today),
+                    'overdue': [dict(row) for row in overdue_borrowers(conn, days, today, _api_limit())]})
+
+@app.route('/api/v1/reports/monthly')
+def api_report_monthly():
+    try:
+        months = min(max(int(request.args.get('months', 24)), 1), 240)
+    except ValueError:
+        raise ApiError('months must be an integer')
+    return jsonify({'months': [dict(row) for row in monthly_report(get_db(), months)]})
+
+@app.route('/api/v1/search')
+def api_search():
+    query = request.args.get('q', '').strip()
+    if not query:
+        raise ApiError('q is required')
+    results = search_borrowers(get_db(), query, min(_api_limit(), 100))
+    for result in results:
+        for match in result['matches']:
+            match['snippet'] = str(match['snippet'])
+    return jsonify({'query': query, 'results': results})
+
+# Background jobs: long operations are queued in the jobs table and run by worker threads, so the
+# request that starts one returns at once. Queued jobs survive a restart; running ones are requeued.
+app.config['JOBS_WORKERS'] = 2           # 0 leaves queued jobs to `flask jobs run`
+app.config['JOBS_POLL_SECONDS'] = 2.0    # how often idle workers look for jobs queued by another process
+app.config['JOBS_RETRY_DELAY'] = 30      # seconds before the first retry, doubled for each further attempt
+app.config['JOBS_KEEP_DAYS'] = 30        # finished jobs (and their export files) are pruned after this
+app.config['EXPORT_FOLDER'] = None       # None keeps exports in exports/ next to the database
+JOB_STATES = ('queued', 'running', 'done', 'failed', 'cancelled')
+# Seconds between progress writes; a job checks for cancellation at the same moments
+JOB_PROGRESS_INTERVAL = 0.5
+
+JOB_KINDS = {}
+
+def job_kind(name, label, priority=0, max_attempts=3):
+    """ Register handler(job) as the job kind name; it runs inside an app context and its
+    JSON-serializable return value is stored as the job result """
+    def decorator(handler):
+        JOB_KINDS[name] = {'handler': handler, 'label': label, 'priority': priority, 'max_attempts': max_attempts}
+        return handler
+    return decorator
+
+class JobCancelled(Exception):
+    """ Raised from Job.progress when the job was cancelled while running """
+
+def _job_time(offset=0):
+    return datetime.fromtimestamp(time.time() + offset).strftime('%Y-%m-%d %H:%M:%S')
+
+class Job:
+    """ A claimed job as its handler sees it: the parameters, progress reporting and cancellation """
+
+    def __init__(self, row, conn):
+        self.id = row['id']
+        self.kind = row['kind']
+        self.params = json.loads(row['params'])
+        self.attempt = row['attempts']
+        self._conn = conn
+        self._reported = 0.0
+
+    def progress(self, done, total=None, message=None):
+        """ Record done of total (or a fraction when total is None) and raise JobCancelled if the job
+        was cancelled. Writes are throttled; never call this inside a write transaction. """
+        now = time.monotonic()
+        if now - self._reported < JOB_PROGRESS_INTERVAL:
+            return
+        self._reported = now
+        fraction = min(1.0, done / total) if total else min(1.0, float(done))
+        with write_transaction(self._conn):
+            self._conn.execute('UPDATE jobs SET progress = ?, message = COALESCE(?, message) WHERE id = ?',
+                               (fraction, message, self.id))
+            cancelled = self._conn.execute('SELECT cancel_requested FROM jobs WHERE id = ?',
+                                           (self.id,)).fetchone()[0]
+        if cancelled:
+            raise JobCancelled()
+
+def enqueue_job(conn, kind, params=None, priority=None, max_attempts=None):
+    """ Queue a job and wake a worker; returns its id. The same kind with the same parameters
+    already waiting in the queue is not added twice. Raises ValueError for an unknown kind. """
+    if kind not in JOB_KINDS:
+        raise ValueError(f'unknown job kind {kind!r}')
+    spec = JOB_KINDS[kind]
+    params = json.dumps(params or {}, sort_keys=True, ensure_ascii=False)
+    with write_transaction(conn):
+        row = conn.execute("SELECT id FROM jobs WHERE state = 'queued' AND kind = ? AND params = ?",
+                           (kind, params)).fetchone()
+        if row is not None:
+            return row['id']
+        now = _job_time()
+        job_id = conn.execute('''INSERT INTO jobs (kind, params, priority, max_attempts, created_at, run_after)
+                                 VALUES (?, ?, ?, ?, ?, ?)''',
+                              (kind, params, spec['priority'] if priority is None else int(priority),
+                               max_attempts or spec['max_attempts'], now, now)).lastrowid
+    job_runner.wake()
+    return job_id
+
+def cancel_job(conn, job_id):
+    """ Cancel a queued job at once, or ask a running one to stop at its next progress report.
+    Returns the job's state afterwards, or None when there is no such job. """
+    with write_transaction(conn):
+        row = conn.execute('SELECT state FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        if row['state'] == 'queued':
+            conn.execute("UPDATE jobs SET state = 'cancelled', finished_at = ? WHERE id = ?", (_job_time(), job_id))
+            return 'cancelled'
+        if row['state'] == 'running':
+            conn.execute('UPDATE jobs SET cancel_requested = 1 WHERE id = ?', (job_id,))
+        return row['state']
+
+def job_dict(row):
+    job = dict(row)
+    job['params'] = json.loads(job['params'])
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    job['cancel_requested'] = bool(job['cancel_requested'])
+    job['label'] = JOB_KINDS[job['kind']]['label'] if job['kind'] in JOB_KINDS else job['kind']
+    return job
+
+def list_jobs(conn, state=None, limit=50):
+    if state:
+        return conn.execute('SELECT * FROM jobs WHERE state = ? ORDER BY id DESC LIMIT ?', (state, limit)).fetchall()
+    return conn.execute('SELECT * FROM jobs ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+
+def requeue_interrupted(conn):
+    """ Queue again the jobs a previous run left running; ones out of attempts or cancelled are closed """
+    now = _job_time()
+    with write_transaction(conn):
+        return conn.execute('''
+            UPDATE jobs SET state = CASE WHEN cancel_requested THEN 'cancelled'
+                                         WHEN attempts >= max_attempts THEN 'failed'
+                                         ELSE 'queued' END,
+                            finished_at = CASE WHEN cancel_requested OR attempts >= max_attempts THEN ? END,
+                            error = CASE WHEN attempts >= max_attempts THEN 'interrupted by a restart' ELSE error END,
+                            run_after = ?, message = 'interrupted by a restart'
+            WHERE state = 'running' ''', (now, now)).rowcount
+
+def prune_jobs(conn, days=None):
+    """ Delete finished jobs older than days, with the files their exports wrote """
+    days = app.config['JOBS_KEEP_DAYS'] if days is None else days
+    cutoff = _job_time(-days * 86400)
+    with write_transaction(conn):
+        rows = conn.execute("SELECT id, kind, result FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?",
+                            (cutoff,)).fetchall()
+        conn.execute('DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?', (cutoff,))
+    for row in rows:
+        if row['kind'] == 'export' and row['result']:
+            path = os.path.join(get_export_folder(), json.loads(row['result'])['file'])
+            if os.path.exists(path):
+                os.remove(path)
+    return len(rows)
+
+class JobRunner:
+    """ Worker threads taking queued jobs in priority order, one at a time each. A failed job is
+    queued again after an exponential delay until it runs out of attempts. """
+
+    def __init__(self):
+        self._threads = []
+        self._wakeup = threading.Condition()
+        self._lock = threading.Lock()
+
+    def wake(self):
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def claim(self, conn):
+        """ Mark the next due job running and return it, or None when nothing is due """
+        with write_transaction(conn):
+            row = conn.execute("""SELECT id FROM jobs WHERE state = 'queued' AND run_after <= ?
+                                  ORDER BY priority DESC, run_after, id LIMIT 1""", (_job_time(),)).fetchone()
+            if row is None:
+                return None
+            conn.execute('''UPDATE jobs SET state = 'running', attempts = attempts + 1, started_at = ?,
+                                            progress = 0, message = NULL WHERE id = ?''', (_job_time(), row['id']))
+            return Job(conn.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone(), conn)
+
+    def run_job(self, job, conn):
+        """ Run a claimed job to its next state: done, failed, cancelled or queued for a retry """
+        spec = JOB_KINDS.get(job.kind)
+        try:
+            if spec is None:
+                raise ValueError(f'unknown job kind {job.kind!r}')
+            with app.app_context():
+                result = spec['handler'](job)
+        except JobCancelled:
+            state, values = 'cancelled', {}
+        except Exception as e:
+            app.logger.error('Job %s (%s) failed on attempt %s: %s', job.id, job.kind, job.attempt, e)
+            row = conn.execute('SELECT max_attempts, cancel_requested FROM jobs WHERE id = ?', (job.id,)).fetchone()
+            if spec is not None and job.attempt < row['max_attempts'] and not row['cancel_requested']:
+                delay = app.config['JOBS_RETRY_DELAY'] * 2 ** (job.attempt - 1)
+                state, values = 'queued', {'error': str(e), 'run_after': _job_time(delay)}
+            else:
+                state, values = 'failed', {'error': str(e)}
+        else:
+            state, values = 'done', {'result': json.dumps(result, ensure_ascii=False), 'progress': 1, 'error': None}
+        if state != 'queued':
+            values['finished_at'] = _job_time()
+        assignments = ', '.join(f'{column} = ?' for column in values)
+        with write_transaction(conn):
+            conn.execute(f"UPDATE jobs SET state = ?{', ' + assignments if assignments else ''} WHERE id = ?",
+                         (state, *values.values(), job.id))
+        return state
+
+    def work(self, conn):
+        """ Run due jobs until none is left; returns how many ran """
+        count = 0
+        while True:
+            job = self.claim(conn)
+            if job is None:
+                break
+            self.run_job(job, conn)
+            count += 1
+        return count
+
+    def _worker(self):
+        conn = get_pool().connect()
+        while True:
+            try:
+                self.work(conn)
+            except Exception as e:
+                app.logger.error('Job worker error: %s', e)
+            with self._wakeup:
+                self._wakeup.wait(app.config['JOBS_POLL_SECONDS'])
+
+    def start(self):
+        """ Requeue interrupted jobs, prune old ones and start the workers, once """
+        with self._lock:
+            if self._threads or app.config['JOBS_WORKERS'] <= 0:
+                return
+            conn = get_pool().connect()
+            try:
+                requeued = requeue_interrupted(conn)
+                if requeued:
+                    app.logger.warning('Requeued %d job(s) interrupted by a restart', requeued)
+                prune_jobs(conn)
+            finally:
+                conn.close()
+            for n in range(app.config['JOBS_WORKERS']):
+                thread = threading.Thread(target=self._worker, name=f'jobs-{n}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+job_runner = JobRunner()
+
+def get_export_folder():
+    return app.config['EXPORT_FOLDER'] or os.path.join(os.path.dirname(os.path.abspath(app.config['DATABASE'])),
+                                                       'exports')
+
+@job_kind('rebuild-balances', 'إعادة حساب الأرصدة', priority=5)
+def job_rebuild_balances(job):
+    conn = get_db()
+    drift = verify_balances(conn)
+    job.progress(0.5, message=f'{len(drift)} drifted value(s)')
+    rebuild_balances(conn)
+    data_changed()
+    return {'corrected': len(drift)}
+
+@job_kind('rebuild-reports', 'إعادة بناء التقارير', priority=5)
+def job_rebuild_reports(job):
+    conn = get_db()
+    drift = verify_reports(conn)
+    job.progress(0.5, message=f'{len(drift)} drifted value(s)')
+    rebuild_reports(conn)
+    data_changed()
+    return {'corrected': len(drift)}
+
+@job_kind('rebuild-search', 'إعادة بناء فهرس البحث', priority=5)
+def job_rebuild_search(job):
+    rebuild_search(get_db())
+    return {}
+
+@job_kind('integrity-check', 'فحص سلامة قاعدة البيانات')
+def job_integrity_check(job):
+    result = check_integrity()
+    conn = get_db()
+    job.progress(0.5)
+    return {'ok': result == ['ok'], 'errors': result if result != ['ok'] else [],
+            'balance_drift': len(verify_balances(conn)), 'summary_drift': len(verify_summary(conn))}
+
+@job_kind('thumbnails', 'إنشاء الصور المصغرة', priority=-5)
+def job_thumbnails(job):
+    if load_pillow()[0] is None:
+        return {'images': 0, 'error': 'Pillow is not installed'}
+    upload_dir = app.config['UPLOAD_FOLDER']
+    names = [name for name in (os.listdir(upload_dir) if os.path.isdir(upload_dir) else [])
+             if _HASHED_NAME.match(name) and any(
+                 not os.path.exists(os.path.join(upload_dir, variant_filename(name, variant)))
+                 for variant in IMAGE_VARIANTS)]
+    for done, name in enumerate(names):
+        job.progress(done, len(names), name)
+        generate_thumbnails(name)
+    return {'images': len(names)}
+
+@job_kind('export', 'تصدير البيانات', max_attempts=2)
+def job_export(job):
+    """ Write an export to the export folder; the status page links to it once done """
+    dataset = job.params.get('dataset')
+    fmt = job.params.get('fmt', 'csv')
+    if dataset not in EXPORTS or fmt not in ('csv', 'xlsx'):
+        raise ValueError(f'cannot export {dataset!r} as {fmt!r}')
+    borrower_id = str(job.params.get('borrower_id') or '')
+    sql, params = export_query(dataset, date_from=job.params.get('date_from') or None,
+                               date_to=job.params.get('date_to') or None,
+                               borrower_id=int(borrower_id) if borrower_id.isdigit() else None)
+    total = get_db().execute(f'SELECT COUNT(*) FROM ({sql})', params).fetchone()[0]
+    written = 0
+
+    def batches():
+        nonlocal written
+        for rows in iter_export_rows(sql, params):
+            written += len(rows)
+            yield rows
+            job.progress(written, total)
+
+    columns = EXPORTS[dataset]['columns']
+    body = generate_xlsx(dataset, columns, batches()) if fmt == 'xlsx' else generate_csv(columns, batches())
+    folder = get_export_folder()
+    os.makedirs(folder, exist_ok=True)
+    filename = f"{dataset}-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{job.id}.{fmt}"
+    temp_path = os.path.join(folder, '.' + filename + '.tmp')
+    try:
+        with open(temp_path, 'wb') as f:
+            for chunk in body:
+                f.write(chunk)
+        os.replace(temp_path, os.path.join(folder, filename))
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return {'file': filename, 'rows': written}
+
+@job_kind('archive', 'أرشفة العملاء المسددين', priority=-5)
+def job_archive(job):
+    days = job.params.get('days')
+    conn = get_db()
+    archived = archive_settled(conn, days=int(days) if str(days or '').isdigit() else None)
+    job.progress(0.5)
+    return {'archived': len(archived), 'freed_pages': reclaim_space(conn)}
+
+@job_kind('backup', 'نسخة احتياطية', priority=10, max_attempts=2)
+def job_backup(job):
+    return {'stamp': create_backup()}
+
+JOBS_PAGE = '''<!DOCTYPE html>
+<html lang="ar" dir="rtl">
+<head>
+<meta charset="utf-8">
+<title>المهام</title>
+{% if busy %}<meta http-equiv="refresh" content="3">{% endif %}
+<style>
+body { font-family: sans-serif; margin: 2em; }
+table { border-collapse: collapse; width: 100%; }
+th, td { border-bottom: 1px solid #ddd; padding: .4em; text-align: right; }
+progress { width: 8em; }
+.failed { color: #b00; }
+</style>
+</head>
+<body>
+<p><a href="{{ url_for('dashboard') }}">لوحة التحكم</a></p>
+{% for category, message in get_flashed_messages(with_categories=true) %}<p class="{{ category }}">{{ message }}</p>{% endfor %}
+<h1>المهام</h1>
+<form method="post" action="{{ url_for('start_job') }}">
+<select name="kind">{% for name, spec in kinds.items() %}<option value="{{ name }}">{{ spec.label }}</option>{% endfor %}</select>
+<select name="dataset">{% for name in datasets %}<option value="{{ name }}">{{ name }}</option>{% endfor %}</select>
+<select name="fmt"><option value="csv">CSV</option><option value="xlsx">XLSX</option></select>
+<button type="submit">تشغيل</button>
+</form>
+<table>
+<tr><th>#</th><th>المهمة</th><th>الحالة</th><th>التقدم</th><th>المحاولات</th><th>أُنشئت</th><th>انتهت</th><th></th></tr>
+{% for job in jobs %}
+<tr>
+<td>{{ job.id }}</td>
+<td>{{ job.label }}</td>
+<td class="{{ job.state }}">{{ states[job.state] }}{% if job.error %} — {{ job.error }}{% endif %}</td>
+<td><progress value="{{ job.progress }}" max="1"></progress> {{ job.message or '' }}</td>
+<td>{{ job.attempts }}/{{ job.max_attempts }}</td>
+<td>{{ job.created_at }}</td>
+<td>{{ job.finished_at or '' }}</td>
+<td>{% if job.state in ('queued', 'running') and not job.cancel_requested %}
+<form method="post" action="{{ url_for('cancel_job_view', job_id=job.id) }}"><button type="submit">إلغاء</button></form>
+{% elif job.state == 'done' and job.kind == 'export' %}<a href="{{ url_for('download_job_file', job_id=job.id) }}">تنزيل</a>{% endif %}</td>
+</tr>
+{% endfor %}
+</table>
+</body>
+</html>'''
+JOB_STATE_LABELS = {'queued': 'في الانتظار', 'running': 'قيد التنفيذ', 'done': 'تمت',
+                    'failed': 'فشلت', 'cancelled': 'أُلغيت'}
+
+@app.route('/jobs')
+def jobs_page():
+    if 'email' not in session:
+        return redirect(url_for('login'))
+    jobs = [job_dict(row) for row in list_jobs(get_db())]
+    return render_template_string(JOBS_PAGE, jobs=jobs, kinds=JOB_KINDS, datasets=sorted(EXPORTS),
+                                  states=JOB_STATE_LABELS,
+                                  busy=any(job['state'] in ('queued', 'running') for job in jobs))
+
+@app.route('/jobs', methods=['POST'])
+def start_job():
+    if 'email' not in session:
+        return redirect(url_for('login'))
+    kind = request.form.get('kind', '').strip()
+    params = {key: value.strip() for key, value in request.form.items()
+              if key not in ('kind', 'priority') and value.strip()}
+    if kind != 'export':
+        params.pop('dataset', None)
+        params.pop('fmt', None)
+    priority = request.form.get('priority', '').strip()
+    try:
+        job_id = enqueue_job(get_db(), kind, params, int(priority) if priority.lstrip('-').isdigit() else None)
+    except ValueError:
+        if wants_json():
+            return jsonify({'ok': False, 'errors': ['نوع المهمة غير معروف']}), 400
+        flash('نوع المهمة غير معروف', 'error')
+        return redirect(url_for('jobs_page'))
+    if wants_json():
+        return jsonify({'ok': True, 'id': job_id, 'url': url_for('api_job', job_id=job_id)}), 202
+    return redirect(url_for('jobs_page'))
+
+@app.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+def cancel_job_view(job_id):
+    if 'email' not in session:
+        return redirect(url_for('login'))
+    state = cancel_job(get_db(), job_id)
+    if wants_json():
+        if state is None:
+            return jsonify({'ok': False, 'errors': ['المهمة غير موجودة']}), 404
+        return jsonify({'ok': True, 'state': state})
+    if state is None:
+        flash('المهمة غير موجودة', 'error')
+    return redirect(url_for('jobs_page'))
+
+@app.route('/jobs/<int:job_id>/download')
+def download_job_file(job_id):
+    if 'email' not in session:
+        return redirect(url_for('login'))
+    row = get_db().execute("SELECT result FROM jobs WHERE id = ? AND kind = 'export' AND state = 'done'",
+                           (job_id,)).fetchone()
+    if row is None:
+        abort(404)
+    return send_from_directory(get_export_folder(), json.loads(row['result'])['file'], as_attachment=True)
+
+@app.route('/api/v1/jobs')
+def api_jobs():
+    state = request.args.get('state', '').strip()
+    if state and state not in JOB_STATES:
+        raise ApiError('state must be one of ' + ', '.join(JOB_STATES))
+    return jsonify({'data': [job_dict(row) for row in list_jobs(get_db(), state or None, _api_limit())]})
+
+@app.route('/api/v1/jobs/<int:job_id>')
+def api_job(job_id):
+    row = get_db().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    if row is None:
+        raise ApiError('job not found', 404)
+    return jsonify(job_dict(row))
+
+@app.cli.group()
+def jobs():
+    """ Queue, list, cancel and run background jobs """
+
+@jobs.command('enqueue')
+@click.argument('kind', type=click.Choice(sorted(JOB_KINDS)))
+@click.option('--param', 'params', multiple=True, metavar='KEY=VALUE', help='Job parameter, repeatable.')
+@click.option('--priority', type=int, default=None, help='Higher runs first.')
+def jobs_enqueue(kind, params, priority):
+    """ Queue a job for the server's workers """
+    values = dict(param.split('=', 1) for param in params if '=' in param)
+    click.echo(f'Queued job {enqueue_job(get_db(), kind, values, priority)}')
+
+@jobs.command('list')
+@click.option('--state', type=click.Choice(JOB_STATES), default=None)
+def jobs_list(state):
+    """ Show the latest jobs """
+    for row in list_jobs(get_db(), state):
+        job = job_dict(row)
+        click.echo(f"{job['id']:6d} {job['kind']:18s} {job['state']:9s} {job['progress'] * 100:5.0f}% "
+                   f"{job['attempts']}/{job['max_attempts']} {job['created_at']} {job['error'] or ''}")
+
+@jobs.command('cancel')
+@click.argument('job_id', type=int)
+def jobs_cancel(job_id):
+    """ Cancel a queued job or stop a running one """
+    state = cancel_job(get_db(), job_id)
+    click.echo(f'Job {job_id}: ' + (state or 'not found'))
+
+@jobs.command('run')
+def jobs_run():
+    """ Run every due job in this process, for when the server is not running """
+    count = job_runner.work(get_db())
+    click.echo(f'Ran {count} job(s)')
+
 # Route to update user info (GET and POST)
 @app.route('/update_user', methods=['GET', 'POST'])
 def update_user():
     if 'email' not in session:
         return redirect(url_for('login'))
 
-    conn = sqlite3.connect(get_db_path())
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
 
     message = ''
@@ -760,7 +4741,6 @@ def update_user():
             # Email is required and cannot be empty
             if not email:
                 error = 'البريد الإلكتروني مطلوب'
-                conn.close()
                 return render_template('update_user.html', user=current_user, message=message, error=error)
 
             # Check if email is provided and different from current
@@ -770,7 +4750,6 @@ def update_user():
                 existing_user = c.fetchone()
                 if existing_user:
                     error = 'البريد الإلكتروني مستخدم بالفعل'
-                    conn.close()
                     return render_template('update_user.html', user=current_user, message=message, error=error)
 
             # Check if username is provided and different from current
@@ -780,7 +4759,6 @@ def update_user():
                 existing_user = c.fetchone()
                 if existing_user:
                     error = 'اسم المستخدم مستخدم بالفعل'
-                    conn.close()
                     return render_template('update_user.html', user=current_user, message=message, error=error)
 
             # Update user information
@@ -797,7 +4775,6 @@ def update_user():
                     update_values.append(username)
 
                 if password:
-                    from werkzeug.security import generate_password_hash
                     hashed_password = generate_password_hash(password)
                     update_fields.append('password = ?')
                     update_values.append(hashed_password)
@@ -820,9 +4797,124 @@ def update_user():
     # Get current user data
     c.execute('SELECT * FROM users WHERE email = ?', (session['email'],))
     user = c.fetchone()
-    conn.close()
 
     return render_template('update_user.html', user=user, message=message, error=error)
 
+# Production serving: a bounded, multi-threaded WSGI server instead of the debug server
+app.config['SERVER_HOST'] = '127.0.0.1'
+app.config['SERVER_PORT'] = 5000
+app.config['SERVER_THREADS'] = 8
+app.config['SERVER_CONNECTION_LIMIT'] = 100
+app.config['SERVER_TIMEOUT'] = 30
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """ wsgiref handler that keeps per-request lines out of the console """
+
+    def log_message(self, format, *args):
+        pass
+
+class PooledWSGIServer(WSGIServer):
+    """ Pure-Python WSGI server handing each connection to a fixed pool of worker threads.
+    Connections beyond the limit are answered with 503 instead of queueing without bound. """
+
+    def __init__(self, address, threads, connection_limit, timeout):
+        super().__init__(address, QuietRequestHandler)
+        self.request_timeout = timeout
+        self._workers = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='http')
+        self._slots = threading.BoundedSemaphore(connection_limit)
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(blocking=False):
+            try:
+                request.sendall(b'HTTP/1.0 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n')
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        request.settimeout(self.request_timeout)
+        self._workers.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except (socket.timeout, ConnectionError):
+            pass
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self._workers.shutdown(wait=False)
+
+def serve(host, port, threads, connection_limit, timeout):
+    """ Run the app in production mode: debug off, threaded server, enough pooled connections """
+    app.debug = False
+    app.config['SERVER_THREADS'] = threads
+    app.config['DB_POOL_SIZE'] = max(app.config['DB_POOL_SIZE'], threads)
+    try:
+        import waitress
+    except ImportError:
+        waitress = None
+
+    print(f'Serving on http://{host}:{port} with {threads} threads')
+    if waitress is not None:
+        waitress.serve(app, host=host, port=port, threads=threads,
+                       connection_limit=connection_limit, channel_timeout=timeout)
+        return
+
+    server = PooledWSGIServer((host, port), threads, connection_limit, timeout)
+    server.set_app(app)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+boot.record('module setup', time.perf_counter() - _IMPORTS_DONE)
+
+def profile_startup():
+    """ Run the whole boot sequence in the foreground and print how long each phase took """
+    boot.ensure_database()
+    boot.run_deferred()
+    with boot.phase('first request'):
+        with app.test_request_context('/login'):
+            app.preprocess_request()
+            login()
+    for line in boot.report():
+        print(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Loan Management System')
+    parser.add_argument('--serve', action='store_true',
+                        help='production mode: multi-threaded server with debug disabled')
+    parser.add_argument('--dev', action='store_true', help='debug server with the reloader (default from source)')
+    parser.add_argument('--host', default=app.config['SERVER_HOST'])
+    parser.add_argument('--port', type=int, default=app.config['SERVER_PORT'])
+    parser.add_argument('--threads', type=int, default=app.config['SERVER_THREADS'])
+    parser.add_argument('--connection-limit', type=int, default=app.config['SERVER_CONNECTION_LIMIT'])
+    parser.add_argument('--timeout', type=int, default=app.config['SERVER_TIMEOUT'],
+                        help='seconds before an idle or slow connection is dropped')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='print the duration of each start-up phase and exit')
+    args = parser.parse_args(argv)
+
+    if args.profile_startup:
+        profile_startup()
+        return
+
+    # The packaged executable always serves in production mode
+    if args.serve or (hasattr(sys, '_MEIPASS') and not args.dev):
+        boot.start_deferred()
+        serve(args.host, args.port, args.threads, args.connection_limit, args.timeout)
+    else:
+        # With the reloader only the child process that serves requests does the deferred work
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            boot.start_deferred()
+        app.run(debug=True, host=args.host, port=args.port)
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    main()
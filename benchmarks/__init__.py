@@ -0,0 +1,58 @@
+""" Benchmarks for the loan management app.
+
+Every script here is run as a module from the repository root, so it can share
+the helpers below:
+
+    python -m benchmarks.synthetic users.db --borrowers 10000
+    python -m benchmarks.routes --sizes 1000 10000 100000 --output report.json
+    python -m benchmarks.http_session --borrowers 10000 --visits 5
+    python -m benchmarks.backup_latency --size-mb 1024 --clients 8
+    python -m benchmarks.live_updates --borrowers 10000 --payments 200 --listeners 4
+    python -m benchmarks.job_queue --borrowers 50000 --clients 4
+    python -m benchmarks.bench_connections --requests 2000 --threads 4
+    python -m benchmarks.bench_export --payments 1000000 --budget-mb 32
+    python -m benchmarks.bench_import --payments 100000
+    python -m benchmarks.bench_server --clients 16 --seconds 10
+    python -m benchmarks.bench_startup --runs 5
+    python -m benchmarks.stress_payments --threads 16 --payments 200
+"""
+import os
+import sqlite3
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app(workdir):
+    """ Import the app with its database and uploads inside a scratch directory,
+    while templates and static files still come from the source tree """
+    os.chdir(workdir)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import app as app_module
+    app_module.app.template_folder = os.path.join(ROOT, 'templates')
+    app_module.app.static_folder = os.path.join(ROOT, 'static')
+    app_module.boot.ensure_database()
+    return app_module
+
+
+def use_database(app_module, db_path):
+    """ Point an imported app at another database file, dropping every in-memory view of the old one """
+    app = app_module.app
+    pool = app.extensions.pop('db_pool', None)
+    if pool is not None:
+        pool.close_all()
+    app.config['DATABASE'] = db_path
+    app_module.init_db(db_path)
+    app_module.page_cache.clear()
+    app_module.data_changed()
+    app_module.name_index.reset()
+
+
+def seed(db_path, borrowers, owed=1000.0):
+    """ Add borrowers named 'customer 0' .. 'customer N-1', each owing the same amount """
+    conn = sqlite3.connect(db_path)
+    conn.executemany('INSERT INTO borrowers (name, number_phone, total_amount, notes) VALUES (?, ?, ?, ?)',
+                     ((f'customer {i}', '0770000000', owed, '') for i in range(borrowers)))
+    conn.commit()
+    conn.close()
@@ -0,0 +1,130 @@
+""" Measure request latency while an online backup runs.
+
+Builds a synthetic shop padded to --size-mb, then drives reads (loan status
+pages, API pages) and writes (payments) from several test-client threads,
+first with no backup running and then for as long as create_backup() takes,
+and prints p50/p99/max latency for both phases.
+
+    python -m benchmarks.backup_latency --size-mb 1024 --clients 8
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from benchmarks import load_app, use_database
+from benchmarks.synthetic import generate
+
+
+def pad_database(db_path, size_mb):
+    """ Grow the database to about size_mb with a filler table that compresses like real rows """
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE IF NOT EXISTS bench_padding (id INTEGER PRIMARY KEY, data BLOB)')
+    rng = random.Random(1)
+    row = 1024
+    while os.path.getsize(db_path) < size_mb * 1024 * 1024:
+        conn.executemany('INSERT INTO bench_padding (data) VALUES (?)',
+                         ((rng.randbytes(row // 4) + b'borrower payment device ' * (row * 3 // 4 // 24),)
+                          for _ in range(20000)))
+        conn.commit()
+    conn.close()
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def drive(app, shop, clients, until):
+    """ Run the request mix from clients threads until until() is true; returns (reads, writes) latencies """
+    reads, writes = [], []
+    lock = threading.Lock()
+    heavy = shop['heaviest_borrower']
+
+    def client(n):
+        rng = random.Random(n)
+        test_client = app.test_client()
+        test_client.post('/login', data={'username': 'admin', 'password': '123456'})
+        mine_reads, mine_writes = [], []
+        while not until():
+            if rng.random() < 0.2:
+                start = time.perf_counter()
+                test_client.post('/add_payment', data={'borrower_name': heavy['name'], 'amount_paid': '1',
+                                                       'payment_date': '2025-12-31'})
+                mine_writes.append(time.perf_counter() - start)
+            else:
+                url = (f'/loan_status/{rng.randint(1, shop["borrowers"])}' if rng.random() < 0.5
+                       else f'/api/v1/borrowers?limit=50&after={rng.randint(0, shop["borrowers"])}')
+                start = time.perf_counter()
+                test_client.get(url).get_data()
+                mine_reads.append(time.perf_counter() - start)
+        with lock:
+            reads.extend(mine_reads)
+            writes.extend(mine_writes)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sorted(reads), sorted(writes)
+
+
+def report(label, latencies, seconds):
+    ms = [value * 1000 for value in latencies]
+    print(f'{label:22s} {len(ms) / seconds:8.0f}/s  p50 {percentile(ms, 0.5):7.1f} ms  '
+          f'p99 {percentile(ms, 0.99):7.1f} ms  max {(ms[-1] if ms else 0):7.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=1024, help='database size to back up')
+    parser.add_argument('--borrowers', type=int, default=100000)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10.0, help='length of the phase without a backup')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='loan-bench-')
+    app_module = load_app(workdir)
+    app = app_module.app
+    app.config['DB_POOL_SIZE'] = args.clients
+    db_path = os.path.join(workdir, 'shop.db')
+    app_module.init_db(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    shop = generate(conn, args.borrowers, args.borrowers * 2, args.borrowers * 5, 1.1, 1)
+    conn.close()
+    pad_database(db_path, args.size_mb)
+    use_database(app_module, db_path)
+    print(f'database {os.path.getsize(db_path) / 1e6:.0f} MB, {args.clients} clients')
+
+    deadline = time.perf_counter() + args.seconds
+    reads, writes = drive(app, shop, args.clients, lambda: time.perf_counter() >= deadline)
+    report('reads, no backup', reads, args.seconds)
+    report('writes, no backup', writes, args.seconds)
+
+    done = threading.Event()
+    timing = {}
+
+    def run_backup():
+        start = time.perf_counter()
+        timing['stamp'] = app_module.create_backup()
+        timing['seconds'] = time.perf_counter() - start
+        done.set()
+
+    backup_thread = threading.Thread(target=run_backup)
+    backup_thread.start()
+    reads, writes = drive(app, shop, args.clients, done.is_set)
+    backup_thread.join()
+    report('reads, during backup', reads, timing['seconds'])
+    report('writes, during backup', writes, timing['seconds'])
+    size = sum(os.path.getsize(path) for path in app_module.list_backups()[0][1].values())
+    print(f"backup {timing['stamp']} took {timing['seconds']:.1f}s, {size / 1e6:.0f} MB compressed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+""" Compare requests per second for the pooled connection layer against opening
+a connection per query, using /check_name as the hot request.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_connections --requests 2000 --threads 4
+"""
+import argparse
+import sqlite3
+import tempfile
+import threading
+import time
+
+from benchmarks import load_app, seed
+
+
+
+def register_legacy_route(app_module):
+    """ The check_name view as it was before pooling: connect, query, close """
+    app = app_module.app
+
+    def check_name_legacy():
+        from flask import request, jsonify
+        name = request.args.get('name', '').strip()
+        conn = sqlite3.connect(app.config['DATABASE'])
+        c = conn.cursor()
+        c.execute('SELECT id FROM borrowers WHERE LOWER(TRIM(name)) = LOWER(TRIM(?))', (name,))
+        exists = c.fetchone() is not None
+        conn.close()
+        return jsonify({'exists': exists})
+
+    app.add_url_rule('/_bench/check_name_legacy', 'check_name_legacy', check_name_legacy)
+
+
+def run(app, url, total, threads):
+    per_thread = total // threads
+
+    def worker():
+        client = app.test_client()
+        for i in range(per_thread):
+            client.get(url + str(i % 500))
+
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return per_thread * threads / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--borrowers', type=int, default=1000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='loan-bench-')
+    app_module = load_app(workdir)
+    app = app_module.app
+    seed(app.config['DATABASE'], args.borrowers)
+    register_legacy_route(app_module)
+
+    results = {}
+    results['open per query'] = run(app, '/_bench/check_name_legacy?name=customer ', args.requests, args.threads)
+
+    app.config['DB_POOL_SIZE'] = 0
+    app.extensions.pop('db_pool', None)
+    results['unpooled, PRAGMAs per request'] = run(app, '/check_name?name=customer ', args.requests, args.threads)
+
+    app.config['DB_POOL_SIZE'] = max(args.threads, 1)
+    app.extensions.pop('db_pool', None)
+    results['pooled'] = run(app, '/check_name?name=customer ', args.requests, args.threads)
+
+    print(f'{args.requests} requests, {args.threads} threads, {args.borrowers} borrowers')
+    for label, rps in results.items():
+        print(f'  {label:32s} {rps:10.1f} req/s')
+
+
+if __name__ == '__main__':
+    main()
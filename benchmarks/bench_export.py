@@ -0,0 +1,91 @@
+""" Export a large synthetic payments table through /export and check that the
+process's peak memory stays within a fixed budget.
+
+On Linux the budget applies to anonymous RSS (RssAnon), sampled after every
+chunk, so pages of the database file that SQLite memory-maps are not counted.
+Elsewhere it falls back to the growth of peak RSS.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_export --payments 1000000 --budget-mb 32
+"""
+import argparse
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+
+from benchmarks import load_app
+
+
+
+def rss_mb():
+    """ Anonymous RSS when /proc is available, otherwise peak RSS """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('RssAnon:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def seed_payments(db_path, borrowers, payments):
+    """ Generate the rows inside SQLite so seeding does not inflate this process's memory """
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < ?)
+        INSERT INTO borrowers (name, number_phone, total_amount, notes)
+        SELECT 'customer ' || n, '0770' || n, 1000000000, '' FROM seq
+    ''', (borrowers,))
+    conn.execute('''
+        WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < ?)
+        INSERT INTO payments (borrower_id, amount_paid, payment_date, device_description)
+        SELECT 1 + n % ?, 1000 + n % 97, date('2020-01-01', '+' || (n % 2000) || ' days'), 'payment ' || n FROM seq
+    ''', (payments, borrowers))
+    conn.commit()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--payments', type=int, default=1000000)
+    parser.add_argument('--borrowers', type=int, default=10000)
+    parser.add_argument('--format', choices=('csv', 'xlsx'), default='csv')
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--budget-mb', type=float, default=32.0,
+                        help='allowed memory growth while exporting')
+    args = parser.parse_args()
+
+    app_module = load_app(tempfile.mkdtemp(prefix='loan-bench-'))
+    app = app_module.app
+    seed_payments(app.config['DATABASE'], args.borrowers, args.payments)
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': '123456'})
+    url = f'/export/payments.{args.format}' + ('?gzip=1' if args.gzip else '')
+
+    baseline = peak = rss_mb()
+    start = time.perf_counter()
+    response = client.get(url, buffered=False)
+    size = 0
+    for chunk in response.response:
+        size += len(chunk)
+        peak = max(peak, rss_mb())
+    response.close()
+    elapsed = time.perf_counter() - start
+    growth = peak - baseline
+
+    print(f'exported {args.payments} payments as {args.format}{" (gzip)" if args.gzip else ""}: '
+          f'{size / 1e6:.1f} MB in {elapsed:.1f}s')
+    print(f'peak memory growth {growth:.1f} MB (budget {args.budget_mb:.0f} MB)')
+    if growth > args.budget_mb:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+""" Time the bulk CSV import of a large synthetic payments file.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_import --payments 100000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks import load_app, seed
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--payments', type=int, default=100000)
+    parser.add_argument('--borrowers', type=int, default=5000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='loan-bench-')
+    app_module = load_app(workdir)
+    app = app_module.app
+
+    seed(app.config['DATABASE'], args.borrowers, 1e9)
+
+    path = os.path.join(workdir, 'payments.csv')
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write('borrower_name,amount_paid,payment_date\n')
+        for i in range(args.payments):
+            f.write(f'customer {i % args.borrowers},{1000 + i % 97},2024-{1 + i % 12:02d}-{1 + i % 28:02d}\n')
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': '123456'})
+    start = time.perf_counter()
+    with open(path, 'rb') as f:
+        response = client.post('/import', data={'kind': 'payments', 'file': (f, 'payments.csv')},
+                               content_type='multipart/form-data')
+    elapsed = time.perf_counter() - start
+    report = response.get_json()
+
+    print(f"imported {report['imported']} payments ({report['error_count']} rejected) in {elapsed:.2f}s "
+          f"= {report['imported'] / elapsed:,.0f} rows/s")
+
+
+if __name__ == '__main__':
+    main()
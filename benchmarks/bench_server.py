@@ -0,0 +1,110 @@
+""" Measure startup time and concurrent throughput of the debug server against
+the production serve mode (python app.py --serve).
+
+Run from the repository root:
+
+    python -m benchmarks.bench_server --clients 16 --seconds 10
+"""
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from benchmarks import ROOT
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start(mode_args, port, workdir):
+    """ Launch the app and return (process, seconds until it answered a request) """
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'app.py'), '--port', str(port)] + mode_args,
+                               cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               start_new_session=True)
+    url = f'http://127.0.0.1:{port}/check_name?name=x'
+    while True:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return process, time.perf_counter() - started
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError('server exited during startup')
+            time.sleep(0.01)
+
+
+def stop(process):
+    os.killpg(process.pid, signal.SIGTERM)
+    process.wait()
+
+
+def load(port, clients, seconds):
+    """ Hammer /check_name from several threads; return (requests/s, p50 ms, p99 ms, errors) """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def client(n):
+        mine = []
+        i = 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                urllib.request.urlopen(f'http://127.0.0.1:{port}/check_name?name=customer+{n}-{i}', timeout=10).read()
+                mine.append(time.perf_counter() - start)
+            except OSError:
+                with lock:
+                    errors[0] += 1
+            i += 1
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    latencies.sort()
+    if not latencies:
+        return 0.0, 0.0, 0.0, errors[0]
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    return len(latencies) / seconds, p50, p99, errors[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--threads', type=int, default=8, help='server threads in --serve mode')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='loan-bench-')
+    modes = {
+        'debug server (app.run)': ['--dev'],
+        'production (--serve)': ['--serve', '--threads', str(args.threads)],
+    }
+    for label, mode_args in modes.items():
+        port = free_port()
+        process, startup = start(mode_args, port, workdir)
+        try:
+            rps, p50, p99, errors = load(port, args.clients, args.seconds)
+        finally:
+            stop(process)
+        print(f'{label:24s} startup {startup * 1000:7.0f} ms  {rps:8.1f} req/s  '
+              f'p50 {p50:6.1f} ms  p99 {p99:6.1f} ms  errors {errors}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+""" Measure cold and warm start of the app: the per-phase start-up profile
+(python app.py --profile-startup) and the time until the production server
+answers its first request.
+
+A cold start runs in an empty directory, so the database is created and
+migrated; a warm start reuses the directory of the previous run.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_startup --runs 5
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from benchmarks import ROOT
+from benchmarks.bench_server import free_port, start, stop
+
+PHASE_LINE = re.compile(r'^(.+?)\s+([\d.]+) ms')
+
+
+def make_workdir():
+    """ Empty directory with the source tree's templates and static files linked in """
+    workdir = tempfile.mkdtemp(prefix='loan-bench-')
+    for name in ('templates', 'static'):
+        if os.path.isdir(os.path.join(ROOT, name)):
+            os.symlink(os.path.join(ROOT, name), os.path.join(workdir, name))
+    return workdir
+
+
+def profile(workdir):
+    """ Phase durations in ms reported by one --profile-startup run """
+    output = subprocess.run([sys.executable, os.path.join(ROOT, 'app.py'), '--profile-startup'],
+                            cwd=workdir, capture_output=True, text=True, check=True).stdout
+    phases = {}
+    for line in output.splitlines():
+        match = PHASE_LINE.match(line)
+        if match:
+            phases[match.group(1).strip()] = float(match.group(2))
+    return phases
+
+
+def first_response(workdir):
+    """ Seconds from launching --serve until the first request is answered """
+    process, seconds = start(['--serve'], free_port(), workdir)
+    stop(process)
+    return seconds
+
+
+def median_phases(runs):
+    names = list(runs[0])
+    return {name: statistics.median(run.get(name, 0.0) for run in runs) for name in names}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    cold, warm = [], []
+    cold_serve, warm_serve = [], []
+    for _ in range(args.runs):
+        workdir = make_workdir()
+        cold.append(profile(workdir))
+        warm.append(profile(workdir))
+        cold_serve.append(first_response(make_workdir()))
+        warm_serve.append(first_response(workdir))
+
+    cold, warm = median_phases(cold), median_phases(warm)
+    print(f"{'phase (median ms)':24s} {'cold':>9s} {'warm':>9s}")
+    for name in cold:
+        print(f'{name:24s} {cold[name]:9.1f} {warm.get(name, 0.0):9.1f}')
+    print(f"{'first response (--serve)':24s} {statistics.median(cold_serve) * 1000:9.1f} "
+          f'{statistics.median(warm_serve) * 1000:9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+""" Replay a typical dashboard session through Flask's test client, once with the
+HTTP caching and compression hooks switched off and once with them on, and
+report bytes on the wire and latency for a first visit and for repeat visits.
+
+    python -m benchmarks.http_session --borrowers 10000 --visits 5
+
+The client behaves like a browser: it asks for gzip (and brotli), keeps every
+response with its validators, skips assets that are still fresh and sends
+If-None-Match / If-Modified-Since for the rest.
+"""
+import argparse
+import os
+import re
+import sqlite3
+import tempfile
+import time
+
+from benchmarks import load_app, use_database
+from benchmarks.synthetic import generate
+
+ASSET_URL = re.compile(r'''(?:src|href)=["'](/(?:static|uploads)/[^"']+)["']''')
+MAX_AGE = re.compile(r'max-age=(\d+)')
+
+
+def session_pages(shop):
+    typical = shop['typical_borrower']
+    heavy = shop['heaviest_borrower']
+    return [
+        '/dashboard',
+        f"/loan_status/{typical['id']}",
+        f"/device_details/{typical['id']}",
+        '/dashboard',
+        f"/loan_status/{heavy['id']}",
+        '/search?q=' + typical['name'].split()[-1],
+        '/reports',
+        '/api/v1/borrowers?limit=100',
+        '/dashboard',
+    ]
+
+
+class Browser:
+    """ Test client with a private HTTP cache that honours max-age and revalidates with ETag / Last-Modified """
+
+    def __init__(self, app):
+        self.client = app.test_client()
+        self.client.post('/login', data={'username': 'admin', 'password': '123456'})
+        self.cache = {}
+        self.requests = self.bytes = self.not_modified = self.cache_hits = 0
+        self.seconds = 0.0
+
+    def get(self, url):
+        cached = self.cache.get(url)
+        if cached is not None and cached['expires'] > time.time():
+            self.cache_hits += 1
+            return cached['body']
+        headers = {'Accept-Encoding': 'br, gzip'}
+        if cached is not None:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        start = time.perf_counter()
+        response = self.client.get(url, headers=headers)
+        body = response.get_data()
+        self.seconds += time.perf_counter() - start
+        self.requests += 1
+        self.bytes += len(body) + sum(len(k) + len(v) + 4 for k, v in response.headers.items())
+
+        if response.status_code == 304 and cached is not None:
+            self.not_modified += 1
+            cached['expires'] = self._expires(response)
+            return cached['body']
+        if response.status_code == 200:
+            self.cache[url] = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'expires': self._expires(response),
+                'body': response.get_data(as_text=False),
+            }
+        return body
+
+    @staticmethod
+    def _expires(response):
+        match = MAX_AGE.search(response.headers.get('Cache-Control', ''))
+        return time.time() + int(match.group(1)) if match else 0
+
+    def visit(self, url):
+        """ Load a page and the static files and images it references """
+        body = self.get(url)
+        try:
+            text = body.decode('utf-8')
+        except UnicodeDecodeError:  # compressed; the links are the same in the plain copy of the page
+            text = self.client.get(url).get_data(as_text=True)
+        for asset in dict.fromkeys(ASSET_URL.findall(text)):
+            self.get(asset.replace('&amp;', '&'))
+
+    def snapshot(self):
+        return self.requests, self.bytes, self.seconds, self.not_modified, self.cache_hits
+
+
+def toggle_hooks(app_module, enabled):
+    app = app_module.app
+    after = app.after_request_funcs.setdefault(None, [])
+    defaults = app.url_default_functions.setdefault(None, [])
+    for registry, hook in ((after, app_module.cache_and_compress), (defaults, app_module.fingerprint_static_urls)):
+        if enabled and hook not in registry:
+            registry.append(hook)
+        elif not enabled and hook in registry:
+            registry.remove(hook)
+
+
+def run_session(app_module, pages, visits):
+    browser = Browser(app_module.app)
+    rows = []
+    for visit in range(visits):
+        before = browser.snapshot()
+        for url in pages:
+            browser.visit(url)
+        after = browser.snapshot()
+        rows.append([a - b for a, b in zip(after, before)])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--borrowers', type=int, default=10000)
+    parser.add_argument('--visits', type=int, default=5, help='times the session is replayed with one browser cache')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='loan-bench-')
+    app_module = load_app(workdir)
+    db_path = os.path.join(workdir, 'shop.db')
+    app_module.init_db(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    shop = generate(conn, args.borrowers, args.borrowers * 2, args.borrowers * 5, 1.1, args.seed)
+    conn.close()
+    use_database(app_module, db_path)
+    pages = session_pages(shop)
+
+    print(f"{'':10s} {'visit':>6s} {'requests':>9s} {'304s':>5s} {'cached':>7s} {'KiB':>10s} {'ms':>9s}")
+    for label, enabled in (('before', False), ('after', True)):
+        toggle_hooks(app_module, enabled)
+        app_module.page_cache.clear()
+        rows = run_session(app_module, pages, args.visits)
+        for visit, (requests, sent, seconds, not_modified, hits) in enumerate(rows, 1):
+            print(f'{label:10s} {visit:6d} {requests:9d} {not_modified:5d} {hits:7d} {sent / 1024:10.1f} '
+                  f'{seconds * 1000:9.1f}')
+        repeat = rows[1:] or rows
+        print(f"{label:10s} {'repeat':>6s} {'':9s} {'':5s} {'':7s} "
+              f'{sum(r[1] for r in repeat) / len(repeat) / 1024:10.1f} '
+              f'{sum(r[2] for r in repeat) / len(repeat) * 1000:9.1f}  (mean of repeat visits)')
+    toggle_hooks(app_module, True)
+
+
+if __name__ == '__main__':
+    main()
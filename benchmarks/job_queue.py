@@ -0,0 +1,116 @@
+""" Measure what moving heavy work into background jobs buys the other tills.
+
+Builds a synthetic shop and times, from several test-client threads reading
+dashboard pages, three phases: nothing else running, a payments export and a
+balances rebuild made inline in request threads, and the same work queued as
+jobs for the worker threads. Prints read latency for each phase and how long
+the requests that started the work took to answer.
+
+    python -m benchmarks.job_queue --borrowers 50000 --clients 4
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from benchmarks import load_app, use_database
+from benchmarks.backup_latency import percentile
+from benchmarks.synthetic import generate
+
+
+def login(app):
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': '123456'})
+    return client
+
+
+def read_while(app, clients, work):
+    """ Run work() while clients threads read dashboard pages; returns (read latencies, work seconds) """
+    latencies = []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def reader(n):
+        client = login(app)
+        mine = []
+        page = 1
+        while not done.is_set():
+            start = time.perf_counter()
+            client.get(f'/dashboard?page={page}&sort=remaining').get_data()
+            mine.append(time.perf_counter() - start)
+            page = page % 50 + n + 1
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=reader, args=(n,)) for n in range(clients)]
+    for t in threads:
+        t.start()
+    start = time.perf_counter()
+    work()
+    elapsed = time.perf_counter() - start
+    done.set()
+    for t in threads:
+        t.join()
+    return sorted(latencies), elapsed
+
+
+def report(label, latencies, work_seconds, answered):
+    ms = [value * 1000 for value in latencies]
+    print(f'{label:18s} reads p50 {percentile(ms, 0.5):7.1f} ms  p99 {percentile(ms, 0.99):7.1f} ms  '
+          f'work {work_seconds:6.2f}s  answered in {answered * 1000:8.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--borrowers', type=int, default=50000)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=3.0, help='length of the idle phase')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='loan-bench-')
+    app_module = load_app(workdir)
+    app = app_module.app
+    app.config['DB_POOL_SIZE'] = args.clients + 4
+    app.config['JOBS_POLL_SECONDS'] = 0.1
+    db_path = os.path.join(workdir, 'shop.db')
+    app_module.init_db(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    generate(conn, args.borrowers, args.borrowers * 2, args.borrowers * 5, 1.1, 1)
+    conn.close()
+    use_database(app_module, db_path)
+    app_module.job_runner.start()
+    client = login(app)
+
+    reads, elapsed = read_while(app, args.clients, lambda: time.sleep(args.seconds))
+    report('idle', reads, elapsed, 0)
+
+    answered = {}
+
+    def inline():
+        start = time.perf_counter()
+        client.get('/export/payments.csv').get_data()
+        answered['inline'] = time.perf_counter() - start
+        with app.app_context():
+            app_module.rebuild_balances(app_module.get_db())
+
+    reads, elapsed = read_while(app, args.clients, inline)
+    report('inline', reads, elapsed, answered['inline'])
+
+    def queued():
+        start = time.perf_counter()
+        ids = [client.post('/jobs', data=data, headers={'X-Requested-With': 'fetch'}).get_json()['id']
+               for data in ({'kind': 'export', 'dataset': 'payments', 'fmt': 'csv'}, {'kind': 'rebuild-balances'})]
+        answered['queued'] = time.perf_counter() - start
+        while any(client.get(f'/api/v1/jobs/{job_id}').get_json()['state'] in ('queued', 'running')
+                  for job_id in ids):
+            time.sleep(0.05)
+
+    reads, elapsed = read_while(app, args.clients, queued)
+    report('background jobs', reads, elapsed, answered['queued'])
+
+
+if __name__ == '__main__':
+    main()
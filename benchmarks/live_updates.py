@@ -0,0 +1,102 @@
+""" Compare a payment posted the old way, redirect and a full dashboard re-render, with the
+same payment posted from the dashboard script, which gets the changed row back as JSON,
+while other open dashboards follow along on /events.
+
+    python -m benchmarks.live_updates --borrowers 10000 --payments 200 --listeners 4
+
+Prints bytes and milliseconds per payment for both cycles and how long the listeners
+took to see each change.
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from benchmarks import load_app, use_database
+from benchmarks.synthetic import generate
+
+
+def login(app):
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': '123456'})
+    return client
+
+
+def pay(client, name, headers=None, follow=False):
+    response = client.post('/add_payment', data={'borrower_name': name, 'amount_paid': '1',
+                                                 'payment_date': '2025-12-31'},
+                           headers=headers, follow_redirects=follow)
+    return len(response.get_data())
+
+
+def listener(app, seen, ready, stop):
+    """ Read /events like a browser and record when each borrower event arrives """
+    response = login(app).get('/events', buffered=False)
+    ready.release()
+    for chunk in response.response:
+        if stop.is_set():
+            break
+        text = chunk.decode() if isinstance(chunk, bytes) else chunk
+        if 'event: borrower' in text:
+            seen.append(time.perf_counter())
+    response.close()
+
+
+def run(label, client, name, payments, headers=None, follow=False):
+    sent = 0
+    start = time.perf_counter()
+    for _ in range(payments):
+        sent += pay(client, name, headers, follow)
+    elapsed = time.perf_counter() - start
+    print(f'{label:28s} {sent / payments / 1024:8.1f} KiB  {elapsed / payments * 1000:7.2f} ms per payment')
+    return start, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--borrowers', type=int, default=10000)
+    parser.add_argument('--payments', type=int, default=200)
+    parser.add_argument('--listeners', type=int, default=4)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='loan-bench-')
+    app_module = load_app(workdir)
+    app = app_module.app
+    app.config['EVENTS_MAX_CLIENTS'] = args.listeners
+    app.config['EVENTS_KEEPALIVE'] = 1
+    db_path = os.path.join(workdir, 'shop.db')
+    app_module.init_db(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    shop = generate(conn, args.borrowers, args.borrowers * 2, args.borrowers * 5, 1.1, 1)
+    conn.close()
+    use_database(app_module, db_path)
+    name = shop['heaviest_borrower']['name']
+    client = login(app)
+
+    run('redirect + dashboard', client, name, args.payments, follow=True)
+
+    seen, ready, stop = [], threading.Semaphore(0), threading.Event()
+    threads = [threading.Thread(target=listener, args=(app, seen, ready, stop), daemon=True)
+               for _ in range(args.listeners)]
+    for t in threads:
+        t.start()
+    for _ in threads:
+        ready.acquire()
+    while app_module.change_feed.stats()['subscribers'] < args.listeners:
+        time.sleep(0.01)
+    start, elapsed = run(f'json, {args.listeners} listeners', client, name, args.payments,
+                         headers={'X-Requested-With': 'fetch'})
+    deadline = time.perf_counter() + 5
+    while len(seen) < args.payments * args.listeners and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    stop.set()
+    received = len(seen)
+    print(f'events received {received} of {args.payments * args.listeners}, '
+          f'last one {(max(seen) - start - elapsed) * 1000 if seen else 0:.1f} ms after the final post')
+
+
+if __name__ == '__main__':
+    main()
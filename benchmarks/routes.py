@@ -0,0 +1,216 @@
+""" Drive every page of the app through Flask's test client against synthetic
+shops of several sizes and write latency percentiles, SQL query counts and
+peak memory per route to a JSON report that can be diffed between commits.
+
+    python -m benchmarks.routes --sizes 1000 10000 100000 --output report.json
+
+Page-cache hits would hide the work a route does, so the cache is cleared
+before every timed request unless --warm is given.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks import ROOT, load_app, use_database
+from benchmarks.synthetic import generate
+
+
+def build_routes(shop):
+    """ (name, method, url, form) for every route; POSTs repeat a harmless write so they can run many times """
+    heavy = shop['heaviest_borrower']
+    typical = shop['typical_borrower']
+    return [
+        ('dashboard', 'GET', '/dashboard', None),
+        ('dashboard page 20 by remaining', 'GET', '/dashboard?sort=remaining&page=20', None),
+        ('dashboard overdue by name', 'GET', '/dashboard?status=overdue&sort=name&order=asc', None),
+        ('dashboard streamed', 'GET', '/dashboard?stream=1', None),
+        ('add_loan GET', 'GET', '/add_loan', None),
+        ('add_payment GET', 'GET', '/add_payment', None),
+        ('add_payment POST', 'POST', '/add_payment',
+         {'borrower_name': heavy['name'], 'amount_paid': '1', 'payment_date': '2025-12-31'}),
+        ('update_loan POST', 'POST', '/update_loan',
+         {'id': str(typical['id']), 'additional_amount': '1', 'device_description': 'bench'}),
+        ('loan_status heavy', 'GET', f"/loan_status/{heavy['id']}", None),
+        ('loan_status typical', 'GET', f"/loan_status/{typical['id']}", None),
+        ('device_details heavy', 'GET', f"/device_details/{heavy['id']}", None),
+        ('device_details typical', 'GET', f"/device_details/{typical['id']}", None),
+        ('check_name', 'GET', '/check_name?name=' + typical['name'], None),
+        ('typeahead', 'GET', '/borrowers/typeahead?q=' + typical['name'][:3], None),
+        ('edit_borrower GET', 'GET', f"/edit_borrower/{typical['id']}", None),
+        ('edit_borrower POST', 'POST', f"/edit_borrower/{typical['id']}", None),
+        ('edit_payment GET', 'GET', '/edit_payment/{payment_id}', None),
+        ('edit_payment POST', 'POST', '/edit_payment/{payment_id}', None),
+        ('api borrowers', 'GET', '/api/v1/borrowers?limit=100', None),
+        ('api payments heavy', 'GET', f"/api/v1/borrowers/{heavy['id']}/payments?limit=100", None),
+        ('search name', 'GET', '/search?q=' + typical['name'].split()[-1], None),
+        ('search item', 'GET', '/search?q=ثلاجة', None),
+        ('reports', 'GET', '/reports', None),
+        ('api aging report', 'GET', '/api/v1/reports/aging', None),
+        ('api monthly report', 'GET', '/api/v1/reports/monthly', None),
+        ('update_user GET', 'GET', '/update_user', None),
+    ]
+
+
+def resolve_forms(conn, routes, shop):
+    """ Fill in ids and current values for routes that edit existing rows """
+    typical = shop['typical_borrower']
+    borrower = conn.execute('SELECT * FROM borrowers WHERE id = ?', (typical['id'],)).fetchone()
+    payment = conn.execute('SELECT * FROM payments ORDER BY id DESC LIMIT 1').fetchone()
+    resolved = []
+    for name, method, url, form in routes:
+        if '{payment_id}' in url:
+            if payment is None:
+                continue
+            url = url.format(payment_id=payment['id'])
+            if method == 'POST':
+                form = {'amount_paid': str(payment['amount_paid']), 'payment_date': payment['payment_date'],
+                        'device_description': payment['device_description'] or ''}
+        elif name == 'edit_borrower POST':
+            form = {'name': borrower['name'], 'number_phone': borrower['number_phone'],
+                    'total_amount': str(borrower['total_amount']), 'notes': borrower['notes'] or ''}
+        resolved.append((name, method, url, form))
+    return resolved
+
+
+class QueryCounter:
+    """ Count the SQL statements the app's request instrumentation records """
+
+    def __init__(self, app_module):
+        self.count = 0
+        stats_class = app_module.QueryStats
+        original = stats_class.record
+        counter = self
+
+        def record(stats, sql):
+            counter.count += 1
+            return original(stats, sql)
+
+        stats_class.record = record
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def measure(app_module, client, counter, method, url, form, iterations, warm):
+    """ Time one route; queries and Python memory are taken from one extra untimed request """
+    call = client.get if method == 'GET' else client.post
+    latencies = []
+    status = None
+    for _ in range(iterations):
+        if not warm:
+            app_module.page_cache.clear()
+        start = time.perf_counter()
+        response = call(url, data=form)
+        response.get_data()
+        latencies.append((time.perf_counter() - start) * 1000)
+        status = response.status_code
+
+    if not warm:
+        app_module.page_cache.clear()
+    counter.count = 0
+    tracemalloc.start()
+    call(url, data=form).get_data()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'status': status,
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p90_ms': round(percentile(latencies, 0.90), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'max_ms': round(latencies[-1], 3),
+        'queries': counter.count,
+        'peak_python_kb': round(peak / 1024, 1),
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024, 1)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='borrower counts')
+    parser.add_argument('--devices-per-borrower', type=float, default=2.0)
+    parser.add_argument('--payments-per-borrower', type=float, default=5.0)
+    parser.add_argument('--skew', type=float, default=1.1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=30, help='timed requests per route')
+    parser.add_argument('--warm', action='store_true', help='let the page cache answer repeated requests')
+    parser.add_argument('--output', default='benchmark-report.json')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+
+    workdir = tempfile.mkdtemp(prefix='loan-bench-')
+    app_module = load_app(workdir)
+    app = app_module.app
+    counter = QueryCounter(app_module)
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'iterations': args.iterations,
+        'warm_cache': args.warm,
+        'sizes': {},
+    }
+    for size in args.sizes:
+        db_path = os.path.join(workdir, f'shop-{size}.db')
+        app_module.init_db(db_path)
+        conn = sqlite3.connect(db_path)
+        conn.row_factory = sqlite3.Row
+        start = time.perf_counter()
+        shop = generate(conn, size, int(size * args.devices_per_borrower), int(size * args.payments_per_borrower),
+                        args.skew, args.seed)
+        generated = time.perf_counter() - start
+        routes = resolve_forms(conn, build_routes(shop), shop)
+        conn.close()
+        use_database(app_module, db_path)
+
+        client = app.test_client()
+        client.post('/login', data={'username': 'admin', 'password': '123456'})
+        results = {}
+        for name, method, url, form in routes:
+            results[name] = measure(app_module, client, counter, method, url, form, args.iterations, args.warm)
+            print(f"{size:>7} {name:24s} p50 {results[name]['p50_ms']:8.2f} ms  p99 {results[name]['p99_ms']:8.2f} ms  "
+                  f"{results[name]['queries']:3d} queries  {results[name]['peak_python_kb']:9.1f} KiB  "
+                  f"[{results[name]['status']}]")
+
+        report['sizes'][str(size)] = {
+            'shop': shop,
+            'generate_seconds': round(generated, 2),
+            'database_mb': round(os.path.getsize(db_path) / 1e6, 1),
+            'routes': results,
+        }
+
+    report['peak_rss_mb'] = peak_rss_mb()
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+        f.write('\n')
+    print(f'report written to {output}')
+
+
+if __name__ == '__main__':
+    main()
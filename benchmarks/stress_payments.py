@@ -0,0 +1,77 @@
+""" Post payments for the same few borrowers from many threads at once and check
+that no balance goes negative, no write fails on a locked database, and the
+balances table still matches the payments it summarises.
+
+Each borrower owes a fixed amount and the threads together try to pay several
+times that, so without the serialized overpayment check some borrowers would
+end up overpaid.
+
+Run from the repository root:
+
+    python -m benchmarks.stress_payments --threads 16 --payments 200
+"""
+import argparse
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks import load_app, seed
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--payments', type=int, default=200, help='payments posted by each thread')
+    parser.add_argument('--borrowers', type=int, default=4)
+    parser.add_argument('--owed', type=float, default=1000.0)
+    parser.add_argument('--amount', type=float, default=7.0)
+    args = parser.parse_args()
+
+    app_module = load_app(tempfile.mkdtemp(prefix='loan-bench-'))
+    app = app_module.app
+    app.config['DB_POOL_SIZE'] = max(args.threads, 1)
+    seed(app.config['DATABASE'], args.borrowers, args.owed)
+
+    failures = []
+    lock = threading.Lock()
+
+    def cashier(n):
+        client = app.test_client()
+        client.post('/login', data={'username': 'admin', 'password': '123456'})
+        for i in range(args.payments):
+            response = client.post('/add_payment', data={
+                'borrower_name': f'customer {(n + i) % args.borrowers}',
+                'amount_paid': str(args.amount),
+                'payment_date': '2024-01-01',
+            })
+            if response.status_code != 302:
+                with lock:
+                    failures.append(response.status_code)
+
+    threads = [threading.Thread(target=cashier, args=(n,)) for n in range(args.threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    conn = app_module.get_pool().connect()
+    negative = conn.execute('SELECT COUNT(*) FROM balances WHERE remaining < 0').fetchone()[0]
+    paid = conn.execute('SELECT COUNT(*), COALESCE(SUM(amount_paid), 0) FROM payments').fetchone()
+    drift = app_module.verify_balances(conn)
+    conn.close()
+
+    posted = args.threads * args.payments
+    print(f'{posted} payment attempts from {args.threads} threads in {elapsed:.1f}s '
+          f'({posted / elapsed:.0f} req/s)')
+    print(f'accepted {paid[0]} payments totalling {paid[1]:.0f} of {args.borrowers * args.owed:.0f} owed')
+    print(f'failed requests {len(failures)}, negative balances {negative}, drifted balances {len(drift)}')
+    if failures or negative or drift:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+""" Deterministic synthetic shop data for users.db.
+
+Loans and payments follow a power-law skew: a few heavy customers carry many
+devices and dozens of instalments while most borrowers bought one device and
+paid a handful of times. The same seed always produces the same database.
+
+    python -m benchmarks.synthetic users.db --borrowers 10000 --devices 20000 --payments 50000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+from datetime import date, timedelta
+
+FIRST_NAMES = ('محمد', 'علي', 'حسين', 'أحمد', 'عمر', 'مصطفى', 'حسن', 'يوسف', 'إبراهيم', 'كريم',
+               'زينب', 'فاطمة', 'مريم', 'نور', 'سارة', 'هدى', 'رقية', 'آية', 'دعاء', 'إسراء')
+FATHER_NAMES = ('عبد الله', 'جاسم', 'كاظم', 'عباس', 'صالح', 'خالد', 'سعد', 'ناصر', 'جعفر', 'حميد',
+                'رعد', 'فاضل', 'ماجد', 'قاسم', 'هادي', 'وليد', 'طارق', 'سلمان', 'نبيل', 'رياض')
+FAMILY_NAMES = ('الجبوري', 'العبيدي', 'الدليمي', 'التميمي', 'الساعدي', 'الخفاجي', 'الربيعي', 'الزبيدي',
+                'الشمري', 'الكعبي', 'الموسوي', 'الحسيني', 'العامري', 'البياتي', 'السامرائي')
+DEVICES = ('هاتف سامسونج', 'آيفون', 'ثلاجة', 'غسالة', 'مكيف سبليت', 'تلفزيون', 'لابتوب', 'مبردة',
+           'طباخ غاز', 'مولدة', 'مجمدة', 'مكنسة كهربائية', 'شاشة', 'بلايستيشن')
+LOAN_AMOUNTS = (150000, 250000, 350000, 500000, 750000, 1000000, 1500000, 2500000)
+INSTALMENTS = (10000, 25000, 50000, 75000, 100000)
+
+START = date(2022, 1, 1)
+DAYS = 4 * 365
+
+
+def borrower_name(n):
+    """ The n-th name; unique for every n, with a counter once the combinations run out """
+    first = FIRST_NAMES[n % len(FIRST_NAMES)]
+    father = FATHER_NAMES[(n // len(FIRST_NAMES)) % len(FATHER_NAMES)]
+    family = FAMILY_NAMES[(n // (len(FIRST_NAMES) * len(FATHER_NAMES))) % len(FAMILY_NAMES)]
+    cycle = n // (len(FIRST_NAMES) * len(FATHER_NAMES) * len(FAMILY_NAMES))
+    return f'{first} {father} {family}' + (f' {cycle + 1}' if cycle else '')
+
+
+def skewed_counts(rng, total, weights, minimum=0):
+    """ Spread total items over len(weights) owners in proportion to their weights """
+    counts = [minimum] * len(weights)
+    cumulative = []
+    running = 0.0
+    for w in weights:
+        running += w
+        cumulative.append(running)
+    for owner in rng.choices(range(len(weights)), cum_weights=cumulative, k=max(total - minimum * len(weights), 0)):
+        counts[owner] += 1
+    return counts
+
+
+def generate(conn, borrowers, devices=None, payments=None, skew=1.1, seed=1):
+    """ Fill an already migrated database and return a summary of what was written.
+
+    devices counts every loan, including the first one each borrower starts with;
+    payments is a target, since borrowers are never paid past what they owe. """
+    devices = max(devices if devices is not None else 2 * borrowers, borrowers)
+    payments = payments if payments is not None else 5 * borrowers
+    rng = random.Random(seed)
+
+    # Rank 1 is the heaviest customer; ranks are shuffled so heavy customers are spread over the ids
+    ranks = list(range(1, borrowers + 1))
+    rng.shuffle(ranks)
+    weights = [1.0 / rank ** skew for rank in ranks]
+    device_counts = skewed_counts(rng, devices, weights, minimum=1)
+    payment_counts = skewed_counts(rng, payments, weights)
+
+    first_id = (conn.execute('SELECT COALESCE(MAX(id), 0) FROM borrowers').fetchone()[0]) + 1
+    borrower_rows = []
+    device_rows = []
+    payment_rows = []
+    for i in range(borrowers):
+        borrower_id = first_id + i
+        opened = rng.randrange(DAYS)
+        loans = []
+        for _ in range(device_counts[i]):
+            day = opened + rng.randrange(DAYS - opened)
+            loans.append((day, rng.choice(LOAN_AMOUNTS)))
+        loans.sort()
+        total = sum(amount for _, amount in loans)
+        for day, amount in loans:
+            device_rows.append((START + timedelta(days=day), borrower_id, rng.choice(DEVICES), amount))
+
+        # About a third of borrowers have settled; the rest paid part of what they owe
+        owed = total if rng.random() < 0.3 else total * rng.random()
+        for _ in range(payment_counts[i]):
+            if owed <= 0:
+                break
+            amount = min(owed, rng.choice(INSTALMENTS))
+            owed -= amount
+            day = opened + rng.randrange(DAYS - opened)
+            payment_rows.append((START + timedelta(days=day), borrower_id, amount))
+
+        borrower_rows.append((borrower_id, borrower_name(first_id - 1 + i), f'07{rng.randrange(10 ** 9):09d}',
+                              float(total), rng.choice(('', '', '', 'كفيل: ' + rng.choice(FIRST_NAMES)))))
+
+    # Rows go in date order, as they would have been entered at the till
+    device_rows.sort()
+    payment_rows.sort()
+    with conn:
+        conn.executemany('INSERT INTO borrowers (id, name, number_phone, total_amount, notes) VALUES (?, ?, ?, ?, ?)',
+                         borrower_rows)
+        conn.executemany('''INSERT INTO devices (device_date, borrower_id, device_description, device_amount)
+                            VALUES (?, ?, ?, ?)''',
+                         ((day.isoformat(), borrower_id, description, amount)
+                          for day, borrower_id, description, amount in device_rows))
+        conn.executemany('INSERT INTO payments (payment_date, borrower_id, amount_paid) VALUES (?, ?, ?)',
+                         ((day.isoformat(), borrower_id, amount) for day, borrower_id, amount in payment_rows))
+
+    heaviest = first_id + ranks.index(1)
+    typical = first_id + ranks.index(borrowers // 2 + 1)
+    return {
+        'borrowers': borrowers,
+        'devices': len(device_rows),
+        'payments': len(payment_rows),
+        'skew': skew,
+        'seed': seed,
+        'heaviest_borrower': {'id': heaviest, 'name': borrower_rows[heaviest - first_id][1],
+                              'devices': device_counts[heaviest - first_id],
+                              'payments': sum(1 for row in payment_rows if row[1] == heaviest)},
+        'typical_borrower': {'id': typical, 'name': borrower_rows[typical - first_id][1]},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database', help='users.db to create or extend')
+    parser.add_argument('--borrowers', type=int, default=10000)
+    parser.add_argument('--devices', type=int, help='default: 2 per borrower')
+    parser.add_argument('--payments', type=int, help='default: 5 per borrower')
+    parser.add_argument('--skew', type=float, default=1.1, help='power-law exponent of customer activity')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app import init_db
+    init_db(args.database)
+    conn = sqlite3.connect(args.database)
+    summary = generate(conn, args.borrowers, args.devices, args.payments, args.skew, args.seed)
+    conn.close()
+    print(f"{summary['borrowers']} borrowers, {summary['devices']} devices, {summary['payments']} payments; "
+          f"heaviest customer #{summary['heaviest_borrower']['id']} has "
+          f"{summary['heaviest_borrower']['devices']} devices and {summary['heaviest_borrower']['payments']} payments")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+/* Live dashboard: patches rows and header totals from the /events stream and submits
+ * forms marked data-live with fetch, so a payment or a new loan does not reload the page.
+ *
+ * Markup it looks for in modern_dashboard.html:
+ *   <script src="{{ url_for('static', filename='js/live_dashboard.js') }}" defer></script>
+ *   <tr data-borrower-id="{{ borrower.id }}"> ... <td data-field="remaining"> ... </tr>
+ *   <span data-total="total_remaining"> ... </span>
+ *   <form method="post" action="..." data-live> ... </form>
+ * data-field may name any column of a borrower event (name, number_phone, total_loaned,
+ * total_paid, payment_count, remaining, last_payment_date, device_description);
+ * data-total any shop_summary column. Amount columns are shown like the format_number filter.
+ */
+(function () {
+    'use strict';
+
+    var AMOUNTS = ['total_loaned', 'total_paid', 'remaining', 'total_loans', 'total_remaining'];
+
+    function format(name, value) {
+        if (value === null || value === undefined) {
+            return '';
+        }
+        if (AMOUNTS.indexOf(name) !== -1) {
+            return Math.round(Number(value)).toLocaleString('en-US');
+        }
+        return String(value);
+    }
+
+    function setTotals(totals) {
+        Object.keys(totals || {}).forEach(function (name) {
+            document.querySelectorAll('[data-total="' + name + '"]').forEach(function (element) {
+                element.textContent = format(name, totals[name]);
+            });
+        });
+    }
+
+    function applyChange(change) {
+        var rows = document.querySelectorAll('[data-borrower-id="' + change.id + '"]');
+        rows.forEach(function (row) {
+            if (change.borrower === null) {
+                row.remove();
+                return;
+            }
+            row.querySelectorAll('[data-field]').forEach(function (cell) {
+                var name = cell.getAttribute('data-field');
+                if (name in change.borrower) {
+                    cell.textContent = format(name, change.borrower[name]);
+                }
+            });
+            row.classList.toggle('settled', change.borrower.remaining <= 0);
+            row.classList.add('live-updated');
+            setTimeout(function () { row.classList.remove('live-updated'); }, 1500);
+        });
+        setTotals(change.totals);
+    }
+
+    function listen() {
+        if (!window.EventSource) {
+            return;
+        }
+        var source = new EventSource('/events');
+        source.addEventListener('borrower', function (event) {
+            applyChange(JSON.parse(event.data));
+        });
+        source.addEventListener('reload', function () {
+            // Too much changed to patch row by row (an import, a restore, a long disconnect)
+            source.close();
+            window.location.reload();
+        });
+    }
+
+    function submitLive(event) {
+        var form = event.target;
+        if (!form.hasAttribute || !form.hasAttribute('data-live')) {
+            return;
+        }
+        event.preventDefault();
+        fetch(form.action, {
+            method: 'POST',
+            body: new FormData(form),
+            credentials: 'same-origin',
+            headers: {'X-Requested-With': 'fetch', 'Accept': 'application/json'}
+        }).then(function (response) {
+            return response.json();
+        }).then(function (result) {
+            if (!result.ok) {
+                window.alert(result.errors.join('\n'));
+                return;
+            }
+            if (result.reload) {
+                window.location.reload();
+                return;
+            }
+            result.changes.forEach(applyChange);
+            setTotals(result.totals);
+            form.reset();
+        }).catch(function () {
+            // Fall back to an ordinary post and redirect
+            form.removeAttribute('data-live');
+            form.submit();
+        });
+    }
+
+    document.addEventListener('submit', submitLive);
+    document.addEventListener('DOMContentLoaded', listen);
+}());
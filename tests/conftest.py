@@ -0,0 +1,65 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks import load_app, use_database  # noqa: E402
+
+
+def pytest_addoption(parser):
+    parser.addoption('--slow', action='store_true', help='also run the tests marked slow')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'slow: takes about a minute and a large scratch database; run with --slow')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--slow'):
+        return
+    skip = pytest.mark.skip(reason='slow, run with --slow')
+    for item in items:
+        if 'slow' in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    """ The app module pointed at a fresh, migrated database and upload folder in tmp_path """
+    monkeypatch.chdir(tmp_path)
+    module = load_app(str(tmp_path))
+    monkeypatch.setitem(module.app.config, 'UPLOAD_FOLDER', str(tmp_path / 'uploads'))
+    monkeypatch.setitem(module.app.config, 'BACKUP_FOLDER', None)
+    monkeypatch.setitem(module.app.config, 'EXPORT_FOLDER', None)
+    os.makedirs(module.app.config['UPLOAD_FOLDER'])
+    use_database(module, str(tmp_path / 'users.db'))
+    yield module
+    pool = module.app.extensions.pop('db_pool', None)
+    if pool is not None:
+        pool.close_all()
+
+
+@pytest.fixture
+def db_path(app_module):
+    return app_module.app.config['DATABASE']
+
+
+@pytest.fixture
+def raw_db(db_path):
+    """ A plain sqlite3 connection to the test database, for seeding """
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def client(app_module):
+    client = app_module.app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': '123456'})
+    return client
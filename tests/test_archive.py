@@ -0,0 +1,50 @@
+import json
+import sqlite3
+
+import pytest
+
+
+def settled_borrower(raw_db, name):
+    """ A borrower who paid everything back long ago """
+    cursor = raw_db.execute('INSERT INTO borrowers (name, number_phone, total_amount, notes) VALUES (?, ?, 100, ?)',
+                            (name, '077', ''))
+    raw_db.execute("INSERT INTO devices (borrower_id, device_description, device_image, device_date, device_amount) "
+                   "VALUES (?, 'phone', '', '2020-01-01', 100)", (cursor.lastrowid,))
+    raw_db.execute("INSERT INTO payments (borrower_id, amount_paid, payment_date) VALUES (?, 100, '2020-02-01')",
+                   (cursor.lastrowid,))
+    raw_db.commit()
+    return cursor.lastrowid
+
+
+def test_restore_refuses_a_name_taken_while_archived(app_module, raw_db):
+    borrower_id = settled_borrower(raw_db, 'Ali')
+    with app_module.app.app_context():
+        conn = app_module.get_db()
+        assert app_module.archive_settled(conn, days=30) == [borrower_id]
+
+        # A database migrated with duplicate names only has a plain index on the normalized name
+        raw_db.execute('DROP INDEX idx_borrowers_name_normalized')
+        raw_db.execute('CREATE INDEX idx_borrowers_name_normalized ON borrowers (LOWER(TRIM(name)))')
+        raw_db.execute("INSERT INTO borrowers (name, number_phone, total_amount, notes) VALUES (' ali ', '078', 50, '')")
+        raw_db.commit()
+
+        with pytest.raises(sqlite3.IntegrityError):
+            app_module.restore_borrower(conn, borrower_id)
+        assert conn.execute('SELECT COUNT(*) FROM archive.borrowers WHERE id = ?', (borrower_id,)).fetchone()[0] == 1
+
+    assert raw_db.execute("SELECT COUNT(*) FROM borrowers WHERE LOWER(TRIM(name)) = 'ali'").fetchone()[0] == 1
+
+
+def test_archive_job_reclaims_space(app_module, raw_db):
+    for n in range(50):
+        settled_borrower(raw_db, f'customer {n}')
+    with app_module.app.app_context():
+        conn = app_module.get_db()
+        job_id = app_module.enqueue_job(conn, 'archive', {'days': '30'})
+        assert app_module.job_runner.work(conn) == 1
+        row = conn.execute('SELECT state, result FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+    assert row['state'] == 'done'
+    result = json.loads(row['result'])
+    assert result['archived'] == 50
+    assert isinstance(result['freed_pages'], int)
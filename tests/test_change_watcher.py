@@ -0,0 +1,104 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def watcher(app_module, monkeypatch):
+    """ A fresh change watcher, polled by hand on a pooled connection """
+    watcher = app_module.ChangeWatcher()
+    monkeypatch.setattr(app_module, 'change_watcher', watcher)
+    conn = app_module.get_pool().connect()
+    watcher.poll(conn)
+    yield lambda: watcher.poll(conn)
+    conn.close()
+
+
+def add_borrower(raw_db, name):
+    """ A write made by another process, such as flask import-csv """
+    cursor = raw_db.execute('INSERT INTO borrowers (name, number_phone, total_amount, notes) VALUES (?, ?, 100, ?)',
+                            (name, '077', ''))
+    raw_db.commit()
+    return cursor.lastrowid
+
+
+def test_names_written_elsewhere_reach_the_name_index(app_module, raw_db, watcher):
+    with app_module.app.app_context():
+        app_module.name_index.warm()
+        borrower_id = add_borrower(raw_db, 'Ali')
+        assert app_module.name_index.find('ali') is None
+
+        assert watcher() == 1
+        assert app_module.name_index.find('ali') == borrower_id
+
+        raw_db.execute("UPDATE borrowers SET name = 'Omar' WHERE id = ?", (borrower_id,))
+        raw_db.commit()
+        watcher()
+        assert app_module.name_index.find('ali') is None
+        assert app_module.name_index.find('omar') == borrower_id
+
+
+def test_payments_written_elsewhere_move_the_borrower_version(app_module, raw_db, watcher):
+    borrower_id = add_borrower(raw_db, 'Ali')
+    watcher()
+    before = app_module.data_versions.borrower(borrower_id)
+    raw_db.execute("INSERT INTO payments (borrower_id, amount_paid, payment_date) VALUES (?, 10, '2025-01-01')",
+                   (borrower_id,))
+    raw_db.commit()
+    assert watcher() == 1
+    assert app_module.data_versions.borrower(borrower_id) > before
+
+
+def test_shop_wide_changes_elsewhere_reset_everything(app_module, raw_db, watcher):
+    borrower_id = add_borrower(raw_db, 'Ali')
+    watcher()
+    before = app_module.data_versions.borrower(borrower_id + 1)
+    raw_db.execute('INSERT INTO data_changes (borrower_id) VALUES (NULL)')
+    raw_db.commit()
+    watcher()
+    assert app_module.data_versions.borrower(borrower_id + 1) > before
+
+    # A restored copy of the file can end before the ids already read
+    raw_db.execute('DELETE FROM data_changes')
+    raw_db.commit()
+    before = app_module.data_versions.borrower(borrower_id + 1)
+    watcher()
+    assert app_module.data_versions.borrower(borrower_id + 1) > before
+
+
+def test_live_feed_gets_outside_changes_once(app_module, raw_db, client, watcher):
+    borrower_id = add_borrower(raw_db, 'Ali')
+    watcher()
+    subscriber = app_module.change_feed.subscribe()
+    try:
+        raw_db.execute("INSERT INTO payments (borrower_id, amount_paid, payment_date) VALUES (?, 10, '2025-01-01')",
+                       (borrower_id,))
+        raw_db.commit()
+        watcher()
+        event = subscriber.get_nowait()
+        assert event[1] == 'borrower'
+        assert json.loads(event[2])['borrower']['total_paid'] == 10
+
+        # Published by the request itself; the watcher sees the same row and stays quiet
+        client.post('/add_payment', data={'borrower_name': 'Ali', 'amount_paid': '5', 'payment_date': '2025-01-02'})
+        assert json.loads(subscriber.get_nowait()[2])['borrower']['total_paid'] == 15
+        watcher()
+        assert subscriber.empty()
+    finally:
+        app_module.change_feed.unsubscribe(subscriber)
+
+
+def test_restore_continues_the_change_log(app_module, raw_db, client, tmp_path, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'BACKUP_FOLDER', str(tmp_path / 'backups'))
+    with app_module.app.app_context():
+        stamp = app_module.create_backup()
+        add_borrower(raw_db, 'Ali')
+        add_borrower(raw_db, 'Omar')
+        seen = raw_db.execute('SELECT MAX(id) FROM data_changes').fetchone()[0]
+
+        app_module.restore_backup(stamp)
+
+    assert raw_db.execute('SELECT COUNT(*) FROM borrowers').fetchone()[0] == 0
+    newest = raw_db.execute('SELECT id, borrower_id FROM data_changes ORDER BY id DESC LIMIT 1').fetchone()
+    assert newest['id'] > seen
+    assert newest['borrower_id'] is None
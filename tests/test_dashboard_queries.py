@@ -0,0 +1,41 @@
+import re
+
+import pytest
+
+from benchmarks import seed
+
+
+def add_activity(raw_db):
+    """ Give every borrower a device and two payments so the per-row lookups have something to find """
+    raw_db.execute("INSERT INTO devices (borrower_id, device_description, device_image, device_date, device_amount) "
+                   "SELECT id, 'phone', '', '2025-01-01', 10 FROM borrowers "
+                   "WHERE id NOT IN (SELECT borrower_id FROM devices)")
+    raw_db.execute("INSERT INTO payments (borrower_id, amount_paid, payment_date) "
+                   "SELECT id, 1, '2025-01-02' FROM borrowers, (SELECT 1 UNION ALL SELECT 2) "
+                   "WHERE id NOT IN (SELECT borrower_id FROM payments)")
+    raw_db.commit()
+
+
+def dashboard_queries(app_module, client, query):
+    app_module.page_cache.clear()
+    response = client.get('/dashboard' + query)
+    assert response.status_code == 200
+    return int(re.search(r'"(\d+) queries"', response.headers['Server-Timing']).group(1))
+
+
+@pytest.mark.parametrize('query', ['', '?sort=remaining&order=asc', '?status=unsettled&page=2',
+                                   '?status=overdue&per_page=100'])
+def test_dashboard_query_count_does_not_grow_with_borrowers(app_module, raw_db, db_path, client, monkeypatch, query):
+    # Only the data handed to the page matters here, not its markup
+    monkeypatch.setattr(app_module, 'render_template', lambda name, **context: str(len(context['borrowers'])))
+    seed(db_path, 30)
+    add_activity(raw_db)
+    small = dashboard_queries(app_module, client, query)
+
+    raw_db.execute("UPDATE borrowers SET name = 'old ' || name")
+    raw_db.commit()
+    seed(db_path, 270)
+    add_activity(raw_db)
+    large = dashboard_queries(app_module, client, query)
+
+    assert small == large
@@ -0,0 +1,63 @@
+import tracemalloc
+
+import pytest
+
+from benchmarks.bench_export import rss_mb, seed_payments
+
+# The budget bench_export checks by default
+RSS_BUDGET_MB = 32
+
+
+def export_peak(client):
+    """ Read /export/payments.csv chunk by chunk; returns (lines, bytes, peak traced memory) """
+    tracemalloc.start()
+    try:
+        response = client.get('/export/payments.csv', buffered=False)
+        assert response.status_code == 200
+        lines = size = 0
+        for chunk in response.response:
+            lines += chunk.count(b'\n') if isinstance(chunk, bytes) else chunk.count('\n')
+            size += len(chunk)
+        response.close()
+        return lines, size, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_payments_export_streams_in_bounded_memory(raw_db, db_path, client):
+    seed_payments(db_path, 200, 10000)
+    export_peak(client)
+    lines, small_size, small_peak = export_peak(client)
+    assert lines == 10000 + 1
+
+    # Four times the rows
+    for _ in range(2):
+        raw_db.execute('INSERT INTO payments (borrower_id, amount_paid, payment_date, device_description) '
+                       'SELECT borrower_id, amount_paid, payment_date, device_description FROM payments')
+    raw_db.commit()
+    lines, large_size, large_peak = export_peak(client)
+
+    assert lines == 40000 + 1
+    assert large_size > 3 * small_size
+    # Memory follows the chunk size, not the file size
+    assert large_peak < small_peak * 1.5
+
+
+@pytest.mark.slow
+def test_million_payment_export_stays_within_rss_budget(raw_db, db_path, client):
+    payments = 1000000
+    seed_payments(db_path, 10000, payments)
+
+    baseline = peak = rss_mb()
+    response = client.get('/export/payments.csv', buffered=False)
+    assert response.status_code == 200
+    lines = size = 0
+    for chunk in response.response:
+        lines += chunk.count(b'\n') if isinstance(chunk, bytes) else chunk.count('\n')
+        size += len(chunk)
+        peak = max(peak, rss_mb())
+    response.close()
+
+    assert lines == payments + 1
+    assert size > 40 * 1024 * 1024
+    assert peak - baseline < RSS_BUDGET_MB
@@ -0,0 +1,35 @@
+import hashlib
+import io
+import os
+
+import pytest
+
+
+def make_png():
+    Image = pytest.importorskip('PIL.Image')
+    buffer = io.BytesIO()
+    Image.new('RGB', (600, 400), (200, 30, 30)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def test_images_migrate_renames_and_thumbnails(app_module, raw_db):
+    upload_dir = app_module.app.config['UPLOAD_FOLDER']
+    data = make_png()
+    for name in ('old photo.png', 'copy.png'):
+        with open(os.path.join(upload_dir, name), 'wb') as f:
+            f.write(data)
+    raw_db.execute("INSERT INTO borrowers (name, number_phone, total_amount, notes) VALUES ('Ali', '077', 100, '')")
+    raw_db.executemany('INSERT INTO devices (borrower_id, device_description, device_image, device_date, device_amount) '
+                       "VALUES (1, 'phone', ?, '2025-01-01', 50)", [('old photo.png',), ('copy.png',), ('gone.png',)])
+    raw_db.commit()
+
+    result = app_module.app.test_cli_runner().invoke(args=['images', 'migrate'])
+
+    assert result.exit_code == 0, result.output
+    assert '1 file(s) renamed, 1 duplicate(s) removed, 1 missing file(s)' in result.output
+    stored = hashlib.sha256(data).hexdigest() + '.png'
+    assert sorted(name for name in os.listdir(upload_dir) if name != 'thumbs') == [stored]
+    images = {row[0] for row in raw_db.execute('SELECT device_image FROM devices')}
+    assert images == {stored, 'gone.png'}
+    for variant in app_module.IMAGE_VARIANTS:
+        assert os.path.exists(os.path.join(upload_dir, app_module.variant_filename(stored, variant)))
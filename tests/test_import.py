@@ -0,0 +1,49 @@
+from datetime import datetime
+
+
+def run_import(app_module, kind, lines):
+    with app_module.app.app_context():
+        return app_module.import_csv(app_module.get_db(), kind, lines)
+
+
+def seed_borrower(raw_db, name='Ali', owed=100):
+    raw_db.execute('INSERT INTO borrowers (name, number_phone, total_amount, notes) VALUES (?, ?, ?, ?)',
+                   (name, '077', owed, ''))
+    raw_db.commit()
+
+
+def test_payments_are_checked_against_balances_at_write_time(app_module, raw_db):
+    seed_borrower(raw_db, owed=100)
+
+    def lines():
+        yield 'borrower_name,amount_paid,payment_date\n'
+        yield 'Ali,60,2025-01-01\n'
+        # Another till takes a payment while the file is still being read
+        raw_db.execute("INSERT INTO payments (borrower_id, amount_paid, payment_date) VALUES (1, 30, '2025-01-01')")
+        raw_db.commit()
+        yield 'Ali,30,2025-01-02\n'
+        yield 'Ali,10,2025-01-03\n'
+
+    report = run_import(app_module, 'payments', lines())
+
+    assert report['imported'] == 2
+    assert [error['line'] for error in report['errors']] == [3]
+    remaining = raw_db.execute('SELECT remaining FROM balances WHERE borrower_id = 1').fetchone()[0]
+    assert remaining == 0
+
+
+def test_rejected_payments_do_not_use_up_the_balance(app_module, raw_db):
+    seed_borrower(raw_db, owed=100)
+    report = run_import(app_module, 'payments', ['borrower_name,amount_paid,payment_date\n',
+                                                 'Ali,500,2025-01-01\n',
+                                                 'Ali,100,2025-01-02\n'])
+    assert report['imported'] == 1
+    assert report['errors'] == [{'line': 2, 'error': 'اكثر'}]
+
+
+def test_borrower_loan_without_a_date_is_dated_today(app_module, raw_db):
+    report = run_import(app_module, 'borrowers', ['name,number_phone,total_amount,device_description\n',
+                                                  'Sara,078,250,phone\n'])
+    assert report == {'kind': 'borrowers', 'imported': 1, 'errors': []}
+    device = raw_db.execute('SELECT device_date, device_amount FROM devices').fetchone()
+    assert tuple(device) == (datetime.now().strftime('%Y-%m-%d'), 250)
@@ -0,0 +1,20 @@
+def test_rebuilding_balances_refreshes_cached_borrower_pages(app_module, raw_db, client, monkeypatch):
+    # Only the balance handed to the page matters here, not its markup
+    monkeypatch.setattr(app_module, 'render_template',
+                        lambda name, **context: f"remaining={context['remaining']}")
+    raw_db.execute("INSERT INTO borrowers (name, number_phone, total_amount, notes) VALUES ('Ali', '077', 100, '')")
+    raw_db.execute('UPDATE balances SET remaining = 999 WHERE borrower_id = 1')
+    raw_db.commit()
+    app_module.page_cache.clear()
+
+    assert client.get('/loan_status/1').get_data(as_text=True) == 'remaining=999.0'
+    hits = app_module.page_cache.hits
+    assert client.get('/loan_status/1').get_data(as_text=True) == 'remaining=999.0'
+    assert app_module.page_cache.hits == hits + 1
+
+    with app_module.app.app_context():
+        conn = app_module.get_db()
+        app_module.enqueue_job(conn, 'rebuild-balances')
+        assert app_module.job_runner.work(conn) == 1
+
+    assert client.get('/loan_status/1').get_data(as_text=True) == 'remaining=100.0'
@@ -0,0 +1,34 @@
+import pytest
+
+
+@pytest.fixture
+def shop(raw_db):
+    from benchmarks.synthetic import generate
+    shop = generate(raw_db, 300, 600, 1500, 1.1, 1)
+    raw_db.commit()
+    return shop
+
+
+def test_search_page_renders_matches(client, shop):
+    name = shop['typical_borrower']['name']
+    response = client.get('/search', query_string={'q': name.split()[-1]})
+    assert response.status_code == 200
+    assert '<mark>' in response.get_data(as_text=True)
+
+
+def test_search_page_escapes_the_query(client, shop):
+    response = client.get('/search', query_string={'q': '<script>'})
+    assert response.status_code == 200
+    assert '<script>' not in response.get_data(as_text=True)
+
+
+def test_reports_page_renders_every_section(client, shop, app_module):
+    response = client.get('/reports', query_string={'days': 30})
+    assert response.status_code == 200
+    text = response.get_data(as_text=True)
+    with app_module.app.app_context():
+        conn = app_module.get_db()
+        months = app_module.monthly_report(conn)
+        overdue = app_module.overdue_borrowers(conn, 30)
+    assert months and months[0]['month'] in text
+    assert all(str(borrower['name']) in text for borrower in overdue[:5])
@@ -0,0 +1,23 @@
+from benchmarks.synthetic import generate
+
+
+def test_hot_queries_use_their_indexes_on_a_migrated_database(app_module, raw_db):
+    assert app_module.check_query_plans(raw_db) == []
+
+
+def test_hot_queries_use_their_indexes_after_analyze(app_module, raw_db):
+    generate(raw_db, 500, 1000, 2500, 1.1, 1)
+    raw_db.execute('ANALYZE')
+    assert app_module.check_query_plans(raw_db) == []
+
+
+def test_schema_plans_reports_a_missing_index(app_module, raw_db):
+    runner = app_module.app.test_cli_runner()
+    result = runner.invoke(args=['schema', 'plans'])
+    assert result.exit_code == 0, result.output
+
+    raw_db.execute('DROP INDEX idx_payments_date')
+    raw_db.commit()
+    result = runner.invoke(args=['schema', 'plans'])
+    assert result.exit_code == 1, result.output
+    assert 'payments' in result.output
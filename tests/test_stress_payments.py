@@ -0,0 +1,40 @@
+import threading
+
+from benchmarks import seed
+
+
+def test_concurrent_payments_never_overpay(app_module, raw_db, db_path, monkeypatch):
+    threads, payments, borrowers, owed = 8, 30, 2, 100.0
+    app = app_module.app
+    monkeypatch.setitem(app.config, 'DB_POOL_SIZE', threads)
+    seed(db_path, borrowers, owed)
+
+    failures = []
+    lock = threading.Lock()
+
+    def cashier(n):
+        client = app.test_client()
+        client.post('/login', data={'username': 'admin', 'password': '123456'})
+        for i in range(payments):
+            response = client.post('/add_payment', data={
+                'borrower_name': f'customer {(n + i) % borrowers}',
+                'amount_paid': '7',
+                'payment_date': '2024-01-01',
+            })
+            if response.status_code != 302:
+                with lock:
+                    failures.append(response.status_code)
+
+    pool = [threading.Thread(target=cashier, args=(n,)) for n in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+
+    assert failures == []
+    assert raw_db.execute('SELECT COUNT(*) FROM balances WHERE remaining < 0').fetchone()[0] == 0
+    paid = raw_db.execute('SELECT borrower_id, SUM(amount_paid) FROM payments GROUP BY borrower_id').fetchall()
+    # The tills together try to pay far more than is owed; each borrower stops one payment short of going negative
+    assert sorted(row[1] for row in paid) == [98.0] * borrowers
+    with app.app_context():
+        assert app_module.verify_balances(app_module.get_db()) == []